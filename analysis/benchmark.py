@@ -0,0 +1,371 @@
+import argparse
+import importlib.metadata
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import synthetic
+
+'''
+Timing and peak memory benchmarks of the analysis hot paths on synthetic
+bricks (see `synthetic.py`):
+
+    python3 analysis/benchmark.py --trials 10000,100000,1000000
+
+The bricks for each number of trials are written once under `--data-dir`
+and reused. Each (case, trials) pair runs in a fresh process, so imports,
+caches and the memory of one case do not affect another. A case is timed
+`--repeat` times on fresh inputs, after a warm-up run and a run that
+measures memory:
+
+  - peak_mb: peak of the memory traced by `tracemalloc` (Python objects
+    and NumPy/pandas arrays),
+  - peak_rss_mb: growth of the peak resident set size of the process during
+    the run (Linux; also counts Arrow and DuckDB memory).
+
+The slope of log(time) over log(trials) between two sizes is printed as
+`scaling` (1 is linear).
+
+With `--baseline`, results are compared with a saved run and the command
+exits with status 1 if a case is slower than the baseline by more than
+`--tolerance` or uses more memory than it by more than
+`--memory-tolerance`. `analysis/benchmark_baseline.json` is the baseline of
+the committed code; timings depend on the machine, so save one of your own
+with `--save-baseline` before comparing changes. The report records the
+environment (`environment()`), `--repeat` and `--seed`. A baseline recorded
+on other hardware (`HARDWARE`, e.g. another CPU count) is replaced rather
+than added to by `--save-baseline`, and `--baseline` refuses to compare
+with it (exit status 2).
+'''
+
+DEFAULT_TRIALS = [10_000, 100_000, 1_000_000]
+BASELINE = Path(__file__).with_name('benchmark_baseline.json')
+
+# Fields of `environment()` that timings are only comparable between
+HARDWARE = ['machine', 'system', 'cpus']
+
+
+def _window_paths(data_dir):
+    window_dir = Path(data_dir) / 'rule-effective-date_processed'
+    return (str(window_dir / 'datebefore_hlact_studies.parquet'),
+            str(window_dir / 'dateafter_hlact_studies.parquet'))
+
+
+def _dataframes(data_dir):
+    # Inputs of the cases downstream of `get_dataframes`, always with pandas:
+    # the DuckDB backend only returns the columns the plotter needs
+    import utils
+    return utils.get_dataframes(*_window_paths(data_dir))
+
+
+# Each case takes the brick directory and the backend and returns a function
+# that makes the inputs of one run and the function to time on them. The
+# backend only applies to `get_dataframes` and `plot_boxplot_yearly`.
+
+def case_get_dataframes(data_dir, backend):
+    import utils
+    paths = _window_paths(data_dir)
+    return lambda: (), lambda: utils.get_dataframes(*paths, backend=backend)
+
+
+def case_process_months_to_report(data_dir, backend):
+    import utils
+    df = utils.read_processed(_window_paths(data_dir)[0])
+    # Adds its columns in place, so each run gets a copy of the brick as read
+    return lambda: (df.copy(),), utils.process_months_to_report
+
+
+def case_get_d_rates(data_dir, backend):
+    import utils
+    df_overall = _dataframes(data_dir)[2]
+    return lambda: (df_overall, 36), utils.get_d_rates
+
+
+def case_get_confints(data_dir, backend):
+    import plotter
+    df_pre, df_post = _dataframes(data_dir)[:2]
+    return (lambda: (df_pre, df_post, 10_000, [2.5, 97.5]),
+            lambda *args: plotter.get_confints(*args, rng=np.random.default_rng(10)))
+
+
+def case_permutation_test_overall(data_dir, backend):
+    import plotter
+    df_pre, df_post = _dataframes(data_dir)[:2]
+
+    return (lambda: (df_pre, df_post),
+            lambda *args: plotter.permutation_test_overall(
+                *args, N_reps=50_000, rng=np.random.default_rng(10)))
+
+
+def case_plot_boxplot_yearly(data_dir, backend):
+    import plotter
+    dirpath = str(Path(data_dir) / 'yearly_obs36_processed')
+    return lambda: (), lambda: plotter.plot_boxplot_yearly(dirpath, backend=backend)
+
+
+CASES = {
+    'get_dataframes': case_get_dataframes,
+    'process_months_to_report': case_process_months_to_report,
+    'get_d_rates': case_get_d_rates,
+    'get_confints': case_get_confints,
+    'permutation_test_overall': case_permutation_test_overall,
+    'plot_boxplot_yearly': case_plot_boxplot_yearly,
+}
+
+
+def _proc_status(field):
+    # Value in MiB of a `/proc/self/status` field, or None off Linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Resets VmHWM to the current RSS (Linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    peak = _proc_status('VmHWM')
+    if peak is None:
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak /= 1024**2 if sys.platform == 'darwin' else 1024
+    return peak
+
+
+def run_case(name, data_dir, backend='pandas', repeat=3):
+    '''
+    Time and measure the memory of case `name` on the bricks in `data_dir`.
+    '''
+    make_args, func = CASES[name](data_dir, backend)
+
+    # One run first so that lazy imports and caches are not measured
+    func(*make_args())
+
+    args = make_args()
+    rss_before = _proc_status('VmRSS') if _reset_peak_rss() else None
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_rss = _peak_rss_mb() - rss_before if rss_before is not None else None
+    del args
+
+    times = []
+    for _ in range(repeat):
+        args = make_args()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+        del args
+
+    return {
+        'case': name,
+        'backend': backend,
+        'wall_s_min': round(min(times), 4),
+        'wall_s_median': round(statistics.median(times), 4),
+        'peak_mb': round(peak / 1024**2, 1),
+        'peak_rss_mb': round(peak_rss, 1) if peak_rss is not None else None,
+    }
+
+
+def ensure_bricks(data_dir, trials, seed=0):
+    '''
+    Directory of the synthetic bricks of `trials` trials, written if missing.
+    '''
+    path = Path(data_dir) / f'{trials}-{seed}'
+    done = path / '.complete'
+    if not done.exists():
+        print(f'benchmark: writing synthetic bricks of {trials} trials to {path}', file=sys.stderr)
+        synthetic.write_bricks(path, trials, seed=seed)
+        done.touch()
+    return path
+
+
+def run(cases, trials, data_dir, backend='pandas', repeat=3, seed=0):
+    results = []
+    # One fresh process per case, so peak memory is per case
+    context = multiprocessing.get_context('spawn')
+    for n in trials:
+        bricks = ensure_bricks(data_dir, n, seed)
+        for name in cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_case, name, str(bricks), backend, repeat).result()
+            result['trials'] = n
+            results.append(result)
+            print(format_result(result), file=sys.stderr)
+    return results
+
+
+def _version(package):
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'duckdb': _version('duckdb'),
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def hardware_differences(env, baseline_env):
+    '''
+    Returns a list of messages for the `HARDWARE` fields of `env` that
+    differ from `baseline_env`.
+    '''
+    return [f"{field} {env.get(field)}, baseline {baseline_env.get(field)}"
+            for field in HARDWARE if env.get(field) != baseline_env.get(field)]
+
+
+def format_result(result):
+    rss = result['peak_rss_mb']
+    return (f"{result['case']:<26} {result['trials']:>9} {result['wall_s_min']:>9.3f}s"
+            f" {result['peak_mb']:>9.1f}MB" + (f" {rss:>9.1f}MB" if rss is not None else ''))
+
+
+def scaling(results):
+    '''
+    {(case, backend, trials): slope of log(time) over log(trials) from the
+    next smaller number of trials}.
+    '''
+    by_case = {}
+    for r in results:
+        by_case.setdefault((r['case'], r['backend']), []).append(r)
+    slopes = {}
+    for (case, backend), rs in by_case.items():
+        rs = sorted(rs, key=lambda r: r['trials'])
+        for a, b in zip(rs, rs[1:]):
+            slopes[case, backend, b['trials']] = (
+                math.log(b['wall_s_min'] / a['wall_s_min']) / math.log(b['trials'] / a['trials']))
+    return slopes
+
+
+def _key(result):
+    return result['case'], result['backend'], result['trials']
+
+
+def compare(results, baseline, tolerance=.5, memory_tolerance=.25):
+    '''
+    Returns a list of messages for the results that regressed from `baseline`.
+    '''
+    base = {_key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        b = base.get(_key(r))
+        if b is None:
+            continue
+        label = f"{r['case']} ({r['backend']}, {r['trials']} trials)"
+        # Ignore differences of a few ms or MB, which are noise for small inputs
+        if r['wall_s_min'] > b['wall_s_min'] * (1 + tolerance) + .01:
+            regressions.append(f"{label}: {r['wall_s_min']:.3f}s, baseline {b['wall_s_min']:.3f}s")
+        for field in ('peak_mb', 'peak_rss_mb'):
+            if r[field] is None or b.get(field) is None:
+                continue
+            if r[field] > b[field] * (1 + memory_tolerance) + 16:
+                regressions.append(f"{label}: {field} {r[field]:.1f}, baseline {b[field]:.1f}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the analysis functions on synthetic bricks')
+    parser.add_argument('--trials', type=lambda s: [int(x) for x in s.split(',')],
+                        default=DEFAULT_TRIALS, help='comma-separated numbers of trials')
+    parser.add_argument('--cases', type=lambda s: s.split(','), default=list(CASES),
+                        help=f"comma-separated cases (default: all of {','.join(CASES)})")
+    parser.add_argument('--backend', choices=['pandas', 'duckdb'], default='pandas',
+                        help='engine for loading and aggregating the bricks')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each case')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic bricks')
+    parser.add_argument('--data-dir', default='.cache/benchmark',
+                        help='directory for the synthetic bricks')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', nargs='?', const=str(BASELINE),
+                        help=f'compare with the results in this JSON file (default: {BASELINE})')
+    parser.add_argument('--save-baseline', nargs='?', const=str(BASELINE),
+                        help='save the results as the baseline (updating the entries run)')
+    parser.add_argument('--tolerance', type=float, default=.5,
+                        help='allowed relative slowdown from the baseline')
+    parser.add_argument('--memory-tolerance', type=float, default=.25,
+                        help='allowed relative growth of peak memory from the baseline')
+    args = parser.parse_args(argv)
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(f"{'case':<26} {'trials':>9} {'time':>10} {'traced':>11} {'rss':>11}", file=sys.stderr)
+    results = run(args.cases, args.trials, args.data_dir, backend=args.backend,
+                  repeat=args.repeat, seed=args.seed)
+
+    slopes = scaling(results)
+    if slopes:
+        print('\nscaling (1 = linear in the number of trials):')
+        for (case, backend, n), slope in slopes.items():
+            print(f'  {case:<26} {n:>9} {slope:>6.2f}')
+
+    report = {'environment': environment(), 'repeat': args.repeat, 'seed': args.seed,
+              'results': results}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=1) + '\n')
+
+    if args.save_baseline:
+        path = Path(args.save_baseline)
+        saved = json.loads(path.read_text()) if path.exists() else {'results': []}
+        differences = hardware_differences(report['environment'], saved.get('environment', {}))
+        if saved['results'] and differences:
+            print(f"benchmark: replacing the baseline of other hardware ({'; '.join(differences)})")
+            saved['results'] = []
+        ran = {_key(r) for r in results}
+        report['results'] = [r for r in saved['results'] if _key(r) not in ran] + results
+        report['results'].sort(key=lambda r: (r['backend'], r['case'], r['trials']))
+        path.write_text(json.dumps(report, indent=1) + '\n')
+        print(f'benchmark: saved baseline {path}')
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        differences = hardware_differences(report['environment'], baseline.get('environment', {}))
+        if differences:
+            print(f"benchmark: {args.baseline} was recorded on other hardware"
+                  f" ({'; '.join(differences)}); save a baseline of this machine"
+                  f" with --save-baseline first", file=sys.stderr)
+            sys.exit(2)
+        regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+        for message in regressions:
+            print(f'benchmark: regression: {message}')
+        if regressions:
+            sys.exit(1)
+        print(f'benchmark: no regressions from {args.baseline}')
@@ -0,0 +1,159 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+'''
+On-disk memoization for the results of `plotter.py`.
+
+A result is stored under a key made from
+  - the function name,
+  - the arguments: files (e.g. the Parquet bricks) by their content hash,
+    DataFrames by their values, Generators by their state, everything else
+    by value,
+  - the code version: a hash of the analysis/*.py sources,
+so any change in inputs, parameters (N_reps, percentiles, seed) or code
+gives a new key. The cache is kept under `max_bytes` by evicting the least
+recently used results.
+'''
+
+
+def _code_version(dirpath=os.path.dirname(os.path.abspath(__file__))):
+    h = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(dirpath, '*.py'))):
+        with open(path, 'rb') as f:
+            h.update(os.path.basename(path).encode() + b'\0' + f.read())
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir='.cache/plotter_py', max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.code_version = _code_version()
+        os.makedirs(cache_dir, exist_ok=True)
+        # Content hashes of input files, reused while (size, mtime) is unchanged
+        self._file_hashes_path = os.path.join(cache_dir, 'file-hashes.json')
+        try:
+            with open(self._file_hashes_path) as f:
+                self._file_hashes = json.load(f)
+        except (OSError, ValueError):
+            self._file_hashes = {}
+
+    def _file_hash(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        cached = self._file_hashes.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        self._file_hashes[path] = [stamp, h.hexdigest()]
+        _atomic_write(self._file_hashes_path, json.dumps(self._file_hashes).encode())
+        return h.hexdigest()
+
+    def _update(self, h, x):
+        h.update(type(x).__name__.encode() + b'\0')
+        if isinstance(x, (str, os.PathLike)) and os.path.isfile(x):
+            h.update(self._file_hash(x).encode())
+        elif isinstance(x, (pd.DataFrame, pd.Series)):
+            names = list(x.columns) if isinstance(x, pd.DataFrame) else [x.name]
+            h.update(repr((x.shape, names, list(np.atleast_1d(x.dtypes)))).encode())
+            try:
+                h.update(pd.util.hash_pandas_object(x, index=True).to_numpy().tobytes())
+            except TypeError:
+                # e.g. unhashable tuple columns added for plotting
+                h.update(pickle.dumps(x))
+        elif isinstance(x, np.ndarray):
+            h.update(repr((x.shape, x.dtype)).encode() + x.tobytes())
+        elif isinstance(x, np.random.Generator):
+            h.update(repr(x.bit_generator.state).encode())
+        elif isinstance(x, np.random.SeedSequence):
+            h.update(repr((x.entropy, x.spawn_key, x.pool_size)).encode())
+        elif isinstance(x, (list, tuple)):
+            for item in x:
+                self._update(h, item)
+            h.update(b'\1')
+        elif isinstance(x, dict):
+            for k in sorted(x, key=repr):
+                self._update(h, k)
+                self._update(h, x[k])
+            h.update(b'\1')
+        elif callable(x):
+            h.update(f'{x.__module__}.{x.__qualname__}'.encode())
+        else:
+            h.update(repr(x).encode())
+
+    def key(self, func, args=(), kwargs={}):
+        h = hashlib.sha256(self.code_version.encode())
+        self._update(h, func)
+        self._update(h, list(args))
+        self._update(h, dict(kwargs))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def get(self, key):
+        '''
+        Returns (True, value) on a hit, (False, None) otherwise.
+        '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False, None
+        os.utime(path)  # mark as recently used
+        return True, value
+
+    def put(self, key, value):
+        _atomic_write(self._path(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        self.evict()
+
+    def call(self, func, *args, **kwargs):
+        key = self.key(func, args, kwargs)
+        hit, value = self.get(key)
+        if not hit:
+            value = func(*args, **kwargs)
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        # Least recently used results go first
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,181 @@
+import os
+
+import pandas as pd
+
+import utils
+
+'''
+DuckDB versions of the pandas aggregations in `utils`.
+
+The queries run directly over the processed Parquet bricks, so only the
+aggregated results (and, for `get_dataframes`, the few columns the plotter
+needs) are materialized in pandas. DuckDB is an optional dependency; it is
+only imported when one of these functions is called.
+'''
+
+
+def connect(memory_limit=None, temp_directory=None):
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError("The 'duckdb' backend requires the duckdb package: pip install duckdb") from e
+
+    con = duckdb.connect()
+    # Timestamps are compared as UTC, as `utils.process_months_to_report` does
+    con.execute("SET TimeZone = 'UTC'")
+    # Same environment variables as the DuckDB stages in `dvc.yaml`
+    memory_limit = memory_limit or os.environ.get('MY_DUCKDB_MEMORY_LIMIT')
+    temp_directory = temp_directory or os.environ.get('MY_DUCKDB_TEMP_DIR')
+    if memory_limit:
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+    if temp_directory:
+        con.execute(f"SET temp_directory = '{temp_directory}'")
+    return con
+
+
+def _quote(col):
+    return '"' + col.replace('"', '""') + '"'
+
+
+def _parquet_list(paths):
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    return '[' + ', '.join("'" + str(p).replace("'", "''") + "'" for p in paths) + ']'
+
+
+def months_to_report_sql(thresholds=(12, 36)):
+    '''
+    SELECT list computing the columns added by `utils.process_months_to_report`.
+
+    Whole days between the two dates are floored like pandas `.dt.days`.
+    '''
+    pcd, rrd = (_quote(c) for c in utils.date_cols)
+    days = (f"floor((epoch_us(TRY_CAST({rrd} AS TIMESTAMP))"
+            f" - epoch_us(TRY_CAST({pcd} AS TIMESTAMP))) / 86400e6)")
+    cols = [f"{days} / 30.44 AS rf_months_to_report"]
+    cols.append("greatest(coalesce(rf_months_to_report, 65), 0) AS rf_months_to_report_plot")
+    for within in thresholds:
+        cols.append(f"coalesce(rf_months_to_report <= {within} + 1/30.5, false) AS report_within_{within}")
+    return ',\n    '.join(cols)
+
+
+def processed_sql(paths, thresholds=(12, 36), dedup=False):
+    '''
+    Query over processed bricks with the months-to-report columns added.
+
+    dedup: keep only the rows `utils.get_dataframes` keeps for the overall
+        frame, i.e. where the version number has rank 1 (method='max')
+        within its NCT ID.
+    '''
+    cols = ', '.join(_quote(c) for c in utils.processed_columns)
+    sql = f"""
+    SELECT {cols},
+        {months_to_report_sql(thresholds)}
+    FROM read_parquet({_parquet_list(paths)}, union_by_name = true)
+    """
+    if dedup:
+        nct_id, version = (_quote(c) for c in utils.dedup_cols)
+        sql += f"""
+    WHERE {nct_id} IS NOT NULL AND {version} IS NOT NULL
+    QUALIFY count(*) OVER (
+        PARTITION BY {nct_id} ORDER BY {version}
+        RANGE BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+    ) = 1
+    """
+    return sql
+
+
+def get_rates_long(con, sql, thresholds=(12, 36)):
+    '''
+    DuckDB version of `utils.get_rates_long` over the rows of query `sql`.
+
+    Subgroups are ordered by name within each group.
+    '''
+    d_col_group = dict(zip(utils.groups_col, utils.groups))
+    unpivot_cols = ', '.join(f'{_quote(c)}::VARCHAR AS {_quote(c)}' for c in utils.groups_col)
+    counts = ', '.join(f'count_if(report_within_{within}) AS "n_{within}"' for within in thresholds)
+    df = con.execute(f"""
+    WITH src AS (
+        SELECT {', '.join(f'report_within_{within}' for within in thresholds)}, {unpivot_cols}
+        FROM ({sql})
+    )
+    SELECT col_group, subgroup, count(*) AS "N", {counts}
+    FROM (
+        UNPIVOT src ON {', '.join(_quote(c) for c in utils.groups_col)}
+        INTO NAME col_group VALUE subgroup
+    )
+    GROUP BY ALL
+    """).df()
+
+    df['group'] = pd.Categorical(df['col_group'].map(d_col_group), categories=utils.groups)
+    df = df.sort_values(['group', 'subgroup'], ignore_index=True)
+    df['group'] = df['group'].astype(str)
+    df_long = pd.concat([
+        pd.DataFrame({'group': df['group'], 'subgroup': df['subgroup'], 'within': within,
+                      'n': df[f'n_{within}'], 'N': df['N']})
+        for within in thresholds
+    ], ignore_index=True)
+    df_long['rate'] = df_long['n'] / df_long['N']
+    df_long['prop'] = df_long['N'] / df_long.groupby(['group', 'within'])['N'].transform('sum')
+    return df_long
+
+
+def get_dataframes(path_pre_processed, path_post_processed, con=None):
+    '''
+    DuckDB version of `utils.get_dataframes`.
+
+    The pre/post/overall frames only hold the columns the plotter uses
+    (rf_months_to_report, rf_months_to_report_plot, report_within_12/36).
+    '''
+    con = con or connect()
+    thresholds = (12, 36)
+    cols = 'rf_months_to_report, rf_months_to_report_plot, ' + \
+        ', '.join(f'report_within_{within}' for within in thresholds)
+    d_sql = {
+        'pre': processed_sql(path_pre_processed, thresholds),
+        'post': processed_sql(path_post_processed, thresholds),
+        'overall': processed_sql([path_pre_processed, path_post_processed], thresholds, dedup=True),
+    }
+    d_dfs = {window: con.execute(f'SELECT {cols} FROM ({sql})').df() for window, sql in d_sql.items()}
+
+    rates_long = pd.concat(
+        [get_rates_long(con, sql, thresholds).assign(window=window) for window, sql in d_sql.items()],
+        ignore_index=True).melt(
+            id_vars=['group', 'subgroup', 'window', 'within'],
+            value_vars=utils.metrics, var_name='metric', value_name='value')
+    df_prepost_12 = utils.pivot_prepost(rates_long, within=12)
+    df_prepost_36 = utils.pivot_prepost(rates_long, within=36)
+
+    return d_dfs['pre'], d_dfs['post'], d_dfs['overall'], df_prepost_12, df_prepost_36
+
+
+def get_yearly_stats(dirpath, pattern='*_hlact_studies.parquet', con=None):
+    '''
+    DuckDB version of `utils.get_yearly_stats`, as one query over all bricks.
+    '''
+    con = con or connect()
+    files = utils.find_yearly_files(dirpath, pattern=pattern)
+    if not files:
+        raise FileNotFoundError(f'No yearly bricks matching {pattern} in {dirpath}')
+    years = ', '.join(f"({year}, {_parquet_list(path)[1:-1]})" for year, path in files)
+    df = con.execute(f"""
+    WITH files(year, filename) AS (VALUES {years}),
+    src AS (
+        SELECT filename, {months_to_report_sql(())}
+        FROM read_parquet({_parquet_list(p for _, p in files)}, filename = true, union_by_name = true)
+    )
+    SELECT
+        year,
+        count(*) AS "N",
+        avg(rf_months_to_report) AS mean,
+        quantile_cont(rf_months_to_report, 0.5) AS median,
+        quantile_cont(rf_months_to_report, 0.10) AS q10,
+        quantile_cont(rf_months_to_report, 0.25) AS q25,
+        quantile_cont(rf_months_to_report, 0.75) AS q75,
+        quantile_cont(rf_months_to_report, 0.90) AS q90,
+        count(rf_months_to_report) / count(*) AS p_report
+    FROM src JOIN files USING (filename)
+    GROUP BY year
+    ORDER BY year
+    """).df()
+    return df.set_index('year')
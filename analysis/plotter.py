@@ -2,16 +2,27 @@ import numpy as np
 import pandas as pd
 import bokeh.plotting
 from bokeh.models import NumeralTickFormatter
-bokeh.io.output_notebook()
+# Only for notebooks: it replaces `sys.modules['__main__']`, which breaks
+# pickling the functions of the script for the process pool
+if __name__ != '__main__':
+    bokeh.io.output_notebook()
 import iqplot
 import warnings
 warnings.filterwarnings('ignore')
 import utils
+from cache import ResultCache
 from scipy.stats import permutation_test
 from tqdm import tqdm
 
+import argparse
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'stages'))
+import instrument
+
 # TABLES OF RATES OF REPORTING OVERALL, SUBGROUPS
 # TABLES OF COMPOSITION OF SUBGROUPS
 
@@ -142,52 +153,19 @@ def plot_lollipop(df_prepost_12, df_prepost_36):
 
 
 # BOX PLOTS BY YEAR
-def plot_boxplot_yearly():
-    df_12 = pd.read_parquet("brick/yearly_obs36_processed/1_20120101_hlact_studies.parquet")
-    df_13 = pd.read_parquet("brick/yearly_obs36_processed/2_20130101_hlact_studies.parquet")
-    df_14 = pd.read_parquet("brick/yearly_obs36_processed/3_20140101_hlact_studies.parquet")
-    df_15 = pd.read_parquet("brick/yearly_obs36_processed/4_20150101_hlact_studies.parquet")
-    df_16 = pd.read_parquet("brick/yearly_obs36_processed/5_20160101_hlact_studies.parquet")
-    df_17 = pd.read_parquet("brick/yearly_obs36_processed/6_20170101_hlact_studies.parquet")
-    df_18 = pd.read_parquet("brick/yearly_obs36_processed/7_20180101_hlact_studies.parquet")
-    df_19 = pd.read_parquet("brick/yearly_obs36_processed/8_20190101_hlact_studies.parquet")
-    df_20 = pd.read_parquet("brick/yearly_obs36_processed/9_20200101_hlact_studies.parquet")
-    df_21 = pd.read_parquet("brick/yearly_obs36_processed/10_20210101_hlact_studies.parquet")
-    df_22 = pd.read_parquet("brick/yearly_obs36_processed/11_20220101_hlact_studies.parquet")
-    df_23 = pd.read_parquet("brick/yearly_obs36_processed/12_20230101_hlact_studies.parquet")
-    df_24 = pd.read_parquet("brick/yearly_obs36_processed/13_20240101_hlact_studies.parquet")
-
-    all_dfs = [df_12, df_13, df_14, df_15, df_16, 
-               df_17, df_18, df_19, df_20, df_21, df_22, df_23, df_24]
-    all_years = [ 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019, 2020, 2021, 2022, 2023, 2024]
-    
-    for df, year in zip(all_dfs, all_years):
-        df['year'] = int(year)
-        
-    df = pd.concat(all_dfs)    
-    
-    df = utils.process_months_to_report(df)
-    
+def plot_boxplot_yearly(dirpath='brick/yearly_obs36_processed', max_workers=4, backend='pandas'):
+    # One row of statistics per yearly brick found in `dirpath`
+    df_stats = utils.get_yearly_stats(dirpath, max_workers=max_workers, backend=backend)
     
-    col = 'rf_months_to_report'
-    # col = 'schema1.months_to_report_results'
-    d_means = df.groupby('year')[col].mean().to_dict()
-    d_medians = df.groupby('year')[col].median().to_dict()
-    d_25 = df.groupby('year')[col].quantile(.25).to_dict()
-    d_75 = df.groupby('year')[col].quantile(.75).to_dict()
-    d_10 = df.groupby('year')[col].quantile(.10).to_dict()
-    d_90 = df.groupby('year')[col].quantile(.90).to_dict()
-    
-    years = list(d_means.keys())
-    means = list(d_means.values())
-    medians = list(d_medians.values())
-    q25s = list(d_25.values())
-    q75s = list(d_75.values())
-    q10s = list(d_10.values())
-    q90s = list(d_90.values())
+    years = df_stats.index.tolist()
+    means = df_stats['mean'].tolist()
+    medians = df_stats['median'].tolist()
+    q25s = df_stats['q25'].tolist()
+    q75s = df_stats['q75'].tolist()
+    q10s = df_stats['q10'].tolist()
+    q90s = df_stats['q90'].tolist()
 
     
-    df['start_year'] = df['year'] - 3
     start_years = [year - 3 for year in years]
     
     
@@ -227,8 +205,7 @@ def plot_boxplot_yearly():
            legend_label='median', 
            color=color_medians, line_width=1, line_dash='dotted')
     
-    p.xaxis.ticker = [2008, 2009, 2010, 2011, 2012, 2013, 2014, 2015, 2016, 2017, 
-                      2018, 2019, 2020, 2021, 2022, 2023]
+    p.xaxis.ticker = list(range(min(start_years) - 1, max(start_years) + 3))
     
     p.yaxis.ticker = [0, 12, 24, 36, 48, 60, 72, 84, 96]
     # p.yaxis.ticker = np.arange(0, 100)
@@ -238,10 +215,7 @@ def plot_boxplot_yearly():
 
 
     # Create barchart of volume of those reporting
-    d_p_report = df.groupby('year')['rf_months_to_report'].apply(
-        lambda x: 1- x.isnull().sum()/len(x)).to_dict()
-    years = d_p_report.keys()
-    p_report = d_p_report.values()
+    p_report = df_stats['p_report'].tolist()
     
     p = bokeh.plotting.figure(
         output_backend='svg',
@@ -257,8 +231,7 @@ def plot_boxplot_yearly():
                  legend_label='% reported results within 36 months', 
                  color = color_25, width=15, alpha=0.5)
     
-    p.xaxis.ticker = [2011, 2012, 2013, 2014, 2015, 2016, 2017, 
-                      2018, 2019, 2020, 2021, 2022, 2023, 2024]
+    p.xaxis.ticker = list(range(min(years) - 1, max(years) + 1))
     
     p.yaxis.ticker = [0, 0.2, 0.4, 0.6, 0.8, 1.0]
     
@@ -267,6 +240,26 @@ def plot_boxplot_yearly():
     return p_boxplot, p_barchart
 
 
+def export_svgs(figures, webdriver=None, timeout=30):
+    '''
+    Write the figures of {filename: figure} as SVG files.
+
+    `bokeh.io.export_svg` loads a page with BokehJS in the browser for every
+    figure; here all the figures are laid out on one page, rendered once by
+    one webdriver session (`webdriver`, or the one bokeh reuses) and each
+    figure's SVG is written to its file.
+    '''
+    from bokeh.io.export import get_svgs
+    layout = bokeh.layouts.column(*figures.values())
+    # One SVG per plot, in layout order
+    svgs = get_svgs(layout, driver=webdriver, timeout=timeout)
+    if len(svgs) != len(figures):
+        raise RuntimeError(f'Exported {len(svgs)} SVGs for {len(figures)} figures')
+    for filename, svg in zip(figures, svgs):
+        Path(filename).write_text(svg, encoding='utf-8')
+    return list(figures)
+
+
 
 # GET N's FOR CONFINTS + PERMUTATION TEST
 def get_Ns(df_pre, df_post):
@@ -308,9 +301,51 @@ def draw_conf_ints(arr_pre, arr_post, N_reps=10_000, percentiles=[2.5,97.5]):
     return q_min, q_max
 
 
-def get_confints(df_pre, df_post, N_reps, percentiles_confints):
+def draw_conf_ints_counts(n_pre, N_pre, n_post, N_post, N_reps=10_000, percentiles=[2.5,97.5],
+                          rng=None, block_size=10_000_000):
+    '''
+    Bootstrap percentile intervals of (n_post/N_post - n_pre/N_pre) from counts.
+
+    Resampling N 0/1 values with n ones gives Binomial(N, n/N) ones, so each
+    replicate is a pair of binomial draws. Arguments may be scalars or
+    equal-length arrays (one entry per subgroup); rows are processed in chunks
+    of at most `block_size` replicates so memory does not depend on the number
+    of trials.
+
+    Returns arrays (q_min, q_max); rows with missing counts give NaN.
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+
+    valid, (n_pre, N_pre, n_post, N_post) = _as_counts(n_pre, N_pre, n_post, N_post)
+
+    q = np.full((len(valid), 2), np.nan)
+    rows = np.flatnonzero(valid)
+    chunk = max(1, block_size // N_reps)
+    for start in range(0, len(rows), chunk):
+        r = rows[start:start + chunk]
+        rep_pre = rng.binomial(N_pre[r, None], n_pre[r, None]/N_pre[r, None], size=(len(r), N_reps))
+        rep_post = rng.binomial(N_post[r, None], n_post[r, None]/N_post[r, None], size=(len(r), N_reps))
+        rep_diff = rep_post/N_post[r, None] - rep_pre/N_pre[r, None]
+        q[r] = np.percentile(rep_diff, percentiles, axis=1).T
+    return q[:, 0], q[:, 1]
+
+
+def get_confints(df_pre, df_post, N_reps, percentiles_confints, method='counts', rng=None):
     n_pre_12, n_pre_36, N_pre, p_pre_12, p_pre_36, \
             n_post_12, n_post_36, N_post, p_post_12, p_post_36 = get_Ns(df_pre, df_post)
+
+    if method == 'counts':
+        q_min, q_max = draw_conf_ints_counts(
+            [n_pre_12, n_pre_36], N_pre, [n_post_12, n_post_36], N_post,
+            N_reps=N_reps, percentiles=percentiles_confints, rng=rng)
+        confints_12 = q_min[0], q_max[0]
+        confints_36 = q_min[1], q_max[1]
+
+        point_estimate_12 = n_post_12/N_post - n_pre_12/N_pre
+        point_estimate_36 = n_post_36/N_post - n_pre_36/N_pre
+
+        return point_estimate_12, confints_12, point_estimate_36, confints_36
     
     arr_pre_12 = create_array(n_pre_12, N_pre) # pre
     arr_post_12  = create_array(n_post_12, N_post) # post
@@ -337,11 +372,18 @@ def table_confints_save(point_estimate_12, confints_12, point_estimate_36, confi
     return df_confints
 
 
-def get_confints_subcat(r, N_reps=10_000, percentiles_confints=[2.5,97.5]):
+def get_confints_subcat(r, N_reps=10_000, percentiles_confints=[2.5,97.5], method='counts', rng=None):
     n_pre = r.n_pre
     n_post = r.n_post
     N_pre = r.N_pre
     N_post = r.N_post
+
+    if method == 'counts':
+        q_min, q_max = draw_conf_ints_counts(
+            n_pre, N_pre, n_post, N_post,
+            N_reps=N_reps, percentiles=percentiles_confints, rng=rng)
+        point_estimate = n_post/N_post - n_pre/N_pre
+        return (point_estimate, q_min[0], q_max[0])
     
     arr_pre = create_array(n_pre, N_pre) # pre
     arr_post  = create_array(n_post, N_post) # post
@@ -352,19 +394,42 @@ def get_confints_subcat(r, N_reps=10_000, percentiles_confints=[2.5,97.5]):
     return (point_estimate, *confints)
 
 
-def table_confints_subcat_save(df_prepost_12, df_prepost_36, N_reps=10_000, percentiles_confints=[2.5,97.5]):
+def get_confints_subcats(df_prepost, N_reps=10_000, percentiles_confints=[2.5,97.5], rng=None):
+    # Same as df_prepost.apply(get_confints_subcat, axis=1), but all subgroup
+    # rows are drawn together.
+    q_min, q_max = draw_conf_ints_counts(
+        df_prepost['n_pre'], df_prepost['N_pre'],
+        df_prepost['n_post'], df_prepost['N_post'],
+        N_reps=N_reps, percentiles=percentiles_confints, rng=rng)
+    point_estimate = df_prepost['n_post']/df_prepost['N_post'] - df_prepost['n_pre']/df_prepost['N_pre']
+    return pd.DataFrame({'point_estimate': point_estimate.astype(float),
+                         'conf_int_min': q_min, 'conf_int_max': q_max},
+                        index=df_prepost.index)
+
+
+def table_confints_subcat_save(df_prepost_12, df_prepost_36, N_reps=10_000, percentiles_confints=[2.5,97.5],
+                               method='counts', rng=None):
     
     df_confints_subcat = df_prepost_36[['group','subgroup']].copy()
+
+    if method == 'counts':
+        for df_prepost, i in zip([df_prepost_12, df_prepost_36], ['12', '36']):
+            confints = get_confints_subcats(
+                df_prepost, N_reps=N_reps, percentiles_confints=percentiles_confints, rng=rng)
+            df_confints_subcat[f'diff_rate_{i}'] = confints['point_estimate']
+            df_confints_subcat[f'confints_{i}_min'] = confints['conf_int_min']
+            df_confints_subcat[f'confints_{i}_max'] = confints['conf_int_max']
+        return df_confints_subcat
     
     df_confints_subcat['confints_12'] = df_prepost_12.apply(
         get_confints_subcat, 
-        N_reps=N_reps_confints, percentiles_confints=percentiles_confints,
+        N_reps=N_reps, percentiles_confints=percentiles_confints, method=method,
         axis=1
     )
     
     df_confints_subcat['confints_36'] = df_prepost_36.apply(
         get_confints_subcat, 
-        N_reps=N_reps, percentiles_confints=percentiles_confints,
+        N_reps=N_reps, percentiles_confints=percentiles_confints, method=method,
         axis=1
     )
     
@@ -380,39 +445,57 @@ def table_confints_subcat_save(df_prepost_12, df_prepost_36, N_reps=10_000, perc
 def create_array(n, N):
     return np.hstack([np.ones(n), np.zeros(N-n)])
 
-def permutation_test(n_pre, N_pre, n_post, N_post, N_reps=50_000):
+def _as_counts(*counts):
+    # Broadcast scalar or per-subgroup counts into int64 columns, flagging
+    # rows with any missing count (e.g. subgroups absent from one window).
+    counts = np.broadcast_arrays(*[np.atleast_1d(np.asarray(x, dtype=float)) for x in counts])
+    counts = np.column_stack(counts)
+    valid = ~np.isnan(counts).any(axis=1)
+    return valid, np.where(valid[:, None], counts, 0).astype(np.int64).T
 
-    def test_statistic(a, b):
-        return np.mean(b) - np.mean(a)
-    
-    # Permutation Replicate
-    # This assumes two samples are identically distributed
-    def draw_perm_sample(arr_pre, arr_post):
-        concat_data = np.concatenate((arr_pre, arr_post))
-        np.random.shuffle(concat_data)
-        return concat_data[:len(arr_pre)], concat_data[len(arr_pre):]
-    
-    def get_p_value(n_pre, N_pre, n_post, N_post, N_reps = 10_000):
-        arr_pre  = create_array(n_pre, N_pre) # pre
-        arr_post = create_array(n_post, N_post) # post
-        
-        out = np.empty(N_reps)
-        for i in tqdm(range(N_reps)):
-            sim_pre, sim_post = draw_perm_sample(arr_pre, arr_post)
-            p_pre, p_post = sum(sim_pre)/len(sim_pre), sum(sim_post)/len(sim_post)
-            sim_diff = p_post - p_pre
-            out[i] = sim_diff
-    
-        diff_orig = (n_post/N_post) - (n_pre/N_pre)
-        p_value = np.sum(out >= diff_orig) / len(out)
-        print('p-value: ', p_value)
-        return diff_orig, p_value
-        
-    diff_orig, p_value = get_p_value(n_pre, N_pre, n_post, N_post, N_reps=N_reps)
+def permutation_test(n_pre, N_pre, n_post, N_post, N_reps=50_000, rng=None, block_size=1_000_000):
+    # Shuffling the pooled 0/1 arrays and splitting them at N_pre means the
+    # number of ones landing in the pre group is hypergeometric, so the
+    # replicates are drawn directly from the counts instead of from arrays.
+    diff_orig, p_value = permutation_test_counts(
+        n_pre, N_pre, n_post, N_post, N_reps=N_reps, rng=rng, block_size=block_size)
+    return diff_orig[0], p_value[0]
+
+
+def permutation_test_counts(n_pre, N_pre, n_post, N_post, N_reps=50_000, rng=None, block_size=1_000_000):
+    '''
+    Vectorized one-sided permutation test of (n_post/N_post - n_pre/N_pre).
+
+    All arguments may be scalars or equal-length arrays (one entry per
+    subgroup). Replicates are drawn in blocks of at most `block_size` values
+    so memory does not depend on the number of trials.
+
+    Returns arrays (diff_orig, p_value); rows with missing counts give NaN.
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+
+    valid, (n_pre, N_pre, n_post, N_post) = _as_counts(n_pre, N_pre, n_post, N_post)
+
+    diff_orig = np.full(len(valid), np.nan)
+    n_extreme = np.zeros(len(valid), dtype=np.int64)
+    diff_orig[valid] = n_post[valid]/N_post[valid] - n_pre[valid]/N_pre[valid]
+
+    rows = np.flatnonzero(valid)
+    n_ones = (n_pre + n_post)[rows, None]
+    n_zeros = (N_pre + N_post)[rows, None] - n_ones
+    block = max(1, block_size // max(len(rows), 1))
+    for start in range(0, N_reps, block):
+        size = min(block, N_reps - start)
+        sim_n_pre = rng.hypergeometric(n_ones, n_zeros, N_pre[rows, None], size=(len(rows), size))
+        sim_diff = (n_ones - sim_n_pre)/N_post[rows, None] - sim_n_pre/N_pre[rows, None]
+        n_extreme[rows] += np.sum(sim_diff >= diff_orig[rows, None], axis=1)
+
+    p_value = np.where(valid, n_extreme / N_reps, np.nan)
     return diff_orig, p_value
 
 
-def permutation_test_overall(df_pre, df_post, N_reps=50_000):
+def permutation_test_overall(df_pre, df_post, N_reps=50_000, rng=None):
     q_pre = df_pre['rf_months_to_report'].values
     q_post = df_post['rf_months_to_report'].values
     
@@ -426,8 +509,8 @@ def permutation_test_overall(df_pre, df_post, N_reps=50_000):
     #       p_pre_36, p_post_36)
     
 
-    d12, p12 = permutation_test(n_pre_12, N_pre, n_post_12, N_post, N_reps=N_reps)
-    d36, p36 = permutation_test(n_pre_36, N_pre, n_post_36, N_post, N_reps=N_reps)
+    d12, p12 = permutation_test(n_pre_12, N_pre, n_post_12, N_post, N_reps=N_reps, rng=rng)
+    d36, p36 = permutation_test(n_pre_36, N_pre, n_post_36, N_post, N_reps=N_reps, rng=rng)
     results = pd.DataFrame({
         'name':['diff_orig_12mo', 'pvalue_12mo', 'diff_orig_36mo', 'pvalue_36mo'],
         'value':[d12, p12, d36, p36]
@@ -436,12 +519,22 @@ def permutation_test_overall(df_pre, df_post, N_reps=50_000):
     
 
 
-def permutation_test_subgroup(row, N_reps=50_000):
+def permutation_test_subgroup(row, N_reps=50_000, rng=None):
     n_pre, N_pre, n_post, N_post = row.n_pre, row.N_pre, row.n_post, row.N_post
-    diff_orig, p_value = permutation_test(n_pre, N_pre, n_post, N_post, N_reps=N_reps)
+    diff_orig, p_value = permutation_test(n_pre, N_pre, n_post, N_post, N_reps=N_reps, rng=rng)
     return p_value
 
 
+def permutation_test_subgroups(df_prepost, N_reps=50_000, rng=None):
+    # Same as df_prepost.apply(permutation_test_subgroup, axis=1), but all
+    # subgroup rows are drawn together.
+    diff_orig, p_value = permutation_test_counts(
+        df_prepost['n_pre'], df_prepost['N_pre'],
+        df_prepost['n_post'], df_prepost['N_post'],
+        N_reps=N_reps, rng=rng)
+    return pd.Series(p_value, index=df_prepost.index)
+
+
 def table_pvalues_subgroup_save(df_prepost_12, df_prepost_36):
     table = df_prepost_12[['group', 'subgroup', 'rate_pre', 'rate_post', 'p_value']].rename(
         columns={'rate_pre':'rate_pre_12mo',
@@ -487,111 +580,216 @@ def IQR_12mo_primary_cats(table_rates_subgroup_save):
     return df_final
     
 
-# RUN MAIN
-if __name__ == '__main__':
-    np.random.seed(10) # set seed
-    output_dir = Path('figtab/plotter_py')
-    output_dir.mkdir(parents=True, exist_ok=True)
-    # Get dataframes
-    path_pre_processed = "brick/rule-effective-date_processed/datebefore_hlact_studies.parquet"
-    path_post_processed = "brick/rule-effective-date_processed/dateafter_hlact_studies.parquet"
-    df_pre, df_post, df_overall, df_prepost_12, df_prepost_36 = utils.get_dataframes(
-        path_pre_processed, 
-        path_post_processed
-    )
-
-    
-    # Create and save 
-    # - table_rates_overall.csv,
-    # - table_rates_subgroup.csv, 
-    # - table_composition_subgroup.csv
-
-    print(f"\n Creating and saving in {output_dir}")
-    print("- table_rates_overall.csv")
-    print("- table_rates_subgroup.csv")
-    print("- table_composition_subgroup.csv \n")
-    
-    table_rates_overall_save = table_rates_overall(df_overall, df_pre, df_post)
-    table_rates_overall_save.to_csv(output_dir / "table_rates_overall.csv", index=False)
-
-    table_rates_subgroup_save = table_rates_subgroup(df_prepost_12, df_prepost_36)
-    table_rates_subgroup_save.to_csv(output_dir / "table_rates_subgroup.csv", index=False) 
+# PARALLEL SCHEDULER FOR BOOTSTRAPS + PERMUTATION TESTS
+def _run_stat_job(func, args, kwargs, seed_seq):
+    return func(*args, rng=np.random.default_rng(seed_seq), **kwargs)
 
-    # only needs one of them df_prepost_12, redundant columns in both 12 and 36
-    table_composition_subgroup_save = table_composition_subgroup(df_prepost_12) 
-    table_composition_subgroup_save.to_csv(output_dir / "table_composition_subgroup.csv", index=False) 
-
-    # Create and save
-    # - table_IQR_12mo_primary_cats : 25th, 50th, 75th percentile in 12 & 36 mo. improvement for primary categories
-    print(f"\n Creating and saving in {output_dir}")
-    print(f"- table_IQR_12mo_primary_cats")
-    df_IQR = IQR_12mo_primary_cats(table_rates_subgroup_save)
-    df_IQR.to_csv(output_dir / "table_IQR_12mo_primary_cats.csv", index=False)
-    print(df_IQR)
-    
-    # Create and save 
-    # - p_lollipop_12.svg : shows subgroups pre/post rr12mo on lollipop chart
-    # - p_lollipop_36.svg : shows subgroups pre/post rr36mo on lollipop chart
-    # - p_boxplot_yearly.svg  : shows boxplots of time to report of those who report within 36mo
-    # - p_barchart_yearly.svg : shows proportion of those who report within 36mo
 
-    print(f"\n Creating and saving in {output_dir}")
-    print("- p_lollipop_12.svg and _36.svg")
-    print("- p_boxplot_yearly.svg and p_barchart_yearly.svg \n")
-    
-    p_lollipop_12, p_lollipop_36 = plot_lollipop(df_prepost_12, df_prepost_36)
+def run_stat_jobs(jobs, seed=10, n_jobs=1, cache=None):
+    '''
+    Run independent statistics jobs, optionally across a process pool.
 
-    bokeh.io.show(bokeh.layouts.row(p_lollipop_12, p_lollipop_36))
-    bokeh.io.export_svg(p_lollipop_12, filename=output_dir / 'p_lollipop_12.svg')
-    bokeh.io.export_svg(p_lollipop_36, filename=output_dir / 'p_lollipop_36.svg')
+    `jobs` maps a name to (func, args, kwargs); each func must accept an `rng`
+    keyword. Job i gets its own Generator from the i-th child of
+    np.random.SeedSequence(seed), so results only depend on `seed` and the
+    order of `jobs`, never on `n_jobs`.
 
-    p_boxplot_yearly, p_barchart_yearly = plot_boxplot_yearly()
-    bokeh.io.show(bokeh.layouts.column(p_boxplot_yearly, p_barchart_yearly))
-    bokeh.io.export_svg(p_boxplot_yearly, filename=output_dir / 'p_boxplot_yearly.svg')
-    bokeh.io.export_svg(p_barchart_yearly, filename=output_dir / 'p_barchart_yearly.svg')
+    With a `cache.ResultCache`, jobs whose result is already stored (same
+    function, arguments, seed stream and code) are not run again.
 
+    Returns a dict of results keyed by job name.
+    '''
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(jobs))
+    results, keys, todo = {}, {}, {}
+    for (name, (func, args, kwargs)), seed_seq in zip(jobs.items(), seed_seqs):
+        if cache is not None:
+            keys[name] = cache.key(func, args, {**kwargs, 'rng': seed_seq})
+            hit, results[name] = cache.get(keys[name])
+            if hit:
+                continue
+        todo[name] = (func, args, kwargs, seed_seq)
+
+    if n_jobs == 1:
+        results.update({name: _run_stat_job(*job) for name, job in todo.items()})
+    elif todo:
+        # Not forked: the SVG export thread of `__main__` may hold locks
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 mp_context=multiprocessing.get_context('forkserver')) as executor:
+            futures = {name: executor.submit(_run_stat_job, *job) for name, job in todo.items()}
+            results.update({name: future.result() for name, future in futures.items()})
+
+    if cache is not None:
+        for name in todo:
+            cache.put(keys[name], results[name])
+    return {name: results[name] for name in jobs}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Tables and figures for the rule effective date analysis')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes for bootstraps and permutation tests '
+                             '(0 = one per CPU); results do not depend on this')
+    parser.add_argument('--backend', choices=['pandas', 'duckdb'], default='pandas',
+                        help='engine for loading and aggregating the processed bricks')
+    parser.add_argument('--cache-dir', default='.cache/plotter_py',
+                        help='directory for cached dataframes, bootstraps and permutation tests')
+    parser.add_argument('--cache-size-mb', type=int, default=2048,
+                        help='least recently used cache entries are removed above this size')
+    parser.add_argument('--no-cache', action='store_true', help='recompute everything')
+    parser.add_argument('--show', action='store_true', help='also open the figures in the browser')
+    parser.add_argument('--no-svg', action='store_true', help='do not export the figures as SVG')
+    return parser.parse_args(argv)
 
-    # Create and save 
-    # - confidence_intervals.csv
-    output_confidence_path = output_dir / "confidence_intervals.csv"
-    print(f"\n Creating and saving {output_confidence_path}...")
-    
-    N_reps_confints = 10_000
-    percentiles_confints=[2.5,97.5]
-    point_estimate_12, confints_12, point_estimate_36, confints_36 = \
-        get_confints(df_pre, df_post, N_reps_confints, percentiles_confints)
-    
-    print('confidence interval percentiles', percentiles_confints)
-    print('point estimate & confint 12 mo.', point_estimate_12, confints_12)
-    print('point estimate & confint 36 mo.', point_estimate_36, confints_36)
-    
-    confints_table = table_confints_save(
-        point_estimate_12, confints_12, point_estimate_36, confints_36, percentiles_confints)
-    confints_table.to_csv( output_dir / "confidence_intervals.csv", index=False)
 
-    df_confints_subcat = table_confints_subcat_save(
-        df_prepost_12, df_prepost_36, N_reps = N_reps_confints, percentiles_confints=percentiles_confints)
-    df_confints_subcat.to_csv( output_dir / "confidence_intervals_subcat.csv", index=False)
-    
-    
-    # Create and save 
-    # - permutation_results.csv
-    output_permutation_path = output_dir / "permutation_results.csv"
-    print(f"\n Creating and saving {output_permutation_path}...")
-    
-    N_reps = 50_000
-    permutation_results = permutation_test_overall(df_pre, df_post, N_reps=N_reps)
-    permutation_results.to_csv(output_permutation_path, index=False) 
-    
-    df_prepost_12['p_value'] = df_prepost_12.apply(permutation_test_subgroup, axis=1, args=(N_reps,))
-    df_prepost_36['p_value'] = df_prepost_36.apply(permutation_test_subgroup, axis=1, args=(N_reps,))
-    
-    permutation_results_subgroup = table_pvalues_subgroup_save(df_prepost_12, df_prepost_36)
-    permutation_results_subgroup.to_csv( output_dir / "permutation_results_subgroup.csv", index=False)
-    
 
-    
-    pass
+# RUN MAIN
+if __name__ == '__main__':
+    args = parse_args()
+    with instrument.span('main', backend=args.backend) as stage:
+        seed = 10
+        np.random.seed(seed) # set seed
+        cache = None if args.no_cache else ResultCache(args.cache_dir, max_bytes=args.cache_size_mb * 1024**2)
+        output_dir = Path('figtab/plotter_py')
+        output_dir.mkdir(parents=True, exist_ok=True)
+        # Get dataframes
+        path_pre_processed = "brick/rule-effective-date_processed/datebefore_hlact_studies.parquet"
+        path_post_processed = "brick/rule-effective-date_processed/dateafter_hlact_studies.parquet"
+        with instrument.span('get_dataframes', backend=args.backend, cached=cache is not None) as s:
+            if cache is not None:
+                dataframes = cache.call(utils.get_dataframes, path_pre_processed, path_post_processed,
+                                        backend=args.backend)
+            else:
+                dataframes = utils.get_dataframes(path_pre_processed, path_post_processed,
+                                                  backend=args.backend)
+            df_pre, df_post, df_overall, df_prepost_12, df_prepost_36 = dataframes
+            s.add(rows_in=instrument.parquet_rows(path_pre_processed, path_post_processed),
+                  rows_out=len(df_overall))
+
+    
+        # Create and save 
+        # - table_rates_overall.csv,
+        # - table_rates_subgroup.csv, 
+        # - table_composition_subgroup.csv
+
+        print(f"\n Creating and saving in {output_dir}")
+        print("- table_rates_overall.csv")
+        print("- table_rates_subgroup.csv")
+        print("- table_composition_subgroup.csv \n")
+    
+        with instrument.span('tables'):
+            table_rates_overall_save = table_rates_overall(df_overall, df_pre, df_post)
+            table_rates_overall_save.to_csv(output_dir / "table_rates_overall.csv", index=False)
+
+            table_rates_subgroup_save = table_rates_subgroup(df_prepost_12, df_prepost_36)
+            table_rates_subgroup_save.to_csv(output_dir / "table_rates_subgroup.csv", index=False) 
+
+            # only needs one of them df_prepost_12, redundant columns in both 12 and 36
+            table_composition_subgroup_save = table_composition_subgroup(df_prepost_12) 
+            table_composition_subgroup_save.to_csv(output_dir / "table_composition_subgroup.csv", index=False) 
+
+            # Create and save
+            # - table_IQR_12mo_primary_cats : 25th, 50th, 75th percentile in 12 & 36 mo. improvement for primary categories
+            print(f"\n Creating and saving in {output_dir}")
+            print(f"- table_IQR_12mo_primary_cats")
+            df_IQR = IQR_12mo_primary_cats(table_rates_subgroup_save)
+            df_IQR.to_csv(output_dir / "table_IQR_12mo_primary_cats.csv", index=False)
+            print(df_IQR)
+    
+        # Create and save 
+        # - p_lollipop_12.svg : shows subgroups pre/post rr12mo on lollipop chart
+        # - p_lollipop_36.svg : shows subgroups pre/post rr36mo on lollipop chart
+        # - p_boxplot_yearly.svg  : shows boxplots of time to report of those who report within 36mo
+        # - p_barchart_yearly.svg : shows proportion of those who report within 36mo
+
+        print(f"\n Creating and saving in {output_dir}")
+        print("- p_lollipop_12.svg and _36.svg")
+        print("- p_boxplot_yearly.svg and p_barchart_yearly.svg \n")
+    
+        with instrument.span('plot_lollipop'):
+            p_lollipop_12, p_lollipop_36 = plot_lollipop(df_prepost_12, df_prepost_36)
+
+        with instrument.span('plot_boxplot_yearly', backend=args.backend):
+            p_boxplot_yearly, p_barchart_yearly = plot_boxplot_yearly(backend=args.backend)
+
+        if args.show:
+            bokeh.io.show(bokeh.layouts.row(p_lollipop_12, p_lollipop_36))
+            bokeh.io.show(bokeh.layouts.column(p_boxplot_yearly, p_barchart_yearly))
+
+        figures = {} if args.no_svg else {
+            output_dir / 'p_lollipop_12.svg': p_lollipop_12,
+            output_dir / 'p_lollipop_36.svg': p_lollipop_36,
+            output_dir / 'p_boxplot_yearly.svg': p_boxplot_yearly,
+            output_dir / 'p_barchart_yearly.svg': p_barchart_yearly,
+        }
+
+        def export_figures():
+            with instrument.span('export_svgs', parent=stage.id, figures=len(figures)):
+                export_svgs(figures)
+
+
+        # Bootstraps and permutation tests are independent of each other, so run
+        # them together; each gets its own seed stream derived from `seed`.
+        N_reps_confints = 10_000
+        percentiles_confints=[2.5,97.5]
+        N_reps = 50_000
+        cols_counts = ['group', 'subgroup', 'n_pre', 'N_pre', 'n_post', 'N_post']
+        df_q_pre, df_q_post = df_pre[['rf_months_to_report']], df_post[['rf_months_to_report']]
+        df_counts_12, df_counts_36 = df_prepost_12[cols_counts], df_prepost_36[cols_counts]
+        stat_jobs = {
+            'confints': (get_confints, (df_q_pre, df_q_post, N_reps_confints, percentiles_confints), {}),
+            'confints_subcat': (table_confints_subcat_save, (df_counts_12, df_counts_36),
+                                dict(N_reps=N_reps_confints, percentiles_confints=percentiles_confints)),
+            'permutation_overall': (permutation_test_overall, (df_q_pre, df_q_post), dict(N_reps=N_reps)),
+            'permutation_subgroup_12': (permutation_test_subgroups, (df_counts_12,), dict(N_reps=N_reps)),
+            'permutation_subgroup_36': (permutation_test_subgroups, (df_counts_36,), dict(N_reps=N_reps)),
+        }
+        print(f"\n Running bootstraps and permutation tests ({args.jobs or 'all'} jobs)...")
+        with ThreadPoolExecutor(max_workers=1) as exporter:
+            # The browser renders the figures while the statistics run
+            svg_export = exporter.submit(export_figures) if figures else None
+            with instrument.span('run_stat_jobs', jobs=args.jobs):
+                stat_results = run_stat_jobs(stat_jobs, seed=seed, n_jobs=args.jobs or None, cache=cache)
+            if svg_export is not None:
+                svg_export.result()
+
+        # Create and save 
+        # - confidence_intervals.csv
+        output_confidence_path = output_dir / "confidence_intervals.csv"
+        print(f"\n Creating and saving {output_confidence_path}...")
+    
+        point_estimate_12, confints_12, point_estimate_36, confints_36 = stat_results['confints']
+    
+        print('confidence interval percentiles', percentiles_confints)
+        print('point estimate & confint 12 mo.', point_estimate_12, confints_12)
+        print('point estimate & confint 36 mo.', point_estimate_36, confints_36)
+    
+        confints_table = table_confints_save(
+            point_estimate_12, confints_12, point_estimate_36, confints_36, percentiles_confints)
+        confints_table.to_csv( output_dir / "confidence_intervals.csv", index=False)
+
+        df_confints_subcat = stat_results['confints_subcat']
+        df_confints_subcat.to_csv( output_dir / "confidence_intervals_subcat.csv", index=False)
+    
+    
+        # Create and save 
+        # - permutation_results.csv
+        output_permutation_path = output_dir / "permutation_results.csv"
+        print(f"\n Creating and saving {output_permutation_path}...")
+    
+        permutation_results = stat_results['permutation_overall']
+        # Logged here rather than by the permutation test, which runs in a worker
+        print('permutation test', dict(zip(permutation_results['name'], permutation_results['value'])))
+        permutation_results.to_csv(output_permutation_path, index=False) 
+    
+        df_prepost_12['p_value'] = stat_results['permutation_subgroup_12']
+        df_prepost_36['p_value'] = stat_results['permutation_subgroup_36']
+    
+        permutation_results_subgroup = table_pvalues_subgroup_save(df_prepost_12, df_prepost_36)
+        permutation_results_subgroup.to_csv( output_dir / "permutation_results_subgroup.csv", index=False)
+    
+
+    
+        pass
 
 
 
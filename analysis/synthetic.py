@@ -0,0 +1,294 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+'''
+Seeded synthetic `*_hlact_studies.parquet` bricks for benchmarking the
+analysis without the real data.
+
+The bricks have the columns and Arrow types that `windows.hlact.write()` in
+`analysis/ctgov/process_windows.R` writes: `schema1.*` columns from the
+JSONL-derived data, the normalized `common.*` columns and the regression
+`rr.*` columns. R factors are dictionary columns, `Date` columns are
+`date32` and `POSIXct` columns are UTC timestamps. The distributions
+(completion dates, share of trials reporting, months to report, subgroup
+sizes) only roughly follow the real bricks.
+
+`write_bricks(out_dir, n_trials)` writes the layout read by `plotter.py`:
+
+    <out_dir>/rule-effective-date_processed/datebefore_hlact_studies.parquet
+    <out_dir>/rule-effective-date_processed/dateafter_hlact_studies.parquet
+    <out_dir>/yearly_obs36_processed/<n>_<YYYY>0101_hlact_studies.parquet
+
+with `n_trials` trials in each of the two windows (a share of the trials of
+the first window are in the second window with a later version) and
+`n_trials` trials over all the yearly bricks.
+
+    python3 analysis/synthetic.py --trials 100000 work/synthetic
+'''
+
+PHASES = ['PHASE1; PHASE2', 'PHASE2', 'PHASE2; PHASE3', 'PHASE3', 'PHASE4', 'NA']
+PHASE_P = [.08, .30, .05, .25, .12, .20]
+PHASE_COMMON = {
+    'PHASE1; PHASE2': 'Phase 1/Phase 2', 'PHASE2': 'Phase 2',
+    'PHASE2; PHASE3': 'Phase 2/Phase 3', 'PHASE3': 'Phase 3',
+    'PHASE4': 'Phase 4', 'NA': None,
+}
+PHASE_NORM = {
+    'Phase 1/Phase 2': 'Phase 1/2 & 2', 'Phase 2': 'Phase 1/2 & 2',
+    'Phase 2/Phase 3': 'Phase 2/3 & 3', 'Phase 3': 'Phase 2/3 & 3',
+    'Phase 4': 'Phase 4', None: 'N/A',
+}
+PHASE_RR = {
+    'Phase 1/Phase 2': '1-2', 'Phase 2': '2', 'Phase 2/Phase 3': '2-3',
+    'Phase 3': '3', 'Phase 4': '4', None: 'Not applicable',
+}
+
+PURPOSES = ['TREATMENT', 'PREVENTION', 'DIAGNOSTIC', 'SUPPORTIVE_CARE', 'BASIC_SCIENCE',
+            'HEALTH_SERVICES_RESEARCH', 'SCREENING', 'ECT']
+PURPOSE_P = [.70, .10, .04, .06, .05, .02, .02, .01]
+PURPOSE_COMMON = {
+    'BASIC_SCIENCE': 'Basic Science', 'DIAGNOSTIC': 'Diagnostic',
+    'ECT': 'Educational/Counseling/Training', 'HEALTH_SERVICES_RESEARCH': 'Health Services Research',
+    'PREVENTION': 'Prevention', 'SCREENING': 'Screening',
+    'SUPPORTIVE_CARE': 'Supportive Care', 'TREATMENT': 'Treatment',
+}
+
+INTERVENTIONS = ['Device', 'Biological', 'Drug', 'Other']
+INTERVENTION_P = [.15, .07, .60, .18]
+
+FUNDING_SOURCES = ['INDUSTRY', 'NIH', 'OTHER', 'FED', 'OTHER_GOV', 'NETWORK', 'INDIV', 'UNKNOWN']
+FUNDING_P = [.50, .05, .38, .02, .02, .01, .01, .01]
+
+STATUSES = ['COMPLETED', 'TERMINATED']
+STATUS_P = [.82, .18]
+
+ALLOCATIONS = ['RANDOMIZED', 'NON_RANDOMIZED', 'NA']
+ALLOCATION_P = [.65, .15, .20]
+MASKINGS = ['NONE', 'SINGLE', 'DOUBLE', 'TRIPLE', 'QUADRUPLE']
+MASKING_P = [.45, .10, .15, .10, .20]
+
+OVERSIGHT_LEVELS = ['No United States Oversight Authority',
+                    'United States: Food and Drug Administration',
+                    'United States: Non-FDA Only']
+
+YEARS = range(2012, 2025)
+
+
+def _choice(rng, values, p, n):
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size=n, p=p)]
+
+
+def _factor(values, levels):
+    '''
+    Dictionary column like an R factor with `levels` (missing as null).
+    '''
+    values = pd.Categorical(values, categories=levels)
+    return pa.DictionaryArray.from_arrays(
+        pa.array(values.codes, type=pa.int32(), mask=values.codes < 0),
+        pa.array(levels, type=pa.string()))
+
+
+def _dates(days):
+    # Days since the epoch (NaN for missing) as `date32`
+    days = np.asarray(days, dtype=float)
+    return pa.array(np.where(np.isnan(days), 0, days).astype(np.int32),
+                    type=pa.date32(), mask=np.isnan(days))
+
+
+def _timestamps(seconds):
+    seconds = np.asarray(seconds, dtype=float)
+    us = np.where(np.isnan(seconds), 0, seconds).astype(np.int64) * 1_000_000
+    return pa.array(us, type=pa.timestamp('us', tz='UTC'), mask=np.isnan(seconds))
+
+
+def _iso(days):
+    # `schema1.*` dates are strings, as in the JSONL, with some
+    # month-precision dates
+    s = pd.to_datetime(pd.Series(days), unit='D').dt.strftime('%Y-%m-%d').to_numpy(dtype=object)
+    s[np.isnan(days)] = None
+    return s
+
+
+def random_nct_ids(rng, n):
+    # Distinct NCT IDs
+    return np.char.add('NCT', np.char.zfill(rng.choice(100_000_000, size=n, replace=False).astype(str), 8))
+
+
+def hlact_studies(n, seed=0, start='2012-01-01', end='2016-12-31', nct_ids=None,
+                  version_offset=0, p_report=.6):
+    '''
+    Arrow table of `n` synthetic trials whose primary completion dates are
+    between `start` and `end`.
+
+    nct_ids: the NCT IDs to use (default: `n` distinct IDs from the seed).
+    version_offset: added to the version numbers, for trials that are also
+        in an earlier brick.
+    p_report: share of trials with results.
+    '''
+    rng = np.random.default_rng(seed)
+    if nct_ids is None:
+        nct_ids = random_nct_ids(rng, n)
+    nct_ids = np.asarray(nct_ids, dtype=str)
+
+    epoch = np.datetime64('1970-01-01')
+    first = (np.datetime64(start) - epoch).astype(int)
+    last = (np.datetime64(end) - epoch).astype(int)
+    completion = rng.integers(first, last + 1, size=n).astype(float)
+    start_days = completion - rng.gamma(2., 400., size=n).round()
+    # Months to report: most report around 11 months, with a long tail
+    reported = rng.random(n) < p_report
+    delay_days = np.where(rng.random(n) < .7, rng.normal(340, 60, size=n), rng.gamma(2., 500., size=n))
+    results_seconds = (completion + delay_days.round()) * 86400 + rng.integers(0, 86400, size=n)
+    results_seconds[~reported] = np.nan
+    # A few trials only have a completion date at month precision
+    completion_str = _iso(completion)
+    month_only = rng.random(n) < .05
+    completion_str[month_only] = [s[:7] for s in completion_str[month_only]]
+    disp_days = np.where(rng.random(n) < .03, completion + rng.integers(0, 365, size=n), np.nan)
+
+    phase = _choice(rng, PHASES, PHASE_P, n)
+    purpose = _choice(rng, PURPOSES, PURPOSE_P, n)
+    intervention = _choice(rng, INTERVENTIONS, INTERVENTION_P, n)
+    funding_source = _choice(rng, FUNDING_SOURCES, FUNDING_P, n)
+    status = _choice(rng, STATUSES, STATUS_P, n)
+    allocation = _choice(rng, ALLOCATIONS, ALLOCATION_P, n)
+    masking = _choice(rng, MASKINGS, MASKING_P, n)
+    enrollment = rng.lognormal(4., 1.3, size=n).round()
+    n_arms = rng.integers(1, 5, size=n)
+    version = rng.integers(1, 40, size=n) + version_offset
+
+    phase_common = [PHASE_COMMON[p] for p in phase]
+    purpose_common = [PURPOSE_COMMON[p] for p in purpose]
+    funding = np.where(funding_source == 'INDUSTRY', 'Industry',
+                       np.where(funding_source == 'NIH', 'NIH', 'Other'))
+    status_common = np.where(status == 'COMPLETED', 'Completed', 'Terminated')
+    purpose_rr = [p if p in ('Treatment', 'Prevention', 'Diagnostic') else 'Other'
+                  for p in purpose_common]
+    months_to_results = (results_seconds / 86400 - completion) / 30.4375
+    study_duration = (completion - start_days) / 30.4375
+
+    columns = {
+        'schema1.nct_id': pa.array(nct_ids),
+        'schema1.version_number': pa.array(version, type=pa.int32()),
+        'schema1.nct_id_1': pa.array(nct_ids),
+        'schema1.start_date': pa.array(_iso(start_days)),
+        'schema1.primary_completion_date': pa.array(completion_str),
+        'schema1.completion_date': pa.array(_iso(completion + rng.integers(0, 90, size=n))),
+        'schema1.verification_date': pa.array(_iso(completion + rng.integers(0, 900, size=n))),
+        'schema1.results_rec_date': pa.array(_iso(np.floor(results_seconds / 86400))),
+        'schema1.disp_submit_date': pa.array(_iso(disp_days)),
+        'schema1.phase': _factor(phase, PHASES),
+        'schema1.overall_status': _factor(status, STATUSES),
+        'schema1.lead_sponsor_funding_source': _factor(funding_source, FUNDING_SOURCES),
+        'schema1.norm_funding_source_class': _factor(funding, ['Industry', 'NIH', 'Other']),
+        'schema1.primary_purpose': _factor(purpose, sorted(PURPOSES)),
+        'schema1.allocation': _factor(allocation, ALLOCATIONS),
+        'schema1.masking': _factor(masking, MASKINGS),
+        'schema1.enrollment': pa.array(enrollment),
+        'schema1.number_of_arm_groups': pa.array(n_arms, type=pa.int32()),
+        'schema1.number_of_interventions': pa.array(rng.integers(1, 4, size=n), type=pa.int32()),
+        'common.primary_completion_date_imputed': _dates(completion),
+        'common.results_received_date': _timestamps(results_seconds),
+        'common.start_date': _timestamps(start_days * 86400),
+        'common.disp_submit_date': _dates(disp_days),
+        'common.delayed': pa.array(~np.isnan(disp_days)),
+        'common.phase': _factor(phase_common, list(PHASE_NORM)[:-1]),
+        'common.primary_purpose': _factor(purpose_common, sorted(PURPOSE_COMMON.values())),
+        'common.allocation': _factor(allocation, ALLOCATIONS),
+        'common.masking': _factor(masking, MASKINGS),
+        'common.intervention_type': _factor(intervention, INTERVENTIONS),
+        'common.funding': _factor(funding, ['Industry', 'NIH', 'Other']),
+        'common.overall_status': _factor(status_common, ['Completed', 'Terminated']),
+        'common.enrollment': pa.array(enrollment),
+        'common.oversight': _factor([None] * n, OVERSIGHT_LEVELS),
+        'common.number_of_arms': pa.array(n_arms, type=pa.int32()),
+        'common.phase.norm': _factor([PHASE_NORM[p] for p in phase_common],
+                                     ['Phase 1/2 & 2', 'Phase 2/3 & 3', 'Phase 4', 'N/A']),
+        'common.pc_year_imputed': pa.array(
+            (completion.astype('datetime64[D]').astype('datetime64[Y]').astype(int) + 1970).astype(float)),
+        'cr.months_to_results_no_extensions_no_censor': pa.array(months_to_results),
+        'cr.results_reported_12mo': pa.array(np.nan_to_num(months_to_results, nan=np.inf) < 12 + 1/30.4375),
+        'cr.results_reported_36mo': pa.array(np.nan_to_num(months_to_results, nan=np.inf) < 36 + 1/30.4375),
+        'rr.phase': _factor([PHASE_RR[p] for p in phase_common],
+                            ['4', '1-2', '2', '2-3', '3', 'Not applicable']),
+        'rr.primary_purpose': _factor(purpose_rr, ['Treatment', 'Prevention', 'Diagnostic', 'Other']),
+        'rr.study_duration': pa.array(study_duration),
+        'rr.number_of_arms': _factor(np.where(n_arms == 1, 'one', np.where(n_arms == 2, 'two', 'three or more')),
+                                     ['one', 'three or more', 'two']),
+        'rr.intervention_type': _factor(intervention, ['Drug', 'Device', 'Biological', 'Other']),
+        'rr.funding': _factor(funding, ['NIH', 'Industry', 'Other']),
+        'rr.overall_status': _factor(status_common, ['Completed', 'Terminated']),
+    }
+    return pa.table(columns)
+
+
+def write_hlact_studies(path, n, seed=0, **kwargs):
+    table = hlact_studies(n, seed=seed, **kwargs)
+    pq.write_table(table, path)
+    return table
+
+
+def write_bricks(out_dir, n_trials, seed=0, p_overlap=.3):
+    '''
+    Write the window and yearly bricks of `n_trials` trials under
+    `out_dir` (see the module docstring).
+
+    p_overlap: share of the trials of the first window that are in the
+        second window too.
+
+    Returns the paths written.
+    '''
+    seeds = np.random.SeedSequence(seed).spawn(3 + len(YEARS))
+    out_dir = Path(out_dir)
+    paths = []
+
+    window_dir = out_dir / 'rule-effective-date_processed'
+    window_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seeds[0])
+    n_overlap = int(n_trials * p_overlap)
+    nct_ids = random_nct_ids(rng, 2 * n_trials - n_overlap)
+    before_ids = nct_ids[:n_trials]
+    after_ids = rng.permutation(np.concatenate([
+        rng.choice(before_ids, size=n_overlap, replace=False), nct_ids[n_trials:]]))
+    write_hlact_studies(window_dir / 'datebefore_hlact_studies.parquet', n_trials,
+                        seed=seeds[1], start='2013-01-01', end='2016-12-31',
+                        nct_ids=before_ids, p_report=.55)
+    # Trials in both windows have a later version in the second one
+    write_hlact_studies(window_dir / 'dateafter_hlact_studies.parquet', n_trials,
+                        seed=seeds[2], start='2018-01-01', end='2020-12-31',
+                        nct_ids=after_ids, version_offset=40, p_report=.7)
+    paths += [window_dir / 'datebefore_hlact_studies.parquet',
+              window_dir / 'dateafter_hlact_studies.parquet']
+
+    yearly_dir = out_dir / 'yearly_obs36_processed'
+    yearly_dir.mkdir(parents=True, exist_ok=True)
+    sizes = np.full(len(YEARS), n_trials // len(YEARS))
+    sizes[:n_trials % len(YEARS)] += 1
+    for i, (year, size, seed_seq) in enumerate(zip(YEARS, sizes, seeds[3:]), 1):
+        path = yearly_dir / f'{i}_{year}0101_hlact_studies.parquet'
+        # Trials completing in the year before the 36 month observation window
+        write_hlact_studies(path, int(size), seed=seed_seq,
+                            start=f'{year - 4}-01-01', end=f'{year - 4}-12-31',
+                            p_report=.5 + .02 * i)
+        paths.append(path)
+    return paths
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Write synthetic processed hlact bricks')
+    parser.add_argument('out_dir', nargs='?', default='work/synthetic')
+    parser.add_argument('--trials', type=int, default=100_000,
+                        help='number of trials in each window (and over the yearly bricks)')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    paths = write_bricks(args.out_dir, args.trials, seed=args.seed)
+    print(f'synthetic: wrote {len(paths)} bricks of {args.trials} trials to {args.out_dir}')
@@ -2,71 +2,201 @@ import numpy as np
 import pandas as pd
 import os
 import glob
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 
-def process_months_to_report(df_):
-    df_['common.primary_completion_date_imputed'] = pd.to_datetime(
-        df_['common.primary_completion_date_imputed'], errors='coerce')
-    
-    df_['common.results_received_date'] = pd.to_datetime(
-        df_['common.results_received_date'], errors='coerce')
-    
-    # df['common.results_received_date'] = \
-    #     df['common.results_received_date'].dt.tz_localize('UTC')  # Localize tz-naive to UTC
-    df_['common.primary_completion_date_imputed'] = df_[
-        'common.primary_completion_date_imputed'].dt.tz_localize('UTC')  # Localize tz-naive to UTC
-
-    df_['rf_months_to_report'] = (df_['common.results_received_date'] - 
-     df_['common.primary_completion_date_imputed']).dt.days/30.44
-
-    df_['rf_months_to_report_plot'] = df_['rf_months_to_report'].fillna(65)
-    df_.loc[df_['rf_months_to_report_plot'] < 0, 'rf_months_to_report_plot'] = 0 
-
-    df_['report_within_12'] = df_['rf_months_to_report'] <= 12 + 1/30.5
-    df_['report_within_36'] = df_['rf_months_to_report'] <= 36 + 1/30.5
-    try:
-        df_['rr.primary_purpose'].replace({'Diagnostic':'Other'})
-    except: 
-        pass
+date_cols = ['common.primary_completion_date_imputed', 'common.results_received_date']
+dedup_cols = ['schema1.nct_id_1', 'schema1.version_number']
+
+
+def read_processed(path, columns=None, filters=None, dtype_backend=None, categorical=False):
+    '''
+    Read a processed `*_hlact_studies.parquet` brick, loading only `columns`.
+
+    columns: defaults to `processed_columns`, the columns used by the
+        analysis; pass `[]` for all columns.
+    filters: row filters pushed down to the Parquet reader, in the
+        `pyarrow.parquet.read_table` format, e.g.
+        [('rr.overall_status', '==', 'Completed')].
+    dtype_backend: 'pyarrow' for Arrow-backed columns.
+    categorical: store the grouping columns as `category` dtype.
+    '''
+    if columns is None:
+        columns = processed_columns
+    kwargs = {} if dtype_backend is None else {'dtype_backend': dtype_backend}
+    df = pd.read_parquet(path, columns=columns or None, filters=filters, **kwargs)
+    if categorical:
+        for col in df.columns.intersection(groups_col):
+            # Arrow dictionary columns (R factors) are already categorical
+            if not str(df[col].dtype).startswith('dictionary<'):
+                df[col] = df[col].astype('category')
+    return df
+
+
+def _as_utc_datetime(s):
+    # Parse once: columns that are already tz-aware datetimes (e.g. from an
+    # earlier call or a concat of processed frames) are returned unchanged.
+    if isinstance(s.dtype, pd.DatetimeTZDtype) and str(s.dt.tz) == 'UTC':
+        return s
+    if not isinstance(s.dtype, pd.DatetimeTZDtype) and not pd.api.types.is_datetime64_dtype(s):
+        s = pd.to_datetime(s, errors='coerce')
+    if s.dt.tz is not None:
+        return s.dt.tz_convert('UTC')
+    return s.dt.tz_localize('UTC')  # Localize tz-naive to UTC
+
+
+def process_months_to_report(df_, thresholds=(12, 36)):
+    '''
+    Adds months-to-report columns to df_ in place (and returns it):
+
+    - rf_days_to_report: whole days from primary completion to results
+    - rf_months_to_report: rf_days_to_report / 30.44
+    - rf_months_to_report_plot: missing as 65, negative as 0
+    - report_within_<X>: bool, reported within X months, for X in thresholds
+    '''
+    for col in date_cols:
+        df_[col] = _as_utc_datetime(df_[col])
+
+    delta = (df_[date_cols[1]] - df_[date_cols[0]]).to_numpy()
+    # Floors like `.dt.days`; NaT becomes NaN
+    days = delta.astype('timedelta64[D]').astype(np.float64)
+    days[np.isnat(delta)] = np.nan
+    months = days / 30.44
+
+    df_['rf_days_to_report'] = days
+    df_['rf_months_to_report'] = months
+    df_['rf_months_to_report_plot'] = np.clip(np.nan_to_num(months, nan=65), 0, None)
+
+    for within in thresholds:
+        df_[f'report_within_{within}'] = months <= within + 1/30.5
     return df_
 
 
-def get_d_rates(df, within):
-    groups = ['funding','phase', 'intervention','purpose', 'status'] 
-    groups_col = [ 
-        'rr.funding', 
-        'common.phase.norm', 
-        'rr.intervention_type', 
-        'rr.primary_purpose',
-        'rr.overall_status'
-    ]
-
-    d_group_col = dict(zip(groups, groups_col))
-    d_rates, d_props, d_n, d_N = {}, {}, {}, {}
-    for group in groups:
-        col_group = d_group_col[group]
-        # rates: reporting rate n/N, props: proportion of composition, n: reporting within X months, N: total
-        d_rates[group] = df.groupby(col_group)['rf_months_to_report'].apply(
-            lambda x: (x <= within + 1/30.5).sum()/len(x)).to_dict()
-        d_props[group] = df[col_group].value_counts(normalize=True).to_dict()
-        d_N[group] = df.groupby(col_group).size().to_dict()
-        d_n[group] = df.groupby(col_group)['rf_months_to_report'].apply(
-            lambda x: (x <= within + 1/30.5).sum()).to_dict()
+groups = ['funding','phase', 'intervention','purpose', 'status'] 
+groups_col = [ 
+    'rr.funding', 
+    'common.phase.norm', 
+    'rr.intervention_type', 
+    'rr.primary_purpose',
+    'rr.overall_status'
+]
+# Columns of the processed bricks used by the analysis
+processed_columns = date_cols + groups_col + dedup_cols
+
 
+def get_rates_long(df, thresholds=(12, 36)):
+    '''
+    Reporting rates for every group and every threshold in one pass.
+
+    For each grouping column the boolean "reported within X months" flags of
+    all thresholds are summed together in a single groupby.
+
+    Returns a long DataFrame with columns
+    group, subgroup, within, n, N, rate, prop
+    where n: reporting within X months, N: total, rate: n/N,
+    prop: proportion of composition.
+    '''
+    months = df['rf_months_to_report']
+    flags = pd.DataFrame({within: months <= within + 1/30.5 for within in thresholds},
+                         index=df.index)
+
+    parts = []
+    for group, col_group in zip(groups, groups_col):
+        g = flags.groupby(df[col_group])
+        d_n = g.sum()
+        d_N = g.size()
+        subgroups = d_N.index.tolist()
+        for within in thresholds:
+            parts.append(pd.DataFrame({
+                'group': group,
+                'subgroup': subgroups,
+                'within': within,
+                'n': d_n[within].to_numpy(),
+                'N': d_N.to_numpy(),
+            }))
+
+    df_long = pd.concat(parts, ignore_index=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        df_long['rate'] = df_long['n'] / df_long['N']
+    df_long['prop'] = df_long['N'] / df_long.groupby(['group', 'within'])['N'].transform('sum')
+    return df_long
+
+
+def d_rates_from_long(df_long, within):
+    # Nested {group: {subgroup: value}} dicts as returned by `get_d_rates`
+    df_ = df_long[df_long['within'] == within]
+    d_rates, d_props, d_n, d_N = {}, {}, {}, {}
+    for group, df_group in df_.groupby('group', sort=False):
+        d_rates[group] = dict(zip(df_group['subgroup'], df_group['rate']))
+        d_props[group] = dict(zip(df_group['subgroup'], df_group['prop']))
+        d_n[group] = dict(zip(df_group['subgroup'], df_group['n']))
+        d_N[group] = dict(zip(df_group['subgroup'], df_group['N']))
     return d_rates, d_props, d_n, d_N
 
 
+def get_d_rates(df, within):
+    # rates: reporting rate n/N, props: proportion of composition, n: reporting within X months, N: total
+    return d_rates_from_long(get_rates_long(df, thresholds=[within]), within)
+
+
+
+metrics = ['rate', 'prop', 'n', 'N']
+windows = ['pre', 'post', 'overall']
+
+
+def get_rates_windows(d_dfs, thresholds=(12, 36)):
+    '''
+    Long-format rates for several windows, e.g. {'pre': df_pre, 'post': df_post}.
+
+    Returns a DataFrame with one row per
+    (group, subgroup, window, within, metric) and the metric in `value`.
+    '''
+    df_long = pd.concat(
+        [get_rates_long(df, thresholds=thresholds).assign(window=window)
+         for window, df in d_dfs.items()],
+        ignore_index=True)
+    return df_long.melt(id_vars=['group', 'subgroup', 'window', 'within'],
+                        value_vars=metrics, var_name='metric', value_name='value')
+
+
+def pivot_prepost(df_long, within=None):
+    '''
+    Wide pre/post/overall table from `get_rates_windows` output.
+
+    Columns are group, subgroup, then `<metric>_<window>` for each window and
+    metric, and diff_rate = rate_post - rate_pre. Rows follow the subgroups of
+    the first window (as a left join on it would).
+    '''
+    if within is not None:
+        df_long = df_long[df_long['within'] == within]
+    windows_ = list(pd.unique(df_long['window']))
+    keys = ['group', 'subgroup']
+
+    df_wide = df_long.pivot_table(index=keys, columns=['metric', 'window'], values='value',
+                                  aggfunc='first', sort=False, dropna=False)
+    rows = df_long.loc[df_long['window'] == windows_[0], keys].drop_duplicates()
+    df_wide = df_wide.reindex(pd.MultiIndex.from_frame(rows))
+
+    cols = [(metric, window) for window in windows_ for metric in metrics]
+    df_prepost = df_wide.reindex(columns=cols)
+    df_prepost.columns = [f'{metric}_{window}' for metric, window in cols]
+    df_prepost = df_prepost.reset_index()
+    for window in windows_:
+        df_prepost[[f'n_{window}', f'N_{window}']] = \
+            df_prepost[[f'n_{window}', f'N_{window}']].round().astype('Int64')
+
+    df_prepost['diff_rate'] = df_prepost['rate_post'] - df_prepost['rate_pre']
+    return df_prepost
+
 
 def flatten_d(d, rate_col = 'rate'):
-    df_ = pd.DataFrame(columns={'group':[], 'subgroup':[], rate_col:[]})
-    groups = d.keys()
-    for group in groups:
-        d_group = d[group]
-        subgroups = d_group.keys()
-        rates = d_group.values()
-        row = pd.DataFrame({'group':group, 'subgroup':subgroups, rate_col:rates})
-        df_ = pd.concat([df_, row])
-    return df_
+    groups, subgroups, rates = [], [], []
+    for group, d_group in d.items():
+        groups.extend([group] * len(d_group))
+        subgroups.extend(d_group.keys())
+        rates.extend(d_group.values())
+    return pd.DataFrame({'group':groups, 'subgroup':subgroups, rate_col:rates})
 
     
 def get_prepost_dataframes(
@@ -75,70 +205,105 @@ def get_prepost_dataframes(
     d_n_pre, d_n_post, d_n_overall,
     d_N_pre, d_N_post, d_N_overall,
     ):
-    
-    df_pre = flatten_d(d_rates_pre, rate_col='rate_pre').merge(
-        flatten_d(d_props_pre, rate_col='prop_pre')).merge(
-        flatten_d(d_n_pre, rate_col='n_pre')).merge(
-        flatten_d(d_N_pre, rate_col='N_pre'))
-    
-    df_post = flatten_d(d_rates_post, rate_col='rate_post').merge(
-        flatten_d(d_props_post, rate_col='prop_post')).merge(
-        flatten_d(d_n_post, rate_col='n_post')).merge(
-        flatten_d(d_N_post, rate_col='N_post'))
-    
-    df_overall = flatten_d(d_rates_overall, rate_col='rate_overall').merge(
-        flatten_d(d_props_overall, rate_col='prop_overall')).merge(
-        flatten_d(d_n_overall, rate_col='n_overall')).merge(
-        flatten_d(d_N_overall, rate_col='N_overall'))
-
-    
-    df_prepost = df_pre.merge(df_post, on=['group', 'subgroup'], how='left'
-                ).merge(df_overall, on=['group', 'subgroup'], how='left')
-    
-    df_prepost['diff_rate'] = df_prepost['rate_post'] - df_prepost['rate_pre']
-    return df_prepost
+    d_windows = {
+        'pre': [d_rates_pre, d_props_pre, d_n_pre, d_N_pre],
+        'post': [d_rates_post, d_props_post, d_n_post, d_N_post],
+        'overall': [d_rates_overall, d_props_overall, d_n_overall, d_N_overall],
+    }
+    df_long = pd.concat([
+        flatten_d(d, rate_col='value').assign(window=window, metric=metric)
+        for window, ds in d_windows.items()
+        for metric, d in zip(metrics, ds)
+    ], ignore_index=True)
+    return pivot_prepost(df_long)
 
 
-def get_dataframes(path_pre_processed, path_post_processed):
+def get_dataframes(path_pre_processed, path_post_processed, backend='pandas', **read_kwargs):
     # path_pre = "../brick/pre-post-2017_processed/1_20200101_hlact_studies.parquet")
     # path_post = "../brick/pre-post-2017_processed/2_20240101_hlact_studies.parquet")
-    df_pre = pd.read_parquet(path_pre_processed)
-    df_post = pd.read_parquet(path_post_processed)
+    # read_kwargs: passed to `read_processed` (columns, filters, dtype_backend, categorical)
+    if backend == 'duckdb':
+        import duckdb_backend
+        return duckdb_backend.get_dataframes(path_pre_processed, path_post_processed)
+    df_pre = read_processed(path_pre_processed, **read_kwargs)
+    df_post = read_processed(path_post_processed, **read_kwargs)
     
     df_pre = process_months_to_report(df_pre)
     df_post = process_months_to_report(df_post)
-    df_overall = pd.concat([df_pre, df_post])
     #  Reduce duplicates, takes latest version number
-    df_overall = df_overall[ 
-        df_overall.groupby('schema1.nct_id_1')['schema1.version_number'
-        ].rank(method='max') == 1 
-    ]
+    #  (ranked on the key columns only, so only the kept rows are concatenated)
+    keys = pd.concat([df_pre[dedup_cols], df_post[dedup_cols]], ignore_index=True)
+    keep = (keys.groupby(dedup_cols[0])[dedup_cols[1]].rank(method='max') == 1).to_numpy()
+    df_overall = pd.concat([df_pre[keep[:len(df_pre)]], df_post[keep[len(df_pre):]]])
 
     # Gets pre and post aggregate rates within 12 and 36 months
-    groups = ['funding','phase', 'intervention','purpose'] 
-    groups_col = [ 'rr.funding', 'common.phase.norm', 'rr.intervention_type', 'rr.primary_purpose']
-    
-    d_rates_pre_12, d_props_pre_12, d_n_pre_12, d_N_pre_12 = get_d_rates(df_pre, within=12)
-    d_rates_post_12, d_props_post_12, d_n_post_12, d_N_post_12 = get_d_rates(df_post, within=12)
-    d_rates_overall_12, d_props_overall_12, d_n_overall_12, d_N_overall_12 = get_d_rates(df_overall, within=12)
-    
-    d_rates_pre_36, d_props_pre_36, d_n_pre_36, d_N_pre_36 = get_d_rates(df_pre, within=36)
-    d_rates_post_36, d_props_post_36, d_n_post_36, d_N_post_36 = get_d_rates(df_post, within=36)
-    d_rates_overall_36, d_props_overall_36, d_n_overall_36, d_N_overall_36 = get_d_rates(df_overall, within=36)
-    
-    
-    df_prepost_12 = get_prepost_dataframes(d_rates_pre_12, d_rates_post_12, d_rates_overall_12, 
-                                           d_props_pre_12, d_props_post_12, d_props_overall_12,
-                                           d_n_pre_12, d_n_post_12, d_n_overall_12,
-                                           d_N_pre_12, d_N_post_12, d_N_overall_12
-                                          )
-    df_prepost_36 = get_prepost_dataframes(d_rates_pre_36, d_rates_post_36, d_rates_overall_36,
-                                           d_props_pre_36, d_props_post_36, d_props_overall_36,
-                                           d_n_pre_36, d_n_post_36, d_n_overall_36,
-                                           d_N_pre_36, d_N_post_36, d_N_overall_36
-                                          )
+    rates_long = get_rates_windows(
+        {'pre': df_pre, 'post': df_post, 'overall': df_overall}, thresholds=(12, 36))
+    df_prepost_12 = pivot_prepost(rates_long, within=12)
+    df_prepost_36 = pivot_prepost(rates_long, within=36)
 
         
     return df_pre, df_post, df_overall, df_prepost_12, df_prepost_36
 
 
+
+
+# Yearly window bricks are named `<n>_<YYYYMMDD>_hlact_studies.parquet`,
+# e.g. `1_20120101_hlact_studies.parquet` for the 2012 cutoff.
+yearly_file_re = re.compile(r'(?:^|_)(\d{4})\d{4}_hlact_studies\.parquet$')
+
+
+def find_yearly_files(dirpath, pattern='*_hlact_studies.parquet'):
+    '''
+    Returns [(year, path), ...] sorted by year for the yearly bricks in dirpath.
+    '''
+    d_files = {}
+    for path in glob.glob(os.path.join(dirpath, pattern)):
+        match = yearly_file_re.search(os.path.basename(path))
+        if match is None:
+            continue
+        year = int(match.group(1))
+        if year in d_files:
+            raise ValueError(f'Two yearly files for {year}: {d_files[year]}, {path}')
+        d_files[year] = path
+    return sorted(d_files.items())
+
+
+def _months_to_report_stats(path, col='rf_months_to_report'):
+    df = process_months_to_report(read_processed(path, columns=date_cols))
+    x = df[col]
+    return {
+        'N': len(x),
+        'mean': x.mean(),
+        'median': x.median(),
+        'q10': x.quantile(.10),
+        'q25': x.quantile(.25),
+        'q75': x.quantile(.75),
+        'q90': x.quantile(.90),
+        'p_report': 1 - x.isnull().sum()/len(x),
+    }
+
+
+def get_yearly_stats(dirpath, pattern='*_hlact_studies.parquet', max_workers=4, backend='pandas'):
+    '''
+    Months-to-report quantiles and proportion reporting for each yearly brick.
+
+    Files are read by a pool of `max_workers` threads and each one is reduced
+    to a row of statistics as soon as it is loaded, so at most `max_workers`
+    bricks are in memory at a time.
+
+    Returns a DataFrame indexed by year with columns
+    N, mean, median, q10, q25, q75, q90, p_report.
+
+    backend: 'duckdb' to compute all years in one DuckDB query instead.
+    '''
+    if backend == 'duckdb':
+        import duckdb_backend
+        return duckdb_backend.get_yearly_stats(dirpath, pattern=pattern)
+    files = find_yearly_files(dirpath, pattern=pattern)
+    if not files:
+        raise FileNotFoundError(f'No yearly bricks matching {pattern} in {dirpath}')
+    years, paths = zip(*files)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        stats = list(executor.map(_months_to_report_stats, paths))
+    return pd.DataFrame(stats, index=pd.Index(years, name='year'))
@@ -102,6 +102,10 @@
                   pyarrow
                   fastparquet
                   openpyxl
+                  pyyaml
+                  aiohttp
+                  zstandard
+                  duckdb
                   bokeh
                   tqdm
                   iqplot
@@ -116,6 +120,7 @@
                 parallelWithPerlEnv
                 rEnv
                 python3Env
+                pkgs.duckdb
                 pkgs.chromium
                 pkgs.chromedriver
               ]
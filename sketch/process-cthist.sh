@@ -13,8 +13,9 @@ R ./stages/01_download_cts.R
 ## Create work/empty.parquet
 duckdb < ./sql/create_empty.sql
 
-## Create work/all_study_records.parquet
-python3 ./stages/process_parquet.py
+## Create work/all_study_records/*.parquet
+python3 ./stages/process_parquet.py --schema work/empty.parquet \
+	'work/NCT*.parquet' work/all_study_records
 
 ## Create work/relevant_study_records.parquet
 duckdb < ./sql/relevant_study_records.sql
@@ -0,0 +1,43 @@
+-- syntax: DuckDB SQL
+--
+-- NAME
+--
+--   create_aact_parquet.sql - Export the AACT columns used by the HLACT filter
+--
+-- DESCRIPTION
+--
+--   Copies the AACT tables and columns that `sql/create_cthist_hlact.sql`
+--   reads (calculated values, facilities and the disposition date of studies)
+--   from the PostgreSQL database to Parquet files, once per AACT dump. The
+--   HLACT filter then reads these files instead of attaching the database.
+
+INSTALL postgres;
+
+-- See `.env.template` for how to set up other connection parameters.
+-- Make sure to start the database and source `.env` prior to running this SQL.
+-- See `README.md` for how to set up the database.
+ATTACH 'dbname=aact_20240430' AS pg (TYPE postgres, READ_ONLY);
+
+COPY (
+    SELECT
+        nct_id,
+        has_us_facility,
+    FROM
+        pg.ctgov.calculated_values
+) TO 'brick/aact_20240430/ctgov/calculated_values.parquet' (FORMAT PARQUET, COMPRESSION ZSTD);
+
+COPY (
+    SELECT
+        nct_id,
+        country,
+    FROM
+        pg.ctgov.facilities
+) TO 'brick/aact_20240430/ctgov/facilities.parquet' (FORMAT PARQUET, COMPRESSION ZSTD);
+
+COPY (
+    SELECT
+        nct_id,
+        disposition_first_submitted_date,
+    FROM
+        pg.ctgov.studies
+) TO 'brick/aact_20240430/ctgov/studies.parquet' (FORMAT PARQUET, COMPRESSION ZSTD);
@@ -6,19 +6,16 @@
 --
 -- DESCRIPTION
 --
---   Processes the versioned historical ClinicalTrials.gov study record JSONL
---   data files before a given cut-off date (to represent the date that a given
---   dataset was downloaded).
+--   Selects the latest version of each versioned historical
+--   ClinicalTrials.gov study record before a given cut-off date (to represent
+--   the date that a given dataset was downloaded).
 --
---   Extracts a subset of the study record data needed for further processing
---   as a Parquet file.
+--   Reads the typed columns of all record versions written by
+--   `stages/ingest_cthist.py` and writes them with a few derived columns as a
+--   Parquet file.
 --
 -- [% TAGS \[\% \%\] --%% %]
 --%% ## See § Templating… in `sql/README.md`.
-INSTALL json;
-
-LOAD json;
-
 --## {{ begin:normalize_funding_source_top }}
 -- normalize_funding_source
 --
@@ -70,117 +67,27 @@ COPY (
     FROM
         (
             WITH
-            study_changes AS (
+            _extract AS (
+                -- Latest version of each study as of the cut-off date. The
+                -- columns are extracted from the JSON once, by
+                -- `stages/ingest_cthist.py`.
                 SELECT
-                    CAST(json_extract(change, '$.date')    AS DATE   ) AS change_date,
-                    CAST(json_extract(change, '$.version') AS INTEGER) AS change_version,
-                    studyRecord->>'$.study.protocolSection.identificationModule.nctId' AS change_nct_id,
-                    *
+                    * EXCLUDE (change, studyRecord, source_file, nct_prefix)
                 FROM read_parquet(
-                    'brick/ctgov/historical/records.parquet'
+                    'brick/ctgov/historical/versions/*/*.parquet',
+                    hive_partitioning = true
                 )
                 WHERE
+                        nct_id IS NOT NULL
 --%%                FILTER replace('2013-09-27', date.cutoff)
-                    change_date <= '2013-09-27'::DATE -- cut-off date
+                    AND version_date <= '2013-09-27'::DATE -- cut-off date
 --%%                END
-            ),
-            latest_per_file AS (
-                SELECT
-                    change_nct_id,
-                    MAX(change_version) AS max_change_version
-                FROM study_changes
-                GROUP BY change_nct_id
-            ),
-            cutoff_study_records AS (
-                    SELECT
-                        sc.change_date    AS change_date,
-                        sc.change_version AS change_version,
-                        -- sc.studyRecord->>'$.study.protocolSection.identificationModule.nctId' AS nct_id,
-                        sc.change      AS change,
-                        sc.studyRecord AS studyRecord
-                    FROM study_changes sc
-                    JOIN latest_per_file lpf
-                        ON  sc.change_nct_id  = lpf.change_nct_id
-                        AND sc.change_version = lpf.max_change_version
-            ),
-            _extract AS (
-                SELECT
-                    TRY_CAST(change ->> '$.version' AS INTEGER) AS version_number,
-                    TRY_CAST(change ->> '$.date'    AS DATE   ) AS version_date,
-
-                    studyRecord ->> '$.study.protocolSection.identificationModule.nctId' AS nct_id,
-
-                    list_sort(list_distinct(
-                        studyRecord ->> '$.study.protocolSection.contactsLocationsModule.locations[*].country'
-                    )) AS location_country,
-                    TRY_CAST(
-                        studyRecord ->> '$.study.protocolSection.oversightModule.oversightHasDmc' AS BOOLEAN
-                    ) AS has_dmc,
-                    TRY_CAST(
-                        studyRecord ->> '$.study.protocolSection.oversightModule.isFdaRegulatedDevice' AS BOOLEAN
-                    ) AS is_fda_regulated_device,
-                    TRY_CAST(
-                        studyRecord ->> '$.study.protocolSection.oversightModule.isFdaRegulatedDrug' AS BOOLEAN
-                    ) AS is_fda_regulated_drug,
-                    TRY_CAST(
-                        studyRecord ->> '$.study.protocolSection.oversightModule.isPpsd' AS BOOLEAN
-                    ) AS is_ppsd,
-                    TRY_CAST(
-                        studyRecord ->> '$.study.protocolSection.oversightModule.isUnapprovedDevice' AS BOOLEAN
-                    ) AS is_unapproved_device,
-                    TRY_CAST(
-                        studyRecord ->> '$.study.protocolSection.oversightModule.isUsExport' AS BOOLEAN
-                    ) AS is_us_export,
-                    studyRecord ->> '$.study.protocolSection.statusModule.overallStatus' AS overall_status,
-                    TRY_CAST(
-                        studyRecord -> '$.study.protocolSection.designModule.phases' AS VARCHAR[]
-                    ) AS phases,
-                    studyRecord ->> '$.study.protocolSection.statusModule.startDateStruct.date' AS start_date,
-                    -- TODO Partial date type
-                    studyRecord ->> '$.study.protocolSection.statusModule.primaryCompletionDateStruct.date' AS primary_completion_date,
-                    -- TODO Partial date type
-                    studyRecord ->> '$.study.protocolSection.statusModule.completionDateStruct.date' AS completion_date,
-                    -- TODO Partial date type
-                    studyRecord ->> '$.study.protocolSection.designModule.studyType' AS study_type,
-                    studyRecord ->> '$.study.protocolSection.designModule.designInfo.primaryPurpose' AS primary_purpose,
-                    studyRecord ->> '$.study.protocolSection.designModule.designInfo.allocation' AS allocation,
-                    studyRecord ->> '$.study.protocolSection.designModule.designInfo.maskingInfo.masking' AS masking,
-                    TRY_CAST(
-                        studyRecord ->> '$.study.protocolSection.designModule.enrollmentInfo.count' AS INTEGER
-                    ) AS enrollment,
-                    studyRecord ->> '$.study.protocolSection.statusModule.statusVerifiedDate' AS verification_date,
-                    -- TODO Partial date type
-                    list_sort(list_distinct(
-                        studyRecord ->> '$.study.protocolSection.armsInterventionsModule.interventions[*].type'
-                    )) AS intervention_type,
-                    len(
-                        studyRecord ->> '$.study.protocolSection.armsInterventionsModule.armGroups[*]'
-                    ) AS number_of_arm_groups,
-                    len(
-                        studyRecord ->> '$.study.protocolSection.armsInterventionsModule.interventions[*]'
-                    ) AS number_of_interventions,
-                    studyRecord ->> '$.study.hasResults' as has_results,
-                    studyRecord ->> '$.study.protocolSection.sponsorCollaboratorsModule.leadSponsor.class' AS lead_sponsor_funding_source,
-                    studyRecord ->> '$.study.protocolSection.sponsorCollaboratorsModule.leadSponsor.name' AS lead_sponsor_name,
-                    list_sort(list_distinct(
-                        studyRecord ->> '$.study.protocolSection.sponsorCollaboratorsModule.collaborators[*].class'
-                    )) AS collaborators_classes,
-                    studyRecord ->> '$.study.protocolSection.statusModule.resultsFirstPostDateStruct.date' AS results_date,
-                    studyRecord ->> '$.study.protocolSection.statusModule.resultsFirstSubmitDate' AS results_rec_date,
-                    TRY_CAST(
-                        studyRecord -> '$.study.protocolSection.statusModule.dispFirstPostDateStruct.date' AS DATE
-                    ) AS disp_date,
-                    TRY_CAST(
-                        studyRecord -> '$.study.protocolSection.statusModule.dispFirstSubmitDate' AS DATE
-                    ) AS disp_submit_date,
-                    TRY_CAST(
-                        studyRecord -> '$.study.protocolSection.statusModule.dispFirstSubmitQcDate' AS DATE
-                    ) AS disp_qc_date,
-                    FROM
-                        cutoff_study_records
+                QUALIFY
+                    version_number = MAX(version_number) OVER (PARTITION BY nct_id)
             )
             SELECT
                 *,
+--## {{ begin:derived_columns }}
                 -- `list_distinct()` ensures that the list `location_country`
                 -- does not contain `NULL` elements (but can still be `NULL` or
                 -- `[]` itself).
@@ -202,9 +109,16 @@ COPY (
                     lead_sponsor_funding_source,
                     collaborators_classes
                 ) AS norm_funding_source_class,
+--## {{ end:derived_columns }}
             FROM
                 _extract
         )
+    -- Clustered by completion date so that the row group statistics of the
+    -- output cover narrow date ranges (as `stages/build_cthist_snapshots.py`).
+    ORDER BY
+        primary_completion_date NULLS LAST,
+        completion_date NULLS LAST,
+        nct_id NULLS LAST
 --%% FILTER replace("brick/[^']+?\.parquet", output.all)
-) TO 'brick/analysis-20130927/ctgov-studies-all.parquet' (FORMAT PARQUET)
+) TO 'brick/analysis-20130927/ctgov-studies-all.parquet' (FORMAT PARQUET, ROW_GROUP_SIZE 20000)
 --%% END
@@ -11,103 +11,151 @@
 --   inclusion criteria for HLACTs filtered within a given time period.
 --
 --   In particular, retrieves information about facilities and result reporting
---   from the AACT database.
+--   from the AACT database, as exported to Parquet by
+--   `sql/create_aact_parquet.sql`.
+--
+--   With `query.do_flowchart_count`, outputs the number of records left after
+--   each inclusion criterion instead (see
+--   `script/cthist_hlact_flowchart_partial_sql.sh`).
 --
 -- [% TAGS \[\% \%\] --%% %]
 --%% ## See § Templating… in `sql/README.md`.
 
-INSTALL postgres;
-
--- See `.env.template` for how to set up other connection parameters.
--- Make sure to start the database and source `.env` prior to running this SQL.
--- See `README.md` for how to set up the database.
---%%  FILTER replace('aact_20240430', aact.database.name || 'aact_20240430')
-ATTACH 'dbname=aact_20240430' AS pg (TYPE postgres);
---%%  END
-
-
 CREATE MACRO try_parse_date(date_str) AS (
     try_strptime(date_str, [ '%Y-%m-%d', '%Y-%m' ]) :: DATE
 );
 
---%% UNLESS query.do_select_count # {{{
-COPY (
-    SELECT
-        *
---%% ELSE
+--%% IF query.do_flowchart_count # {{{
+-- Cumulative count after each inclusion criterion (N0 is before any) and the
+-- change from the previous count, as in `brick/flowchart-counts/<key>.csv`.
+SELECT
+    key,
+    count,
+    count - LAG(count) OVER (ORDER BY key) AS delta
+FROM (
+    UNPIVOT (
+        SELECT
+            COUNT(*) AS "N0",
+            COUNT_IF(hlact_filter_first_recruitment_status) AS "N1",
+            COUNT_IF(hlact_filter_first_recruitment_status
+                 AND hlact_filter_start_date) AS "N2",
+            COUNT_IF(hlact_filter_first_recruitment_status
+                 AND hlact_filter_start_date
+                 AND hlact_filter_study_design) AS "N3",
+            COUNT_IF(hlact_filter_first_recruitment_status
+                 AND hlact_filter_start_date
+                 AND hlact_filter_study_design
+                 AND hlact_filter_phase) AS "N4",
+            COUNT_IF(hlact_filter_first_recruitment_status
+                 AND hlact_filter_start_date
+                 AND hlact_filter_study_design
+                 AND hlact_filter_phase
+                 AND hlact_filter_oversight) AS "N5",
+            COUNT_IF(hlact_filter_first_recruitment_status
+                 AND hlact_filter_start_date
+                 AND hlact_filter_study_design
+                 AND hlact_filter_phase
+                 AND hlact_filter_oversight
+                 AND hlact_filter_second_recruitment_status) AS "N6",
+            COUNT_IF(hlact_filter_first_recruitment_status
+                 AND hlact_filter_start_date
+                 AND hlact_filter_study_design
+                 AND hlact_filter_phase
+                 AND hlact_filter_oversight
+                 AND hlact_filter_second_recruitment_status
+                 AND hlact_filter_end_date) AS "N7",
+            COUNT_IF(hlact_filter_first_recruitment_status
+                 AND hlact_filter_start_date
+                 AND hlact_filter_study_design
+                 AND hlact_filter_phase
+                 AND hlact_filter_oversight
+                 AND hlact_filter_second_recruitment_status
+                 AND hlact_filter_end_date
+                 AND hlact_filter_verification_date) AS "N8",
+--%% ELSIF query.do_select_count
     SELECT
         '\[\% query.count_key_name || "default_key" \%\]' AS key,
         COUNT(*) AS count
---%% END ## query.do_select_count }}}
+--%% ELSE
+COPY (
+    SELECT
+        * EXCLUDE (
+            hlact_filter_first_recruitment_status,
+            hlact_filter_start_date,
+            hlact_filter_study_design,
+            hlact_filter_phase,
+            hlact_filter_oversight,
+            hlact_filter_second_recruitment_status,
+            hlact_filter_end_date,
+            hlact_filter_verification_date,
+        )
+--%% END ## query.do_flowchart_count }}}
     FROM
         (
             WITH
             _all AS (
+                -- Each inclusion criterion is a flag, true only when the
+                -- criterion holds (so NULLs exclude the record as they would
+                -- in a WHERE clause).
                 SELECT
-                    *
-                FROM
-                    read_parquet(
---%%                FILTER replace("brick/[^']+?\.parquet", output.all )
-                        'brick/analysis-20130927/ctgov-studies-all.parquet'
---%%                END
-                    )
-                WHERE
+                    *,
 --%%            FILTER replace("2008-01-01", date.start)
 --%%                FILTER replace("2012-09-01", date.stop )
-                    1 = 1 -- Needed for dynamic AND clauses
---%%            UNLESS query.disable_filter_first_recruitment_status # {{{
-                    AND overall_status != 'WITHDRAWN'
---%%            END ## query.disable_filter_first_recruitment_status }}}
---%%            UNLESS query.disable_filter_start_date # {{{
-                    AND (
-                        try_parse_date(primary_completion_date) :: DATE >= '2008-01-01'
-                        OR primary_completion_date IS NULL
-                        AND (
-                            try_parse_date(completion_date) :: DATE >= '2008-01-01'
-                            OR completion_date IS NULL
+                    coalesce(
+                        overall_status != 'WITHDRAWN'
+                    , false) AS hlact_filter_first_recruitment_status,
+                    coalesce(
+                        (
+                            try_parse_date(primary_completion_date) :: DATE >= '2008-01-01'
+                            OR primary_completion_date IS NULL
+                            AND (
+                                try_parse_date(completion_date) :: DATE >= '2008-01-01'
+                                OR completion_date IS NULL
+                            )
                         )
-                    )
 --%%                IF date.exists('initiated') # {{{
-                    AND (
-                        -- This is to accurately model the regulation which
-                        -- only comes into effect for trials on or after a
-                        -- certain start date.
-                        try_parse_date(start_date) :: DATE >= '\[\% date.initiated \%\]'
-                        OR start_date IS NULL
-                    )
+                        AND (
+                            -- This is to accurately model the regulation which
+                            -- only comes into effect for trials on or after a
+                            -- certain start date.
+                            try_parse_date(start_date) :: DATE >= '\[\% date.initiated \%\]'
+                            OR start_date IS NULL
+                        )
 --%%                END ## date.exists('initiated') }}}
---%%            END ## query.disable_filter_start_date }}}
---%%            UNLESS query.disable_filter_study_design # {{{
-                    AND study_type = 'INTERVENTIONAL'
---%%            END ## query.disable_filter_study_design }}}
---%%            UNLESS query.disable_filter_phase # {{{
-                    AND phase NOT IN ('EARLY_PHASE1', 'PHASE1')
---%%            END ## query.disable_filter_phase }}}
---%%            UNLESS query.disable_filter_second_recruitment_status # {{{
-                    AND overall_status IN ('TERMINATED', 'COMPLETED')
---%%            END ## query.disable_filter_second_recruitment_status }}}
---%%            UNLESS query.disable_filter_end_date # {{{
-                    AND (
+                    , false) AS hlact_filter_start_date,
+                    coalesce(
+                        study_type = 'INTERVENTIONAL'
+                    , false) AS hlact_filter_study_design,
+                    coalesce(
+                        phase NOT IN ('EARLY_PHASE1', 'PHASE1')
+                    , false) AS hlact_filter_phase,
+                    coalesce(
+                        overall_status IN ('TERMINATED', 'COMPLETED')
+                    , false) AS hlact_filter_second_recruitment_status,
+                    coalesce(
                         try_parse_date(primary_completion_date) :: DATE < '2012-09-01'
                         OR primary_completion_date IS NULL
                         AND (
                             try_parse_date(completion_date) :: DATE < '2012-09-01'
                             OR completion_date IS NULL
                         )
-                    )
---%%            END ## query.disable_filter_end_date }}}
---%%            UNLESS query.disable_filter_verification_date # {{{
-                    AND (
+                    , false) AS hlact_filter_end_date,
+                    coalesce(
                         primary_completion_date IS NOT NULL
                         OR completion_date IS NOT NULL
                         OR (
                             try_parse_date(verification_date) :: DATE >= '2008-01-01'
                             AND try_parse_date(verification_date) :: DATE < '2012-09-01'
                         )
-                    )
---%%            END ## query.disable_filter_verification_date }}}
+                    , false) AS hlact_filter_verification_date,
 --%%                END ## date.stop
 --%%            END ## date.start
+                FROM
+                    read_parquet(
+--%%                FILTER replace("brick/[^']+?\.parquet", output.all )
+                        'brick/analysis-20130927/ctgov-studies-all.parquet'
+--%%                END
+                    )
             ),
             aact AS (
                 SELECT
@@ -115,37 +163,80 @@ COPY (
                     any_value(v.has_us_facility) as has_us_facility,
                     any_value(disposition_first_submitted_date) as extension_date2,
                     any_value(f.country) as country,
+                -- Columns of the AACT tables exported by
+                -- `sql/create_aact_parquet.sql`.
+--%%            FILTER replace('aact_20240430', aact.database.name || 'aact_20240430')
                 FROM
-                    pg.ctgov.calculated_values v
-                    JOIN pg.ctgov.facilities f ON v.nct_id = f.nct_id
-                    JOIN pg.ctgov.studies s ON v.nct_id = s.nct_id
+                    read_parquet('brick/aact_20240430/ctgov/calculated_values.parquet') v
+                    JOIN read_parquet('brick/aact_20240430/ctgov/facilities.parquet') f ON v.nct_id = f.nct_id
+                    JOIN read_parquet('brick/aact_20240430/ctgov/studies.parquet') s ON v.nct_id = s.nct_id
+--%%            END
                 WHERE
                     v.has_us_facility IS NOT NULL
                 GROUP BY
                     f.nct_id
+            ),
+            _flags AS (
+                SELECT
+                    *,
+                    -- Records without AACT data are excluded by the
+                    -- oversight criterion.
+                    coalesce(
+                        ct.nct_id IS NOT NULL
+                        AND (
+                            (
+                                (is_fda_regulated_drug   = true AND primary_purpose = 'INTERVENTIONAL')
+                            OR  (is_fda_regulated_device = true)
+                            )
+                            AND a.has_us_facility = true
+                            OR ct.has_us_facility = true
+                        )
+                    , false) AS hlact_filter_oversight,
+                FROM
+                    _all a
+                    LEFT JOIN aact ct ON ct.nct_id = a.nct_id
             )
             SELECT
                 *
             FROM
-                _all a
---%%            UNLESS query.disable_filter_oversight # {{{
-                JOIN aact ct ON ct.nct_id = a.nct_id
---%%            END ## query.disable_filter_oversight }}}
+                _flags
             WHERE
                 1 = 1 -- Needed for dynamic AND clauses
---%%            UNLESS query.disable_filter_oversight # {{{
-                AND
-                (
-                    (is_fda_regulated_drug   = true AND primary_purpose = 'INTERVENTIONAL')
-                OR  (is_fda_regulated_device = true)
-                )
-                AND a.has_us_facility = true
-                OR ct.has_us_facility = true
---%%            END ## query.disable_filter_oversight }}}
+--%%        UNLESS query.do_flowchart_count # {{{
+--%%            UNLESS query.disable_filter_first_recruitment_status
+                AND hlact_filter_first_recruitment_status
+--%%            END
+--%%            UNLESS query.disable_filter_start_date
+                AND hlact_filter_start_date
+--%%            END
+--%%            UNLESS query.disable_filter_study_design
+                AND hlact_filter_study_design
+--%%            END
+--%%            UNLESS query.disable_filter_phase
+                AND hlact_filter_phase
+--%%            END
+--%%            UNLESS query.disable_filter_oversight
+                AND hlact_filter_oversight
+--%%            END
+--%%            UNLESS query.disable_filter_second_recruitment_status
+                AND hlact_filter_second_recruitment_status
+--%%            END
+--%%            UNLESS query.disable_filter_end_date
+                AND hlact_filter_end_date
+--%%            END
+--%%            UNLESS query.disable_filter_verification_date
+                AND hlact_filter_verification_date
+--%%            END
+--%%        END ## query.do_flowchart_count }}}
         )
---%% UNLESS query.do_select_count # {{{
+--%% IF query.do_flowchart_count # {{{
+    ) ON COLUMNS(*) INTO NAME key VALUE count
+)
+ORDER BY key
+--%% ELSIF query.do_select_count
+--%% ELSE
 --%%   FILTER replace("brick/[^']+?\.parquet", output.item('hlact-filtered') )
 ) TO 'brick/analysis-20130927/ctgov-studies-hlact.parquet' (FORMAT PARQUET)
 --%%   END ## FILTER
---%% END ## query.do_select_count }}}
+--%% END ## query.do_flowchart_count }}}
 --%% # vim: fdm=marker
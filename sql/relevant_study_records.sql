@@ -2,13 +2,13 @@ COPY (
     SELECT
         t1.*
     FROM
-        read_parquet ('work/all_study_records.parquet') AS t1
+        read_parquet ('work/all_study_records/*.parquet') AS t1
         JOIN (
             SELECT
                 nctid,
                 MAX(version_number) AS max_version
             FROM
-                read_parquet ('work/all_study_records.parquet')
+                read_parquet ('work/all_study_records/*.parquet')
             WHERE
                 version_date <= '2013-09-27'
             GROUP BY
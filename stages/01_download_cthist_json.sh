@@ -4,9 +4,6 @@ set -eu
 
 mkdir -p log
 
-JOB_PROCFILE=./log/job-procfile
-echo 3 > $JOB_PROCFILE
-
 #export CTHIST_DOWNLOAD_CUTOFF_DATE=2024-04-30
 
 ## Do not set `CTHIST_DOWNLOAD_CUTOFF_DATE` so that all record versions are
@@ -15,27 +12,21 @@ unset CTHIST_DOWNLOAD_CUTOFF_DATE
 
 export PGDATABASE_LATEST=aact_20240430
 
-duckdb -noheader -csv -c "$(cat <<EOF
+## The NCT IDs of the Anderson 2015 data and of AACT `ctgov.studies` are
+## downloaded by one harvester process, which limits the concurrency and rate
+## of all requests together (see `stages/harvest_cthist.py`).
+(
+	duckdb -noheader -csv -c "$(cat <<EOF
 	SELECT NCT_ID
 	FROM 'brick/anderson2015/proj_results_reporting_studies_Analysis_Data.parquet';
 EOF
-)" \
-	| parallel \
-		-j"$JOB_PROCFILE" \
-		--results log/01_download_cthist_json.anderson2015.par-results.csv \
-		--eta --bar \
-		-n1 \
-		'./stages/fetch-cthist-json.pl {}'
+)"
 
-(
 	make docker-compose-up >&2;
 	[ -r .env ] && . .env;
 	export PGDATABASE="$PGDATABASE_LATEST";
 	psql --csv -c 'SELECT nct_id FROM ctgov.studies' | awk 'NR > 1'
 ) \
-	| parallel \
-		-j"$JOB_PROCFILE" \
-		--results log/01_download_cthist_json.postgres_aact.par-results.csv \
-		--eta --bar \
-		-n1 \
-		'./stages/fetch-cthist-json.pl {}'
+	| python3 ./stages/harvest_cthist.py \
+		--packed-dir download/ctgov/historical-packed \
+		2> >(tee log/01_download_cthist_json.harvest.log >&2)
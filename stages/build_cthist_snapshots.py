@@ -0,0 +1,172 @@
+import argparse
+import re
+
+import yaml
+
+'''
+Build the `ctgov-studies-all.parquet` snapshots of every cut-off date in
+`params.yaml` in one pass over the record versions.
+
+This prints DuckDB SQL to pipe into `duckdb`. Each version of a study is
+valid from its `version_date` until the earliest `version_date` of any later
+version, so the version that `sql/create_cthist_all.sql` selects for a
+cut-off (the latest version dated on or before it) is the one whose validity
+interval contains the cut-off. A single range join of the versions with all
+cut-off dates gives every snapshot, written to
+
+    brick/ctgov/snapshots/cutoff=<date>/
+
+With `--key`, the SQL instead copies the snapshot of that parameter key to
+its `output.all`, with the same columns as `sql/create_cthist_all.sql`.
+The rows are sorted by the `--layout` columns (`LAYOUTS`) and written in row
+groups of `--row-group-size` rows, so that the min/max statistics of each row
+group cover a narrow range of completion dates.
+
+The funding source macro and the derived columns are taken from
+`sql/create_cthist_all.sql` so that both stay the same.
+
+With `--execute`, the SQL is run in-process (with the DuckDB settings of
+`MY_DUCKDB_MEMORY_LIMIT` and `MY_DUCKDB_TEMP_DIR`) instead of printed, so that
+it is logged with `PIPELINE_PROFILE_LOG` (see `stages/instrument.py`).
+'''
+
+VERSIONS = 'brick/ctgov/historical/versions/*/*.parquet'
+SNAPSHOTS = 'brick/ctgov/snapshots'
+TEMPLATE = 'sql/create_cthist_all.sql'
+
+# Sort orders of the `output.all` snapshots
+LAYOUTS = {
+    'completion_date': ['primary_completion_date', 'completion_date', 'nct_id'],
+    'nct_id':          ['nct_id'],
+}
+
+
+def sql_section(sql, begin, end):
+    '''
+    Lines between the `--## {{ begin:<begin> }}` and `--## {{ end:<end> }}`
+    markers.
+    '''
+    m = re.search(rf'^--## {{{{ begin:{begin} }}}}\n(.*?)^--## {{{{ end:{end} }}}}\n', sql, re.S | re.M)
+    if m is None:
+        raise ValueError(f'Missing section {begin}..{end} in {TEMPLATE}')
+    return m.group(1)
+
+
+def _quote(s):
+    return "'" + str(s).replace("'", "''") + "'"
+
+
+def read_params(path='params.yaml'):
+    with open(path) as f:
+        return yaml.safe_load(f)['param']
+
+
+def snapshots_sql(cutoffs, versions=VERSIONS, snapshots=SNAPSHOTS, template=TEMPLATE):
+    with open(template) as f:
+        sql = f.read()
+    cutoff_values = ',\n        '.join(f'({_quote(c)}::DATE)' for c in sorted(set(cutoffs)))
+    return f'''
+{sql_section(sql, 'normalize_funding_source_macro', 'normalize_funding_source_all')}
+CREATE TEMP TABLE cutoffs(cutoff) AS
+    VALUES
+        {cutoff_values};
+
+COPY (
+    WITH
+    versions AS (
+        SELECT
+            * EXCLUDE (change, studyRecord, source_file, nct_prefix),
+            -- Valid until the first date of a later version
+            MIN(version_date) OVER (
+                PARTITION BY nct_id
+                ORDER BY version_number
+                RANGE BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING
+            ) AS valid_to,
+        FROM read_parquet(
+            {_quote(versions)},
+            hive_partitioning = true
+        )
+        WHERE
+                nct_id IS NOT NULL
+            AND version_number IS NOT NULL
+            AND version_date IS NOT NULL
+    ),
+    _extract AS (
+        SELECT
+            c.cutoff,
+            v.* EXCLUDE (valid_to),
+        FROM cutoffs c
+        JOIN versions v
+            ON  v.version_date <= c.cutoff
+            AND (v.valid_to IS NULL OR c.cutoff < v.valid_to)
+    )
+    SELECT
+        *,
+{sql_section(sql, 'derived_columns', 'derived_columns')}
+    FROM
+        _extract
+) TO {_quote(snapshots)} (FORMAT PARQUET, PARTITION_BY (cutoff), OVERWRITE);
+'''
+
+
+def snapshot_copy_sql(cutoff, output, snapshots=SNAPSHOTS, layout='completion_date', row_group_size=20_000):
+    order_by = ', '.join(f'{col} NULLS LAST' for col in LAYOUTS[layout])
+    # A cut-off without any rows has no partition, so read all of them and
+    # let the filter on the partition column select the files
+    return f'''
+COPY (
+    SELECT
+        * EXCLUDE (cutoff)
+    FROM read_parquet(
+        {_quote(f'{snapshots}/*/*.parquet')},
+        hive_partitioning = true,
+        hive_types = {{'cutoff': DATE}}
+    )
+    WHERE cutoff = {_quote(cutoff)}::DATE
+    ORDER BY {order_by}
+) TO {_quote(output)} (FORMAT PARQUET, ROW_GROUP_SIZE {int(row_group_size)});
+'''
+
+
+def execute(sql, label):
+    import instrument
+    from run_templated_sql import Runner, connect, env_settings
+
+    con = connect(*env_settings())
+    try:
+        with instrument.span('main', label=label):
+            Runner(con, instrument.duckdb_profile_dir()).run(sql, label=label)
+    finally:
+        con.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Print SQL for the snapshots of all cut-off dates')
+    parser.add_argument('--params', default='params.yaml')
+    parser.add_argument('--key', help='copy the snapshot of this parameter key to its output.all')
+    parser.add_argument('--layout', choices=LAYOUTS, default='completion_date',
+                        help='sort order of the output.all rows')
+    parser.add_argument('--row-group-size', type=int, default=20_000)
+    parser.add_argument('--execute', action='store_true',
+                        help='run the SQL in DuckDB instead of printing it')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    params = read_params(args.params)
+    if args.key is None:
+        label = 'snapshots'
+        sql = snapshots_sql(p['date']['cutoff'] for p in params.values())
+    else:
+        if args.key not in params:
+            raise SystemExit(f'Missing parameter key {args.key} in {args.params}\n\n'
+                             f'Existing parameter keys are: {" ".join(params)}')
+        p = params[args.key]
+        label = args.key
+        sql = snapshot_copy_sql(p['date']['cutoff'], p['output']['all'],
+                                layout=args.layout, row_group_size=args.row_group_size)
+    if args.execute:
+        execute(sql, label)
+    else:
+        print(sql)
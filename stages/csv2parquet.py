@@ -1,37 +1,366 @@
-import pandas as pd
-import sys
+import argparse
+import hashlib
+import json
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import shutil
-
-InDirName = sys.argv[1]
-OutDirName = sys.argv[2]
-
-#create folder -> parquet split in 1 Gb
-try:
-    os.mkdir(OutDirName)
-except OSError:
-    shutil.rmtree(OutDirName)
-    os.mkdir(OutDirName)
-
-# navigate in folder and retieve only table of interest
-l_files_download = os.listdir(InDirName)
-for file_download in l_files_download:
-    file_path = Path(file_download)
-    in_file = os.path.join(InDirName, file_path)
-    file_ext = file_path.suffix
-    file_name = file_path.stem
-    if file_ext == ".xlsx":
-        xlsx = pd.ExcelFile(in_file, engine="openpyxl")
-        l_sheet = xlsx.sheet_names
-        for sheet in l_sheet:
-            out_file = os.path.join(OutDirName, f"{file_path.stem}_{sheet.replace(' ', '_')}.parquet")
-            df = pd.read_excel(in_file, sheet_name=sheet, dtype=str, engine="openpyxl")
-            df.to_parquet(out_file)
-    elif file_ext == ".txt":
-        out_file = os.path.join(OutDirName, file_path.with_suffix(".parquet"))
-        df = pd.read_csv(in_file, sep="\t", encoding='unicode_escape',
-                         low_memory=False, on_bad_lines='skip')
-        df.to_parquet(out_file)
-
-print(f"csv2parquet: Converting file {InDirName}")
+
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import instrument
+
+'''
+Convert the Anderson 2015 `.txt` (TSV) and `.xlsx` downloads to Parquet.
+
+Each TSV and each Excel sheet is streamed in chunks of `--chunksize` rows
+into a ZSTD-compressed Parquet file (one row group per chunk), so memory
+use does not grow with the size of the input. Files and sheets are
+converted in parallel.
+
+Columns are typed by `SCHEMAS`. Other TSV columns take the type that
+`pd.read_csv` infers from the whole file, found in a first pass over the
+chunks (`infer_types()`); other Excel columns are strings.
+
+Reruns are incremental: `MANIFEST` in the output directory records the
+size, mtime and hash of every input (and a hash of every Excel sheet), and
+only changed inputs or sheets are converted again. Outputs of inputs that
+no longer exist are removed. Every Parquet file is written to a temporary
+file first and renamed into place once complete.
+
+With `PIPELINE_PROFILE_LOG` set, the stage and each conversion are logged
+with their row and byte counts (see `stages/instrument.py`).
+'''
+
+MANIFEST = '.csv2parquet-manifest.json'
+
+# Declared column types per output file stem (`<file>` for TSVs,
+# `<file>_<sheet>` for Excel sheets).
+SCHEMAS = {
+    'proj_results_reporting_studies_Analysis_Data': {
+        'NCT_ID':                 pa.string(),
+        'ENROLLMENT':             pa.int64(),
+        'NUMBER_OF_ARMS':         pa.int64(),
+        'mntopcom':               pa.float64(),
+        'start_year':             pa.int64(),
+        'p_completion_year':      pa.int64(),
+        'completion_year':        pa.int64(),
+        'verification_year':      pa.int64(),
+        'resultsreceived_year':   pa.int64(),
+        # The other `*_month` columns are month names.
+        'resultsreceived_month':  pa.int64(),
+    },
+}
+
+
+# Values `pd.read_csv` reads as booleans
+BOOL_VALUES = {'True': True, 'TRUE': True, 'true': True,
+               'False': False, 'FALSE': False, 'false': False}
+
+
+def schema_for(stem, columns, inferred=None):
+    types = dict(inferred or {})
+    types.update(SCHEMAS.get(stem, {}))
+    return pa.schema([(col, types.get(col, pa.string())) for col in columns])
+
+
+def _value_type(s):
+    kind = pd.api.types.infer_dtype(s, skipna=True)
+    if kind == 'empty':
+        return None
+    if kind == 'boolean':
+        return pa.bool_()
+    if kind == 'integer':
+        return pa.int64()
+    if kind in ('floating', 'mixed-integer-float'):
+        return pa.float64()
+    return pa.string()
+
+
+def infer_types(chunks):
+    '''
+    Arrow types of the columns of `chunks` (read by `pd.read_csv` without
+    `dtype`), as `pd.read_csv` infers them from the whole file: integer
+    columns with missing values and empty columns are float64, columns of
+    mixed types are strings.
+    '''
+    types, has_nulls = {}, set()
+    for df in chunks:
+        for col in df.columns:
+            s = df[col]
+            if s.isna().any():
+                has_nulls.add(col)
+            t = _value_type(s)
+            prev = types.setdefault(col, t)
+            if prev is None or t is None or prev == t:
+                types[col] = prev or t
+            elif {prev, t} == {pa.int64(), pa.float64()}:
+                types[col] = pa.float64()
+            else:
+                types[col] = pa.string()
+    for col, t in types.items():
+        if t is None or (t == pa.int64() and col in has_nulls):
+            types[col] = pa.float64()
+    return types
+
+
+def to_arrow(df, schema):
+    '''
+    Convert a chunk of string columns to a table with `schema`.
+
+    Values of numeric columns that do not parse become null; values that do
+    not fit the declared type (e.g. 2.5 for an int64 column) raise.
+    '''
+    arrays = []
+    for field in schema:
+        s = df[field.name]
+        if pa.types.is_string(field.type):
+            arrays.append(pa.array(s.astype(object), type=pa.string(), from_pandas=True))
+        elif pa.types.is_integer(field.type) or pa.types.is_floating(field.type):
+            values = pd.to_numeric(s, errors='coerce')
+            arrays.append(pa.array(values, from_pandas=True).cast(field.type))
+        elif pa.types.is_boolean(field.type):
+            values = s.map(BOOL_VALUES).astype(object)
+            arrays.append(pa.array(values, type=pa.bool_(), from_pandas=True))
+        elif pa.types.is_date(field.type) or pa.types.is_timestamp(field.type):
+            values = pd.to_datetime(s, errors='coerce')
+            arrays.append(pa.array(values, from_pandas=True).cast(field.type))
+        else:
+            raise TypeError(f'Unsupported type {field.type} for column {field.name}')
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_chunks(out_file, schema, chunks, chunksize):
+    '''
+    Returns the number of rows written.
+    '''
+    n_rows = 0
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(out_file), prefix='.', suffix='.parquet.tmp')
+    os.close(fd)
+    try:
+        with pq.ParquetWriter(tmp_file, schema, compression='zstd') as writer:
+            n_chunks = 0
+            for n_chunks, df in enumerate(chunks, start=1):
+                writer.write_table(to_arrow(df, schema), row_group_size=chunksize)
+                n_rows += len(df)
+            if not n_chunks:
+                # Empty inputs still get a file with the header's columns
+                writer.write_table(schema.empty_table())
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    return n_rows
+
+
+def convert_tsv(in_file, out_file, chunksize, prev_hash=None):
+    read_kwargs = dict(sep='\t', encoding='unicode_escape', dtype=str, on_bad_lines='skip')
+    columns = pd.read_csv(in_file, nrows=0, **read_kwargs).columns
+    with instrument.span('convert_tsv', file=out_file) as s:
+        with pd.read_csv(in_file, chunksize=chunksize, **dict(read_kwargs, dtype=None)) as reader:
+            schema = schema_for(Path(out_file).stem, columns, infer_types(reader))
+        with pd.read_csv(in_file, chunksize=chunksize, **read_kwargs) as reader:
+            s.add(rows_out=write_chunks(out_file, schema, reader, chunksize),
+                  bytes_read=instrument.file_bytes(in_file),
+                  bytes_written=instrument.file_bytes(out_file))
+    return out_file, None, True
+
+
+def _sheet_header(row):
+    # Same column names as `pd.read_excel`: blanks become `Unnamed: <i>`,
+    # repeated names get a `.<n>` suffix.
+    columns, seen = [], {}
+    for i, name in enumerate(row):
+        name = f'Unnamed: {i}' if name is None else str(name)
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        columns.append(name)
+    return columns
+
+
+def _sheet_chunks(rows, columns, chunksize):
+    chunk, blank = [], []
+    for row in rows:
+        row = [None if v is None else str(v) for v in row[:len(columns)]]
+        row += [None] * (len(columns) - len(row))
+        # Trailing blank rows are dropped, as in `pd.read_excel`
+        if all(v is None for v in row):
+            blank.append(row)
+            continue
+        chunk += blank
+        blank = []
+        chunk.append(row)
+        if len(chunk) >= chunksize:
+            yield pd.DataFrame(chunk, columns=columns)
+            chunk = []
+    if chunk:
+        yield pd.DataFrame(chunk, columns=columns)
+
+
+def _sheet_rows(in_file, sheet):
+    wb = openpyxl.load_workbook(in_file, read_only=True, data_only=True)
+    try:
+        yield from wb[sheet].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def sheet_hash(in_file, sheet):
+    h = hashlib.sha256()
+    for row in _sheet_rows(in_file, sheet):
+        h.update(repr(row).encode())
+    return h.hexdigest()
+
+
+def convert_sheet(in_file, sheet, out_file, chunksize, prev_hash=None):
+    '''
+    Returns (out_file, hash of the sheet, whether it was converted).
+
+    A sheet whose hash equals `prev_hash` is not converted again when its
+    output exists, e.g. when only another sheet of the workbook changed.
+    '''
+    digest = sheet_hash(in_file, sheet)
+    if digest == prev_hash and os.path.exists(out_file):
+        return out_file, digest, False
+
+    with instrument.span('convert_sheet', file=out_file) as s:
+        rows = _sheet_rows(in_file, sheet)
+        columns = _sheet_header(next(rows, ()))
+        schema = schema_for(Path(out_file).stem, columns)
+        s.add(rows_out=write_chunks(out_file, schema, _sheet_chunks(rows, columns, chunksize), chunksize),
+              bytes_read=instrument.file_bytes(in_file),
+              bytes_written=instrument.file_bytes(out_file))
+    return out_file, digest, True
+
+
+def list_conversions(file_path, out_dir):
+    '''
+    Returns a list of (function, args, out_file) for one input.
+    '''
+    if file_path.suffix == '.xlsx':
+        wb = openpyxl.load_workbook(file_path, read_only=True)
+        sheets = wb.sheetnames
+        wb.close()
+        out_files = [str(Path(out_dir) / f"{file_path.stem}_{sheet.replace(' ', '_')}.parquet")
+                     for sheet in sheets]
+        return [(convert_sheet, (str(file_path), sheet, out_file), out_file)
+                for sheet, out_file in zip(sheets, out_files)]
+    elif file_path.suffix == '.txt':
+        out_file = str(Path(out_dir) / file_path.with_suffix('.parquet').name)
+        return [(convert_tsv, (str(file_path), out_file), out_file)]
+    return []
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def converter_version():
+    # Changes to this script (e.g. to `SCHEMAS`) rebuild every output
+    return file_hash(__file__)
+
+
+def load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('converter') != converter_version():
+        return {}
+    return manifest.get('inputs', {})
+
+
+def save_manifest(out_dir, inputs):
+    fd, tmp_file = tempfile.mkstemp(dir=out_dir, prefix='.', suffix='.json.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'converter': converter_version(), 'inputs': inputs}, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, os.path.join(out_dir, MANIFEST))
+
+
+def is_current(entry, stamp, out_dir):
+    return (entry is not None and entry['stamp'] == stamp
+            and all(os.path.exists(os.path.join(out_dir, out)) for out in entry['outputs']))
+
+
+def remove_stale(out_dir, inputs):
+    keep = {out for entry in inputs.values() for out in entry['outputs']}
+    for path in Path(out_dir).iterdir():
+        # Temporary files are left behind by interrupted runs
+        if (path.suffix == '.parquet' and path.name not in keep) or path.name.endswith('.tmp'):
+            print(f"csv2parquet: Removing {path}")
+            path.unlink()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Convert TSV and Excel files to Parquet')
+    parser.add_argument('in_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='number of worker processes (0 = one per CPU)')
+    parser.add_argument('--chunksize', type=int, default=100_000,
+                        help='rows per chunk and per Parquet row group')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(f"csv2parquet: Converting file {args.in_dir}")
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    with instrument.span('main', in_dir=args.in_dir) as stage:
+        prev_inputs = load_manifest(args.out_dir)
+        inputs, pending = {}, {}
+        for file_path in sorted(Path(args.in_dir).iterdir()):
+            conversions = list_conversions(file_path, args.out_dir)
+            if not conversions:
+                continue
+            st = file_path.stat()
+            stamp = [st.st_size, st.st_mtime_ns]
+            entry = prev_inputs.get(file_path.name)
+            if is_current(entry, stamp, args.out_dir):
+                inputs[file_path.name] = entry
+                continue
+
+            digest = file_hash(file_path)
+            if entry is not None and entry['sha256'] == digest:
+                entry = dict(entry, stamp=stamp)
+                if is_current(entry, stamp, args.out_dir):
+                    inputs[file_path.name] = entry
+                    continue
+            prev_outputs = entry['outputs'] if entry is not None else {}
+            # Outputs are added to the manifest as they are written
+            inputs[file_path.name] = {'stamp': stamp, 'sha256': digest, 'outputs': {}}
+            pending[file_path.name] = [(func, func_args,
+                                        prev_outputs.get(os.path.basename(out_file), {}).get('sheet_sha256'))
+                                       for func, func_args, out_file in conversions]
+
+        try:
+            with ProcessPoolExecutor(max_workers=args.jobs or None) as executor:
+                futures = {executor.submit(func, *func_args, args.chunksize, prev_hash): name
+                           for name, conversions in pending.items()
+                           for func, func_args, prev_hash in conversions}
+                for future, name in futures.items():
+                    out_file, digest, converted = future.result()
+                    print(f"csv2parquet: {'Wrote' if converted else 'Unchanged'} {out_file}")
+                    stage.add(converted=int(converted))
+                    inputs[name]['outputs'][os.path.basename(out_file)] = (
+                        {'sheet_sha256': digest} if digest is not None else {})
+        finally:
+            # Inputs that failed keep an incomplete entry and are converted again
+            for name, conversions in pending.items():
+                if len(inputs[name]['outputs']) < len(conversions):
+                    inputs[name]['stamp'] = None
+            save_manifest(args.out_dir, inputs)
+
+        remove_stale(args.out_dir, inputs)
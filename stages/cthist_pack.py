@@ -0,0 +1,263 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import re
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import zstandard
+
+'''
+Pack the historical study record JSONL files into one zstd-compressed shard
+per NCT prefix, and read study records back from the shards.
+
+Input is the tree written by `stages/harvest_cthist.py`:
+
+    download/ctgov/historical/<NCT prefix>/<NCT ID>.jsonl
+
+and output is one file per prefix directory:
+
+    download/ctgov/historical-packed/<NCT prefix>.jsonl.zst
+
+Each study is a separate zstd frame, so a shard is a valid zstd stream of
+all its JSONL (`zstd -dc NCT000.jsonl.zst` streams every study). The offset
+index of the frames is stored in a zstd skippable frame at the end of the
+shard, which ends with a footer to find it:
+
+    <frame per study> ... <skippable frame: index JSON, u64 index length, FOOTER_MAGIC>
+
+The index maps each NCT ID to the offset and length of its frame, and the
+size, mtime and SHA-256 of the JSONL file it was packed from.
+
+Reruns are incremental: only studies whose JSONL changed are compressed
+again; the frames of the other studies are copied. Studies without a JSONL
+file (e.g. after `--remove-source`) are kept. Each shard is written to a
+temporary file and renamed into place.
+
+`PackedStore` reads the shards: `nct_id in store` and `read(nct_id)` for
+random access to one study and `iter_studies()` to stream all of them. It
+opens (and reads the index of) each shard once, so the shards must not be
+rewritten while it is in use.
+'''
+
+SUFFIX = '.jsonl.zst'
+FOOTER_MAGIC = b'CTHPACK1'
+# First of the 16 zstd skippable frame magic numbers
+SKIPPABLE_MAGIC = 0x184D2A50
+
+nct_dir_re = re.compile(r'^NCT\d*$')
+
+
+class PackError(Exception):
+    pass
+
+
+def data_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _index_frame(index):
+    data = json.dumps(index, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    footer = struct.pack('<Q', len(data)) + FOOTER_MAGIC
+    return struct.pack('<II', SKIPPABLE_MAGIC, len(data) + len(footer)) + data + footer
+
+
+def read_index(f):
+    '''
+    Index of the shard open as the binary file `f`.
+    '''
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    if end < 16:
+        raise PackError(f'{f.name}: too short for a shard')
+    f.seek(end - 16)
+    length, magic = struct.unpack('<Q8s', f.read(16))
+    if magic != FOOTER_MAGIC or length + 24 > end:
+        raise PackError(f'{f.name}: missing index footer')
+    f.seek(end - 16 - length - 8)
+    frame_magic, frame_length = struct.unpack('<II', f.read(8))
+    if frame_magic != SKIPPABLE_MAGIC or frame_length != length + 16:
+        raise PackError(f'{f.name}: bad index frame')
+    return json.loads(f.read(length))
+
+
+class PackedShard:
+    '''
+    The shard of one NCT prefix.
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        self.prefix = self.path.name[:-len(SUFFIX)]
+        with open(self.path, 'rb') as f:
+            self.index = read_index(f)
+        self._dctx = zstandard.ZstdDecompressor()
+
+    def __contains__(self, nct_id):
+        return nct_id in self.index
+
+    def nct_ids(self):
+        return sorted(self.index)
+
+    def read_frame(self, nct_id, f=None):
+        '''
+        The compressed frame of `nct_id`.
+        '''
+        entry = self.index[nct_id]
+        if f is None:
+            with open(self.path, 'rb') as f:
+                return self.read_frame(nct_id, f)
+        f.seek(entry['offset'])
+        return f.read(entry['length'])
+
+    def read(self, nct_id, f=None):
+        '''
+        The JSONL of `nct_id` (bytes).
+        '''
+        return self._dctx.decompress(self.read_frame(nct_id, f),
+                                     max_output_size=self.index[nct_id]['size'])
+
+    def iter_studies(self):
+        '''
+        Yields (NCT ID, JSONL bytes) of every study in file order.
+        '''
+        with open(self.path, 'rb') as f:
+            for nct_id in sorted(self.index, key=lambda n: self.index[n]['offset']):
+                yield nct_id, self.read(nct_id, f)
+
+
+class PackedStore:
+    '''
+    The shards in `pack_dir`.
+    '''
+    def __init__(self, pack_dir):
+        self.pack_dir = Path(pack_dir)
+
+    @staticmethod
+    def is_packed(path):
+        return any(Path(path).glob(f'NCT*{SUFFIX}'))
+
+    def prefixes(self):
+        return sorted(p.name[:-len(SUFFIX)] for p in self.pack_dir.glob(f'NCT*{SUFFIX}'))
+
+    def shard_path(self, prefix):
+        return self.pack_dir / f'{prefix}{SUFFIX}'
+
+    @functools.lru_cache(maxsize=None)
+    def shard(self, prefix):
+        '''
+        The shard of `prefix`, or None if there is none.
+        '''
+        path = self.shard_path(prefix)
+        return PackedShard(path) if path.exists() else None
+
+    def __contains__(self, nct_id):
+        shard = self.shard(nct_id[:6])
+        return shard is not None and nct_id in shard
+
+    def read(self, nct_id):
+        '''
+        The JSONL of `nct_id` (bytes), or None if it is not packed.
+        '''
+        return self.shard(nct_id[:6]).read(nct_id) if nct_id in self else None
+
+    def iter_studies(self):
+        for prefix in self.prefixes():
+            yield from self.shard(prefix).iter_studies()
+
+    def iter_lines(self):
+        '''
+        Yields (NCT ID, line) for every JSONL line of every study.
+        '''
+        for nct_id, data in self.iter_studies():
+            for line in data.splitlines():
+                if line.strip():
+                    yield nct_id, line
+
+
+def pack_prefix(in_dir, pack_dir, level=19, remove_source=False):
+    '''
+    Bring the shard of the prefix directory `in_dir` up to date.
+
+    Returns (prefix, number of studies compressed, number of studies in shard).
+    '''
+    in_dir, pack_dir = Path(in_dir), Path(pack_dir)
+    path = pack_dir / f'{in_dir.name}{SUFFIX}'
+    try:
+        old = PackedShard(path)
+    except (OSError, PackError):
+        old = None
+    old_index = old.index if old is not None else {}
+
+    sources = {p.name[:-len('.jsonl')]: p for p in in_dir.glob('NCT*.jsonl')}
+    cctx = zstandard.ZstdCompressor(level=level, write_content_size=True)
+    index, n_compressed, offset = {}, 0, 0
+    fd, tmp_path = tempfile.mkstemp(dir=pack_dir, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out, \
+                open(old.path if old else os.devnull, 'rb') as old_f:
+            for nct_id in sorted(set(sources) | set(old_index)):
+                prev = old_index.get(nct_id)
+                source = sources.get(nct_id)
+                if source is not None:
+                    st = source.stat()
+                    stamp = [st.st_size, st.st_mtime_ns]
+                if source is None or prev is not None and prev['stamp'] == stamp:
+                    entry, frame = dict(prev), old.read_frame(nct_id, old_f)
+                else:
+                    data = source.read_bytes()
+                    digest = data_hash(data)
+                    if prev is not None and prev['sha256'] == digest:
+                        frame = old.read_frame(nct_id, old_f)
+                    else:
+                        frame = cctx.compress(data)
+                        n_compressed += 1
+                    entry = {'size': len(data), 'sha256': digest, 'stamp': stamp}
+                entry.update(offset=offset, length=len(frame))
+                out.write(frame)
+                offset += len(frame)
+                index[nct_id] = entry
+            out.write(_index_frame(index))
+        if index != old_index or old is None:
+            os.replace(tmp_path, path)
+        else:
+            os.unlink(tmp_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    if remove_source:
+        for source in sources.values():
+            source.unlink()
+    return in_dir.name, n_compressed, len(index)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Pack historical study record JSONL into zstd shards')
+    parser.add_argument('in_dir', nargs='?', default='download/ctgov/historical')
+    parser.add_argument('pack_dir', nargs='?', default='download/ctgov/historical-packed')
+    parser.add_argument('--level', type=int, default=19, help='zstd compression level')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='number of worker processes (0 = one per CPU)')
+    parser.add_argument('--remove-source', action='store_true',
+                        help='remove the JSONL files once packed')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    in_dir, pack_dir = Path(args.in_dir), Path(args.pack_dir)
+    prefixes = sorted(p.name for p in in_dir.iterdir() if p.is_dir() and nct_dir_re.match(p.name))
+    pack_dir.mkdir(parents=True, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.jobs or None) as executor:
+        futures = [executor.submit(pack_prefix, in_dir / prefix, pack_dir, args.level,
+                                   args.remove_source)
+                   for prefix in prefixes]
+        for future in futures:
+            prefix, n_compressed, n_studies = future.result()
+            if n_compressed:
+                print(f"cthist_pack: {prefix}: compressed {n_compressed} of {n_studies} studies")
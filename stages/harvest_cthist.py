@@ -0,0 +1,391 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+import aiohttp
+
+from cthist_pack import PackedStore
+
+'''
+Download the version history of ClinicalTrials.gov study records, as
+`stages/fetch-cthist-json.pl` does for one NCT ID, for many NCT IDs in one
+process.
+
+NCT IDs are read (one per line) from the given files or standard input.
+All requests go through one pooled HTTP client with a global limit on the
+number of requests in flight (`--concurrency`) and on the request rate
+(`--rate`). Failed requests (network errors, HTTP 429 and 5xx) are retried
+with exponential backoff.
+
+The output is the same canonical JSON Lines as `fetch-cthist-json.pl`:
+
+    download/ctgov/historical/<NCT prefix>/<NCT ID>.jsonl
+
+with one line per version, `{"change": ..., "studyRecord": ...}`, or a
+single line with a `null` change for studies without a version history.
+
+Only the versions missing from an existing file are fetched, and the file
+is rewritten (atomically) every `--flush-every` versions, so an interrupted
+run resumes where it stopped. As with `fetch-cthist-json.pl`, the list of
+versions of a study that already has a file is not fetched again unless
+`--refresh-history` is given.
+
+With `--packed-dir`, a study without a JSONL file is loaded from the shards
+of `stages/cthist_pack.py`, so that the JSONL files that were packed (and
+removed) are not downloaded again.
+
+`--base-url` (or `CTHIST_API_BASE_URL`) points the harvester at another
+server, e.g. a local stand-in for testing.
+'''
+
+BASE_URL = 'https://clinicaltrials.gov/api/int/studies'
+OUT_DIR = 'download/ctgov/historical'
+
+NCT_ID_RE = re.compile(r'\ANCT[0-9]{8}\Z')
+NO_HISTORY_RE = re.compile(r'\ANo study \w+ history summary\Z')
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def _log(*msg):
+    print(*msg, file=sys.stderr)
+
+
+class NoHistory(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    def __init__(self, url, status, text):
+        super().__init__(f'Failed to download {url}: HTTP {status}')
+        self.status = status
+        self.text = text
+
+
+def encode_line(obj):
+    '''
+    Canonical JSON (sorted keys, no whitespace, UTF-8) as written by
+    `Cpanel::JSON::XS->new->utf8->canonical`.
+    '''
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False) + '\n'
+
+
+class StudyRecords:
+    '''
+    The versions of one study: `changes` and `studies` keyed by version
+    number, or `latest` for a study without a version history.
+    '''
+    def __init__(self):
+        self.changes = {}
+        self.studies = {}
+        self.latest = None
+
+    @property
+    def history_available(self):
+        return bool(self.changes) or bool(self.studies)
+
+    @property
+    def number_of_studies(self):
+        if self.history_available:
+            return len(self.changes)
+        return 1 if self.latest is not None else 0
+
+    def add_versions_data(self, versions):
+        for change in versions['changes']:
+            self.changes[change['version']] = change
+
+    def add_study_record(self, study_record):
+        self.studies[study_record['studyVersion']] = study_record
+
+    @classmethod
+    def from_lines(cls, lines):
+        records = cls()
+        for line in lines:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            change, study_record = row.get('change'), row.get('studyRecord')
+            if change is None:
+                records.latest = study_record
+                continue
+            records.changes[change['version']] = change
+            if study_record is not None:
+                records.add_study_record(study_record)
+        return records
+
+    def to_lines(self):
+        if not self.history_available:
+            return [encode_line({'change': None, 'studyRecord': self.latest})]
+        return [
+            encode_line({'change': self.changes.get(v), 'studyRecord': self.studies.get(v)})
+            for v in sorted(set(self.changes) | set(self.studies))
+        ]
+
+    def versions_to_fetch(self, cutoff_date=None):
+        '''
+        Change versions (only the latest one on or before `cutoff_date` if
+        given) that have no study record yet.
+        '''
+        versions = sorted(self.changes)
+        if cutoff_date is not None:
+            # ISO 8601 dates compare as strings
+            before = [v for v in versions if self.changes[v]['date'] <= cutoff_date]
+            versions = before[-1:]
+        return [v for v in versions if v not in self.studies]
+
+
+class Store:
+    def __init__(self, out_dir, packed_dir=None):
+        self.out_dir = Path(out_dir)
+        self.packed = PackedStore(packed_dir) if packed_dir is not None else None
+
+    def path(self, nctid):
+        return self.out_dir / nctid[:6] / f'{nctid}.jsonl'
+
+    def exists(self, nctid):
+        return self.path(nctid).exists() or self.packed is not None and nctid in self.packed
+
+    def load(self, nctid):
+        try:
+            with open(self.path(nctid), encoding='utf-8') as f:
+                return StudyRecords.from_lines(f)
+        except FileNotFoundError:
+            pass
+        data = self.packed.read(nctid) if self.packed is not None else None
+        if data is not None:
+            return StudyRecords.from_lines(data.decode('utf-8').splitlines())
+        return StudyRecords()
+
+    def store(self, nctid, records):
+        path = self.path(nctid)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.writelines(records.to_lines())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class RateLimiter:
+    '''
+    Spaces the start of requests at least `1 / rate` seconds apart.
+    '''
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = self._next
+            self._next = now + self.interval
+
+
+class CTGovAPI:
+    def __init__(self, session, base_url=BASE_URL, concurrency=8, rate=10,
+                 retries=5, backoff=1.0):
+        self.session = session
+        self.base_url = base_url.rstrip('/')
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.n_requests = 0
+
+    async def _fetch_json(self, url):
+        for attempt in range(self.retries + 1):
+            delay = None
+            async with self.semaphore:
+                await self.limiter.wait()
+                _log(f'Fetching <{url}>')
+                self.n_requests += 1
+                try:
+                    async with self.session.get(url) as res:
+                        if res.status == 200:
+                            return await res.json(content_type=None)
+                        text = await res.text()
+                        if res.status not in RETRY_STATUS or attempt == self.retries:
+                            raise HTTPError(url, res.status, text)
+                        _log(f'Retrying <{url}>: HTTP {res.status}')
+                        retry_after = res.headers.get('Retry-After', '')
+                        if retry_after.isdigit():
+                            delay = int(retry_after)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.retries:
+                        raise
+                    _log(f'Retrying <{url}>: {e!r}')
+            if delay is None:
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+            await asyncio.sleep(delay)
+
+    async def get_versions(self, nctid):
+        try:
+            return await self._fetch_json(f'{self.base_url}/{nctid}/history')
+        except HTTPError as e:
+            if NO_HISTORY_RE.match(e.text.strip()):
+                raise NoHistory(f'No study history for {nctid}') from e
+            raise
+
+    async def get_study_record_version(self, nctid, version):
+        return await self._fetch_json(f'{self.base_url}/{nctid}/history/{version}')
+
+    async def get_study_record_latest(self, nctid):
+        return await self._fetch_json(f'{self.base_url}/{nctid}')
+
+
+async def harvest_study(api, store, nctid, cutoff_date=None, refresh_history=False,
+                        only_check_for_file=False, flush_every=10):
+    '''
+    Fetch the missing versions of `nctid` into the store.
+
+    Returns the number of study records fetched.
+    '''
+    if only_check_for_file and store.exists(nctid):
+        return 0
+    records = store.load(nctid)
+    if records.number_of_studies == 0 or refresh_history and records.history_available:
+        _log(f'{nctid}: Fetching versions')
+        try:
+            records.add_versions_data(await api.get_versions(nctid))
+        except NoHistory as e:
+            _log(f'No version history for NCT ID {nctid}: {e}')
+
+    if not records.history_available:
+        _log(f'{nctid}: using latest data')
+        if records.latest is None:
+            records.latest = await api.get_study_record_latest(nctid)
+            store.store(nctid, records)
+            return 1
+        return 0
+
+    versions = records.versions_to_fetch(cutoff_date)
+    _log(f'{nctid}: using historical data')
+    _log(f'{nctid}: number of versions: {records.number_of_studies}')
+    _log(f'{nctid}: number of versions to fetch: {len(versions)}')
+    fetched = 0
+    for i in range(0, len(versions), flush_every):
+        batch = versions[i:i + flush_every]
+        results = await asyncio.gather(
+            *(api.get_study_record_version(nctid, v) for v in batch),
+            return_exceptions=True)
+        study_records = [r for r in results if not isinstance(r, BaseException)]
+        for study_record in study_records:
+            records.add_study_record(study_record)
+        fetched += len(study_records)
+        # Also keep the versions fetched before an error
+        if study_records:
+            _log(f'{nctid}: Writing: ' + ' '.join(map(str, sorted(records.studies))))
+            store.store(nctid, records)
+        if len(study_records) < len(results):
+            raise next(r for r in results if isinstance(r, BaseException))
+    return fetched
+
+
+def read_nctids(files):
+    seen = set()
+    for f in files:
+        for line in f:
+            nctid = line.strip()
+            if not nctid or nctid in seen:
+                continue
+            if not NCT_ID_RE.match(nctid):
+                _log(f'Skipping invalid NCT ID {nctid!r}')
+                continue
+            seen.add(nctid)
+            yield nctid
+
+
+async def harvest(nctids, out_dir=OUT_DIR, base_url=BASE_URL, concurrency=8, rate=10,
+                  retries=5, timeout=60, cutoff_date=None, refresh_history=False,
+                  only_check_for_file=False, flush_every=10, backoff=1.0, packed_dir=None):
+    '''
+    Returns the list of NCT IDs that failed.
+    '''
+    store = Store(out_dir, packed_dir)
+    failed = []
+    done = 0
+    queue = asyncio.Queue()
+    for nctid in nctids:
+        queue.put_nowait(nctid)
+    total = queue.qsize()
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout,
+                                     raise_for_status=False) as session:
+        api = CTGovAPI(session, base_url, concurrency, rate, retries, backoff)
+
+        async def worker():
+            nonlocal done
+            while not queue.empty():
+                nctid = queue.get_nowait()
+                try:
+                    await harvest_study(api, store, nctid, cutoff_date, refresh_history,
+                                        only_check_for_file, flush_every)
+                except Exception as e:
+                    _log(f'{nctid}: failed: {e}')
+                    failed.append(nctid)
+                done += 1
+                if done % 100 == 0 or done == total:
+                    _log(f'harvest_cthist: {done}/{total} studies, {api.n_requests} requests')
+
+        # Enough studies in progress to keep all request slots busy
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, total) or 1)))
+    return failed
+
+
+def _cutoff_date(value):
+    if not re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+        raise argparse.ArgumentTypeError(f'expected YYYY-MM-DD, got {value!r}')
+    return value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Download the version history of study records')
+    parser.add_argument('nctid_files', nargs='*', type=argparse.FileType('r'),
+                        help='files with one NCT ID per line (default: standard input)')
+    parser.add_argument('--out-dir', default=OUT_DIR)
+    parser.add_argument('--packed-dir', help='also load existing studies from these packed shards')
+    parser.add_argument('--base-url', default=os.environ.get('CTHIST_API_BASE_URL', BASE_URL))
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight')
+    parser.add_argument('--rate', type=float, default=10, help='requests per second (0 = no limit)')
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds per request')
+    parser.add_argument('--flush-every', type=int, default=10,
+                        help='rewrite the JSONL file after this many versions')
+    parser.add_argument('--cutoff-date', type=_cutoff_date,
+                        default=os.environ.get('CTHIST_DOWNLOAD_CUTOFF_DATE') or None,
+                        help='only fetch the latest version on or before this date')
+    parser.add_argument('--refresh-history', action='store_true',
+                        help='fetch the list of versions again for studies already downloaded')
+    parser.add_argument('--only-check-for-file', action='store_true',
+                        default=bool(os.environ.get('CTHIST_DOWNLOAD_ONLY_CHECK_FOR_FILE')),
+                        help='skip studies that already have a file')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    nctids = list(read_nctids(args.nctid_files or [sys.stdin]))
+    failed = asyncio.run(harvest(
+        nctids, args.out_dir, args.base_url, args.concurrency, args.rate, args.retries,
+        args.timeout, args.cutoff_date, args.refresh_history, args.only_check_for_file,
+        args.flush_every, packed_dir=args.packed_dir))
+    if failed:
+        raise SystemExit(f'harvest_cthist: {len(failed)} of {len(nctids)} studies failed: '
+                         + ' '.join(failed[:20]) + (' ...' if len(failed) > 20 else ''))
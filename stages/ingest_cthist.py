@@ -0,0 +1,436 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cthist_pack import SUFFIX as PACKED_SUFFIX, PackedShard, PackedStore
+
+'''
+Ingest the historical ClinicalTrials.gov study record JSONL files into a
+typed, NCT-prefix partitioned Parquet dataset of all record versions.
+
+Input is the tree written by `stages/fetch-cthist-json.pl`:
+
+    download/ctgov/historical/<NCT prefix>/<NCT ID>.jsonl
+
+or the shards of `stages/cthist_pack.py`:
+
+    download/ctgov/historical-packed/<NCT prefix>.jsonl.zst
+
+and output is one shard per prefix:
+
+    brick/ctgov/historical/versions/nct_prefix=<NCT prefix>/part-0.parquet
+
+Each row is one version (lines without a `change` or a `studyRecord` are
+skipped). The fields that `sql/create_cthist_all.sql` extracts are stored
+as typed columns (`VERSION_SCHEMA`), next to the raw `change` and
+`studyRecord` JSON.
+
+Rows are sorted by the `--layout` columns (`LAYOUTS`) and written in small
+row groups with min/max statistics, a page index and a Bloom filter on
+`nct_id`. With the default `version_date` layout, a query for the versions
+before a cut-off date only reads the row groups that start before it.
+
+The studies of a prefix are parsed in batches of about `BATCH_BYTES` of
+JSON and written to an unsorted file, which DuckDB then sorts (spilling to
+disk beyond `--memory-limit`) into the shard, so that a prefix never has to
+fit in memory.
+
+Prefix directories are ingested in parallel. Reruns are incremental: a
+`_manifest.json` next to each shard records the size, mtime and hash of
+every JSONL file, and only the studies whose file changed are parsed again.
+Packed shards record the same size, mtime and hash of the files they were
+packed from, so switching between the two inputs does not parse anything
+again.
+'''
+
+MANIFEST = '_manifest.json'
+SHARD = 'part-0.parquet'
+
+# JSON parsed before it is written out
+BATCH_BYTES = 64 << 20
+
+# Sort orders of the shards
+LAYOUTS = {
+    'version_date': ['version_date', 'nct_id', 'version_number'],
+    'nct_id':       ['nct_id', 'version_number'],
+}
+
+VERSION_SCHEMA = pa.schema([
+    ('version_number',              pa.int32()),
+    ('version_date',                pa.date32()),
+    ('nct_id',                      pa.string()),
+    ('location_country',            pa.list_(pa.string())),
+    ('has_dmc',                     pa.bool_()),
+    ('is_fda_regulated_device',     pa.bool_()),
+    ('is_fda_regulated_drug',       pa.bool_()),
+    ('is_ppsd',                     pa.bool_()),
+    ('is_unapproved_device',        pa.bool_()),
+    ('is_us_export',                pa.bool_()),
+    ('overall_status',              pa.string()),
+    ('phases',                      pa.list_(pa.string())),
+    # Dates that may be partial (`YYYY-MM`) are kept as strings.
+    ('start_date',                  pa.string()),
+    ('primary_completion_date',     pa.string()),
+    ('completion_date',             pa.string()),
+    ('study_type',                  pa.string()),
+    ('primary_purpose',             pa.string()),
+    ('allocation',                  pa.string()),
+    ('masking',                     pa.string()),
+    ('enrollment',                  pa.int32()),
+    ('verification_date',           pa.string()),
+    ('intervention_type',           pa.list_(pa.string())),
+    ('number_of_arm_groups',        pa.int64()),
+    ('number_of_interventions',     pa.int64()),
+    ('has_results',                 pa.string()),
+    ('lead_sponsor_funding_source', pa.string()),
+    ('lead_sponsor_name',           pa.string()),
+    ('collaborators_classes',       pa.list_(pa.string())),
+    ('results_date',                pa.string()),
+    ('results_rec_date',            pa.string()),
+    ('disp_date',                   pa.date32()),
+    ('disp_submit_date',            pa.date32()),
+    ('disp_qc_date',                pa.date32()),
+    # Raw JSON of the version
+    ('change',                      pa.string()),
+    ('studyRecord',                 pa.string()),
+    # JSONL file the version was read from
+    ('source_file',                 pa.string()),
+])
+
+nct_dir_re = re.compile(r'^NCT\d*$')
+date_re = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+# Conversions with the same results as the DuckDB JSON operators and
+# TRY_CAST()s in `sql/create_cthist_all.sql`.
+
+def _get(obj, *path):
+    for key in path:
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def _text(value):
+    # `->>`: strings as is, other JSON values as JSON text
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    return None
+
+
+def _int(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return round(value)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _date(value):
+    if isinstance(value, str) and date_re.match(value):
+        try:
+            return datetime.date.fromisoformat(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _each(obj, *path):
+    # `$.path[*]`: elements of an array, [] when it is missing
+    items = _get(obj, *path)
+    return items if isinstance(items, list) else []
+
+
+def _distinct_sorted(values):
+    return sorted({v for v in values if v is not None})
+
+
+def extract_version(change, study_record):
+    study = _get(study_record, 'study') or {}
+    protocol = _get(study, 'protocolSection') or {}
+    status = protocol.get('statusModule') or {}
+    design = protocol.get('designModule') or {}
+    oversight = protocol.get('oversightModule') or {}
+    arms = protocol.get('armsInterventionsModule') or {}
+    sponsors = protocol.get('sponsorCollaboratorsModule') or {}
+    phases = design.get('phases')
+
+    return {
+        'version_number':              _int(_get(change, 'version')),
+        'version_date':                _date(_get(change, 'date')),
+        'nct_id':                      _text(_get(protocol, 'identificationModule', 'nctId')),
+        'location_country':            _distinct_sorted(
+            _text(_get(loc, 'country')) for loc in _each(protocol, 'contactsLocationsModule', 'locations')),
+        'has_dmc':                     _bool(oversight.get('oversightHasDmc')),
+        'is_fda_regulated_device':     _bool(oversight.get('isFdaRegulatedDevice')),
+        'is_fda_regulated_drug':       _bool(oversight.get('isFdaRegulatedDrug')),
+        'is_ppsd':                     _bool(oversight.get('isPpsd')),
+        'is_unapproved_device':        _bool(oversight.get('isUnapprovedDevice')),
+        'is_us_export':                _bool(oversight.get('isUsExport')),
+        'overall_status':              _text(status.get('overallStatus')),
+        'phases':                      [_text(p) for p in phases] if isinstance(phases, list) else None,
+        'start_date':                  _text(_get(status, 'startDateStruct', 'date')),
+        'primary_completion_date':     _text(_get(status, 'primaryCompletionDateStruct', 'date')),
+        'completion_date':             _text(_get(status, 'completionDateStruct', 'date')),
+        'study_type':                  _text(design.get('studyType')),
+        'primary_purpose':             _text(_get(design, 'designInfo', 'primaryPurpose')),
+        'allocation':                  _text(_get(design, 'designInfo', 'allocation')),
+        'masking':                     _text(_get(design, 'designInfo', 'maskingInfo', 'masking')),
+        'enrollment':                  _int(_get(design, 'enrollmentInfo', 'count')),
+        'verification_date':           _text(status.get('statusVerifiedDate')),
+        'intervention_type':           _distinct_sorted(
+            _text(_get(i, 'type')) for i in _each(arms, 'interventions')),
+        'number_of_arm_groups':        len(_each(arms, 'armGroups')),
+        'number_of_interventions':     len(_each(arms, 'interventions')),
+        'has_results':                 _text(study.get('hasResults')),
+        'lead_sponsor_funding_source': _text(_get(sponsors, 'leadSponsor', 'class')),
+        'lead_sponsor_name':           _text(_get(sponsors, 'leadSponsor', 'name')),
+        'collaborators_classes':       _distinct_sorted(
+            _text(_get(c, 'class')) for c in _each(sponsors, 'collaborators')),
+        'results_date':                _text(_get(status, 'resultsFirstPostDateStruct', 'date')),
+        'results_rec_date':            _text(status.get('resultsFirstSubmitDate')),
+        'disp_date':                   _date(_get(status, 'dispFirstPostDateStruct', 'date')),
+        'disp_submit_date':            _date(status.get('dispFirstSubmitDate')),
+        'disp_qc_date':                _date(status.get('dispFirstSubmitQcDate')),
+    }
+
+
+def parse_study(lines, source_file):
+    rows = []
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        change, study_record = record.get('change'), record.get('studyRecord')
+        if change is None or study_record is None:
+            continue
+        row = extract_version(change, study_record)
+        row['change'] = _text(change)
+        row['studyRecord'] = _text(study_record)
+        row['source_file'] = source_file
+        rows.append(row)
+    return rows
+
+
+def read_study(path):
+    with open(path, 'rb') as f:
+        return parse_study(f, path.name)
+
+
+def _tree_studies(in_dir):
+    '''
+    Yields (file name, stamp, hash function, read function) of the JSONL
+    files in the prefix directory `in_dir`.
+    '''
+    for path in sorted(in_dir.glob('NCT*.jsonl')):
+        st = path.stat()
+        yield (path.name, [st.st_size, st.st_mtime_ns],
+               lambda path=path: file_hash(path), lambda path=path: read_study(path))
+
+
+def _packed_studies(shard_path):
+    '''
+    As `_tree_studies()` for the studies of a packed shard.
+    '''
+    shard = PackedShard(shard_path)
+    for nct_id in shard.nct_ids():
+        entry, name = shard.index[nct_id], f'{nct_id}.jsonl'
+        yield (name, entry['stamp'], lambda entry=entry: entry['sha256'],
+               lambda nct_id=nct_id, name=name: parse_study(shard.read(nct_id).splitlines(), name))
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest(part_dir):
+    '''
+    Returns (files, layout) of the shard in `part_dir`.
+    '''
+    try:
+        with open(part_dir / MANIFEST) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}, None
+    # A shard written with other columns is rebuilt
+    if manifest.get('schema') != VERSION_SCHEMA.to_string() or not (part_dir / SHARD).exists():
+        return {}, None
+    return manifest.get('files', {}), manifest.get('layout')
+
+
+def _atomic_replace(part_dir, name, write):
+    fd, tmp_path = tempfile.mkstemp(dir=part_dir, prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, part_dir / name)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_batches(path, studies, row_group_size):
+    '''
+    Write the versions of `studies` (lists of rows of `parse_study()`) to
+    the Parquet file `path`, holding at most a row group or `BATCH_BYTES` of
+    JSON in memory.
+    '''
+    with pq.ParquetWriter(path, VERSION_SCHEMA) as writer:
+        rows, size = [], 0
+        for study_rows in studies:
+            rows.extend(study_rows)
+            size += sum(len(row['change']) + len(row['studyRecord']) for row in study_rows)
+            if len(rows) >= row_group_size or size >= BATCH_BYTES:
+                writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=VERSION_SCHEMA))
+                rows, size = [], 0
+        if rows:
+            writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=VERSION_SCHEMA))
+
+
+def write_shard(batches, path, layout, row_group_size, n_studies):
+    '''
+    Write the record batches, already sorted by the `layout` columns, as a
+    shard with one row group per batch.
+    '''
+    keys = [(col, 'ascending') for col in LAYOUTS[layout]]
+    with pq.ParquetWriter(
+            path, VERSION_SCHEMA, compression='zstd',
+            sorting_columns=pq.SortingColumn.from_ordering(VERSION_SCHEMA, keys),
+            write_page_index=True,
+            bloom_filter_options={'nct_id': {'ndv': max(n_studies, 1), 'fpp': 0.01}}) as writer:
+        for batch in batches:
+            writer.write_batch(batch.cast(VERSION_SCHEMA), row_group_size=row_group_size)
+
+
+def ingest_prefix(source, part_dir, row_group_size=20_000, layout='version_date',
+                  memory_limit='1GB'):
+    '''
+    Bring the shard in `part_dir` up to date with the JSONL files in the
+    prefix directory or packed shard `source`.
+
+    Returns (prefix, number of studies parsed, number of studies in shard).
+    '''
+    source, part_dir = Path(source), Path(part_dir)
+    part_dir.mkdir(parents=True, exist_ok=True)
+    prev_files, prev_layout = load_manifest(part_dir)
+    if source.name.endswith(PACKED_SUFFIX):
+        prefix, studies = source.name[:-len(PACKED_SUFFIX)], _packed_studies(source)
+    else:
+        prefix, studies = source.name, _tree_studies(source)
+
+    files, changed = {}, []
+    for name, stamp, digest_of, read in studies:
+        prev = prev_files.get(name)
+        if prev is not None and prev['stamp'] == stamp:
+            files[name] = prev
+            continue
+        digest = digest_of()
+        files[name] = {'stamp': stamp, 'sha256': digest}
+        if prev is None or prev['sha256'] != digest:
+            changed.append((name, read))
+
+    removed = set(prev_files) - set(files)
+    if not changed and not removed and prev_layout == layout:
+        if files != prev_files:
+            _atomic_replace(part_dir, MANIFEST, lambda p: _write_manifest(p, files, layout))
+        return prefix, 0, len(files)
+
+    with tempfile.TemporaryDirectory(dir=part_dir, prefix='.ingest-') as tmp_dir:
+        parsed = Path(tmp_dir) / 'parsed.parquet'
+        write_batches(parsed, (read() for _, read in changed), row_group_size)
+
+        query, params = 'SELECT * FROM read_parquet(?, hive_partitioning = false)', [str(parsed)]
+        if prev_files:
+            # Keep the versions of unchanged studies
+            query += (' UNION ALL SELECT * FROM read_parquet(?, hive_partitioning = false)'
+                      ' WHERE NOT list_contains(?, source_file)')
+            params += [str(part_dir / SHARD), [name for name, _ in changed] + sorted(removed)]
+        query += ' ORDER BY ' + ', '.join(LAYOUTS[layout])
+
+        con = duckdb.connect(config={'memory_limit': memory_limit, 'threads': 1,
+                                     'temp_directory': tmp_dir})
+        try:
+            batches = con.execute(query, params).to_arrow_reader(row_group_size)
+            _atomic_replace(part_dir, SHARD,
+                            lambda p: write_shard(batches, p, layout, row_group_size, len(files)))
+        finally:
+            con.close()
+    _atomic_replace(part_dir, MANIFEST, lambda p: _write_manifest(p, files, layout))
+    return prefix, len(changed), len(files)
+
+
+def _write_manifest(path, files, layout):
+    with open(path, 'w') as f:
+        json.dump({'schema': VERSION_SCHEMA.to_string(), 'layout': layout, 'files': files},
+                  f, indent=1, sort_keys=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Ingest historical study record JSONL into Parquet')
+    parser.add_argument('in_dir', nargs='?', default='download/ctgov/historical',
+                        help='JSONL tree or directory of packed shards')
+    parser.add_argument('out_dir', nargs='?', default='brick/ctgov/historical/versions')
+    parser.add_argument('--jobs', type=int, default=min(4, os.cpu_count() or 1),
+                        help='number of worker processes (0 = one per CPU)')
+    parser.add_argument('--row-group-size', type=int, default=20_000)
+    parser.add_argument('--memory-limit', default='1GB',
+                        help='DuckDB memory limit of each worker for sorting a shard')
+    parser.add_argument('--layout', choices=LAYOUTS, default='version_date',
+                        help='sort order of the rows')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    in_dir, out_dir = Path(args.in_dir), Path(args.out_dir)
+    if PackedStore.is_packed(in_dir):
+        store = PackedStore(in_dir)
+        sources = {prefix: store.shard_path(prefix) for prefix in store.prefixes()}
+    else:
+        sources = {p.name: p for p in in_dir.iterdir() if p.is_dir() and nct_dir_re.match(p.name)}
+    prefixes = sorted(sources)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.jobs or None) as executor:
+        futures = [executor.submit(ingest_prefix, sources[prefix], out_dir / f'nct_prefix={prefix}',
+                                   args.row_group_size, args.layout, args.memory_limit)
+                   for prefix in prefixes]
+        for future in futures:
+            prefix, n_parsed, n_studies = future.result()
+            if n_parsed:
+                print(f"ingest_cthist: {prefix}: parsed {n_parsed} of {n_studies} studies")
+
+    # Prefix directories that no longer exist
+    for part_dir in out_dir.glob('nct_prefix=*'):
+        if part_dir.name.split('=', 1)[1] not in prefixes:
+            print(f"ingest_cthist: Removing {part_dir}")
+            shutil.rmtree(part_dir)
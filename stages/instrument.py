@@ -0,0 +1,403 @@
+import argparse
+import contextlib
+import functools
+import itertools
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+'''
+Per-stage and per-function profiling records as JSON lines.
+
+Instrumentation is off unless `PIPELINE_PROFILE_LOG` names a log file:
+
+    PIPELINE_PROFILE_LOG=log/profile.jsonl dvc repro
+
+Every `span(name)` then appends one JSON object to the log when it ends,
+with
+
+  - run, stage, span, id, parent: the run (`PIPELINE_PROFILE_RUN`, or one
+    per process), the stage (`PIPELINE_PROFILE_STAGE`, or the script name),
+    the span name and the id of the enclosing span,
+  - wall_s, cpu_s: wall time and CPU time of the process (all threads),
+  - children_cpu_s, children_max_rss_mb: of the child processes waited for,
+  - max_rss_mb: peak RSS of the process so far,
+  - io_read_bytes, io_write_bytes: bytes read and written by the process
+    (Linux `/proc/self/io`, including pipes and cached reads),
+  - rows_in, rows_out, bytes_read, bytes_written: counted by the code in
+    the span (`Span.add`),
+  - status ('ok' or 'error') and other fields given to the span.
+
+Spans of concurrent threads overlap, so their CPU and I/O figures include
+each other's. Records are appended with a single `write()` on a file opened
+with `O_APPEND`, so the worker processes of a stage can share the log.
+
+`duckdb_span()` also captures the DuckDB profile of a query (the operator
+tree with timings and cardinalities that `EXPLAIN ANALYZE` shows) as JSON in
+`PIPELINE_DUCKDB_PROFILE_DIR`, and adds its totals to the record.
+
+To aggregate the logs of several runs:
+
+    python3 stages/instrument.py log/profile.jsonl --last 5
+'''
+
+LOG_ENV = 'PIPELINE_PROFILE_LOG'
+RUN_ENV = 'PIPELINE_PROFILE_RUN'
+STAGE_ENV = 'PIPELINE_PROFILE_STAGE'
+DUCKDB_PROFILE_ENV = 'PIPELINE_DUCKDB_PROFILE_DIR'
+
+COUNTERS = ['rows_in', 'rows_out', 'bytes_read', 'bytes_written']
+
+_local = threading.local()
+_ids = itertools.count(1)
+_run = None
+
+
+def log_path():
+    return os.environ.get(LOG_ENV) or None
+
+
+def enabled():
+    return log_path() is not None
+
+
+def run_id():
+    global _run
+    if _run is None:
+        _run = os.environ.get(RUN_ENV) or (
+            datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ') + f'-{os.getpid()}')
+        # Worker processes and subprocesses log to the same run
+        os.environ[RUN_ENV] = _run
+    return _run
+
+
+def stage_name():
+    return os.environ.get(STAGE_ENV) or Path(sys.argv[0]).stem or 'python'
+
+
+def _proc_io():
+    # (rchar, wchar) of the process, or None off Linux
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _rss_mb(ru_maxrss):
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return ru_maxrss / (1024**2 if sys.platform == 'darwin' else 1024)
+
+
+def write_record(record, path=None):
+    path = path or log_path()
+    if path is None:
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    data = (json.dumps(record, default=str) + '\n').encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+class Span:
+    '''
+    Measures the code in a `with` block and logs it as one record.
+    '''
+    def __init__(self, name, parent=None, **fields):
+        self.name = name
+        self.id = f'{os.getpid()}-{next(_ids)}'
+        self.parent = parent
+        self.fields = fields
+        self.enabled = enabled()
+
+    def add(self, **counts):
+        '''
+        Add to counters such as `rows_out` (None is ignored).
+        '''
+        for name, value in counts.items():
+            if value is not None:
+                self.fields[name] = self.fields.get(name, 0) + value
+        return self
+
+    def set(self, **fields):
+        self.fields.update(fields)
+        return self
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        if self.parent is None and stack:
+            self.parent = stack[-1].id
+        stack.append(self)
+        if self.enabled:
+            self._run = run_id()
+            self._start = datetime.now(timezone.utc)
+            self._wall = time.perf_counter()
+            self._self = resource.getrusage(resource.RUSAGE_SELF)
+            self._children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self._io = _proc_io()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.stack.remove(self)
+        if not self.enabled:
+            return False
+        wall = time.perf_counter() - self._wall
+        ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record = {
+            'run': self._run,
+            'stage': stage_name(),
+            'span': self.name,
+            'id': self.id,
+            'parent': self.parent,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'start': self._start.isoformat(),
+            'wall_s': round(wall, 6),
+            'cpu_s': round(ru_self.ru_utime + ru_self.ru_stime
+                           - self._self.ru_utime - self._self.ru_stime, 6),
+            'children_cpu_s': round(ru_children.ru_utime + ru_children.ru_stime
+                                    - self._children.ru_utime - self._children.ru_stime, 6),
+            'max_rss_mb': round(_rss_mb(ru_self.ru_maxrss), 1),
+            'children_max_rss_mb': round(_rss_mb(ru_children.ru_maxrss), 1),
+        }
+        io = _proc_io()
+        if io is not None and self._io is not None:
+            record['io_read_bytes'] = io[0] - self._io[0]
+            record['io_write_bytes'] = io[1] - self._io[1]
+        record.update(self.fields)
+        record['status'] = 'ok' if exc_type is None else 'error'
+        if exc is not None:
+            record['error'] = f'{exc_type.__name__}: {exc}'
+        write_record(record)
+        return False
+
+
+def span(name, **fields):
+    '''
+    `with span('name', key=...) as s: ...; s.add(rows_out=n)`
+    '''
+    return Span(name, **fields)
+
+
+def instrumented(name=None):
+    '''
+    Decorator that runs the function in a span (named after the function).
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def file_bytes(*paths):
+    '''
+    Total size of the files (and of the files under the directories) that
+    exist.
+    '''
+    total = 0
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            total += sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+        elif path.is_file():
+            total += path.stat().st_size
+    return total
+
+
+def parquet_rows(*paths):
+    '''
+    Total number of rows of the Parquet files (from their footers).
+    '''
+    import pyarrow.parquet as pq
+    return sum(pq.ParquetFile(path).metadata.num_rows for path in paths)
+
+
+def duckdb_profile_dir():
+    return os.environ.get(DUCKDB_PROFILE_ENV) or None
+
+
+def profile_path(profile_dir, *parts):
+    '''
+    Path of a DuckDB profile in `profile_dir`/<run>/ named after `parts`.
+    '''
+    name = '-'.join(str(p) for p in parts if p is not None)
+    name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+    path = Path(profile_dir) / run_id() / f'{name}.json'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _operators(node):
+    for child in node.get('children', []):
+        yield child
+        yield from _operators(child)
+
+
+def summarize_duckdb_profile(profile, top=3):
+    '''
+    Totals of a DuckDB JSON profile: rows scanned and output, latency, CPU
+    time, peak buffer memory and the slowest operators.
+    '''
+    rows_out = profile.get('rows_returned')
+    children = profile.get('children', [])
+    if children and children[0].get('operator_type') == 'COPY_TO_FILE':
+        # The result of a COPY is its row count; count the rows copied
+        rows_out = sum(c.get('operator_cardinality', 0) for c in children[0].get('children', []))
+    operators = sorted(_operators(profile), key=lambda n: n.get('operator_timing', 0), reverse=True)
+    return {
+        'rows_in': profile.get('cumulative_rows_scanned'),
+        'rows_out': rows_out,
+        'duckdb_latency_s': profile.get('latency'),
+        'duckdb_cpu_s': profile.get('cpu_time'),
+        'duckdb_peak_buffer_mb': round(profile.get('system_peak_buffer_memory', 0) / 1024**2, 1),
+        'duckdb_peak_temp_mb': round(profile.get('system_peak_temp_dir_size', 0) / 1024**2, 1),
+        'top_operators': [
+            {'name': n.get('operator_name'), 'timing_s': n.get('operator_timing'),
+             'rows': n.get('operator_cardinality')}
+            for n in operators[:top]
+        ],
+    }
+
+
+@contextlib.contextmanager
+def duckdb_span(cursor, name, profile=None, **fields):
+    '''
+    Span of the queries run on the DuckDB `cursor` in the block. With a
+    `profile` path, their profile is written there as JSON and summarized
+    in the record (the profile of the last query if there are several).
+    '''
+    with span(name, **fields) as s:
+        if profile is not None:
+            cursor.execute("SET enable_profiling = 'json'")
+            cursor.execute('SET profiling_output = ?', [str(profile)])
+            s.set(profile=str(profile))
+        try:
+            yield s
+        finally:
+            if profile is not None:
+                cursor.execute("SET enable_profiling = 'no_output'")
+                with contextlib.suppress(OSError, ValueError):
+                    with open(profile) as f:
+                        s.set(**summarize_duckdb_profile(json.load(f)))
+
+
+def read_records(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # A record cut short by an interrupted run
+                        continue
+
+
+FIELDS = ['wall_s', 'cpu_s', 'children_cpu_s', 'max_rss_mb'] + COUNTERS
+
+
+def report(records, by=('stage', 'span'), runs=None, last=None, top_level=False):
+    '''
+    Aggregate the records by the `by` fields: number of records and runs,
+    mean and maximum wall time, mean CPU time, maximum peak RSS and the
+    mean of the row and byte counters. Only the `runs` (or the `last` runs)
+    are included, and with `top_level` only the spans without a parent (the
+    whole stages), so that nested spans are not counted twice.
+
+    Returns a list of dicts sorted by total wall time.
+    '''
+    records = list(records)
+    order = {}
+    for r in records:
+        order.setdefault(r['run'], r['start'])
+    selected = set(runs) if runs else set(order)
+    if last:
+        selected &= set(sorted(order, key=order.get)[-last:])
+
+    groups = {}
+    for r in records:
+        if top_level and r.get('parent') is not None:
+            continue
+        if r['run'] in selected:
+            groups.setdefault(tuple(r.get(f) for f in by), []).append(r)
+
+    rows = []
+    for key, rs in groups.items():
+        row = dict(zip(by, key))
+        row['n'] = len(rs)
+        row['runs'] = len({r['run'] for r in rs})
+        row['errors'] = sum(r.get('status') == 'error' for r in rs)
+        wall = [r['wall_s'] for r in rs]
+        row['wall_s_total'] = sum(wall)
+        row['wall_s_mean'] = sum(wall) / len(wall)
+        row['wall_s_max'] = max(wall)
+        row['cpu_s_mean'] = sum(r['cpu_s'] + r.get('children_cpu_s', 0) for r in rs) / len(rs)
+        row['max_rss_mb'] = max(max(r.get('max_rss_mb', 0), r.get('children_max_rss_mb', 0)) for r in rs)
+        for counter in COUNTERS:
+            values = [r[counter] for r in rs if r.get(counter) is not None]
+            row[counter] = round(sum(values) / len(values)) if values else None
+        rows.append(row)
+    rows.sort(key=lambda row: row['wall_s_total'], reverse=True)
+    return rows
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f'{value:.3f}' if abs(value) < 1000 else f'{value:.0f}'
+    return str(value)
+
+
+def print_table(rows, file=sys.stdout):
+    if not rows:
+        print('No records', file=file)
+        return
+    columns = list(rows[0])
+    cells = [[_format(row[c]) for c in columns] for row in rows]
+    widths = [max(len(c), *(len(r[i]) for r in cells)) for i, c in enumerate(columns)]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)), file=file)
+    for r in cells:
+        print('  '.join(v.ljust(w) for v, w in zip(r, widths)), file=file)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Aggregate the profiling records of pipeline runs')
+    parser.add_argument('logs', nargs='*', help=f'JSON lines logs (default: ${LOG_ENV})')
+    parser.add_argument('--by', type=lambda s: s.split(','), default=['stage', 'span'],
+                        help='comma-separated fields to group by (e.g. run,stage or stage,span,key)')
+    parser.add_argument('--run', action='append', default=[], help='only this run (repeatable)')
+    parser.add_argument('--last', type=int, help='only the last N runs')
+    parser.add_argument('--stages', action='store_true',
+                        help='only the top-level spans, e.g. with --by run,stage')
+    parser.add_argument('--json', action='store_true', help='print JSON lines instead of a table')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logs = args.logs or ([log_path()] if log_path() else [])
+    if not logs:
+        raise SystemExit(f'{sys.argv[0]}: no log given and {LOG_ENV} is not set')
+    rows = report(read_records(logs), by=args.by, runs=args.run, last=args.last,
+                  top_level=args.stages)
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+    else:
+        print_table(rows)
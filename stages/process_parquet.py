@@ -1,27 +1,227 @@
-import duckdb
+import argparse
+import glob
+import json
+import os
+import tempfile
 from pathlib import Path
-from itertools import islice
-
-work_dir = Path("work")
-cols = [
-    "primary_completion_date",
-    "study_start_date",
-    "version_date",
-    "overall_status",
-    "enrolment_type",
-    "enrolment",
-    "nctid",
-    "version_number",
-    "status",
+
+import duckdb
+
+'''
+Compact the per-study Parquet files written by `stages/01_download_cts.R`
+(`work/NCT*.parquet`) into a few large Parquet files:
+
+    work/all_study_records/part-<n>.parquet
+
+The files do not all have the same columns or types, so the selected
+`--columns` are cast to the types of the `--schema` file (see
+`sql/create_empty.sql`); columns missing from a file are `NULL` and columns
+not in the schema file take the type DuckDB unifies over all the files.
+DuckDB reads, sorts (by `--sort-by`, spilling to disk beyond
+`--memory-limit`) and writes the rows with ZSTD compression in row groups of
+`--row-group-size` rows, so the files never have to fit in memory.
+
+Reruns are incremental: `MANIFEST` records the size and mtime of every input
+file and the part that holds its rows. New files are compacted into a new
+part. A part with a changed or removed input is rewritten together with the
+new files. The parts that are kept are merged into the new part once there
+are `--max-parts` of them, or when their types differ from those of the new
+rows. With `--full`, all the input files are compacted again into one part.
+'''
+
+MANIFEST = '_manifest.json'
+
+DEFAULT_COLUMNS = [
+    'primary_completion_date',
+    'study_start_date',
+    'version_date',
+    'overall_status',
+    'enrolment_type',
+    'enrolment',
+    'nctid',
+    'version_number',
+    'status',
 ]
-cols_ = ",".join([f'"{col}"' for col in cols])
-table_list = ["work/empty.parquet", "work/NCT*.parquet"]
-for f in islice(work_dir.iterdir(), 1):
-    duckdb.sql(f"SELECT {cols_} FROM '{f}'")
+
+READ_PARQUET = 'read_parquet(?, union_by_name = true, hive_partitioning = false)'
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def column_types(con, paths):
+    '''
+    DuckDB types of the columns of the Parquet files `paths`, unified by
+    name.
+    '''
+    rows = con.execute(f'DESCRIBE SELECT * FROM {READ_PARQUET}', [list(paths)]).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def select_sql(con, paths, columns, schema_file=None, sort_by=(), like=()):
+    '''
+    Query of `columns` from the Parquet files `paths`, with the types of
+    `schema_file` or else the types of `paths` and `like` unified, sorted by
+    the `sort_by` columns.
+    '''
+    present = column_types(con, paths)
+    types = column_types(con, list(paths) + list(like)) if like else dict(present)
+    if schema_file is not None:
+        types.update(column_types(con, [schema_file]))
+    exprs = []
+    for c in columns:
+        value = _quote(c) if c in present else 'NULL'
+        if c in types:
+            value = f'CAST({value} AS {types[c]})'
+        exprs.append(f'{value} AS {_quote(c)}')
+    sql = f'SELECT {", ".join(exprs)} FROM {READ_PARQUET}'
+    keys = [_quote(c) for c in sort_by if c in columns]
+    if keys:
+        sql += ' ORDER BY ' + ', '.join(keys)
+    return sql
+
+
+def load_manifest(out_dir, columns, schema_file):
+    try:
+        with open(out_dir / MANIFEST) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Parts written with other columns or types are rebuilt
+    if manifest.get('columns') != columns or manifest.get('schema_file') != schema_file:
+        return None
+    if not all((out_dir / part).exists() for part in manifest['parts']):
+        return None
+    return manifest
+
+
+def save_manifest(out_dir, manifest):
+    _atomic_write(out_dir, MANIFEST, lambda p: Path(p).write_text(json.dumps(manifest, indent=1, sort_keys=True)))
+
+
+def _atomic_write(out_dir, name, write):
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, out_dir / name)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _next_part(parts):
+    numbers = [int(p[len('part-'):-len('.parquet')]) for p in parts]
+    return f'part-{max(numbers, default=-1) + 1}.parquet'
+
+
+def compact(in_glob, out_dir, columns=DEFAULT_COLUMNS, schema_file=None,
+            sort_by=('nctid', 'version_number'), row_group_size=500_000,
+            max_parts=16, full=False, jobs=0, memory_limit='1GB'):
+    '''
+    Bring the parts in `out_dir` up to date with the files matching
+    `in_glob`.
+
+    Returns (number of files read, number of files in the parts).
+    '''
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    inputs = {path: _stamp(path) for path in sorted(glob.glob(in_glob))}
+
+    manifest = None if full else load_manifest(out_dir, columns, schema_file)
+    if manifest is None:
+        manifest = {'columns': columns, 'schema_file': schema_file, 'parts': {}, 'files': {}}
+        stale_parts = {p.name for p in out_dir.glob('part-*.parquet')}
+    else:
+        files = manifest['files']
+        changed = {path for path, stamp in inputs.items()
+                   if path not in files or files[path]['stamp'] != stamp}
+        removed = set(files) - set(inputs)
+        stale_parts = {files[path]['part'] for path in (changed | removed) & set(files)}
+
+    # Files whose rows are not in a part that is kept
+    kept = {path for path, info in manifest['files'].items()
+            if info['part'] not in stale_parts and path in inputs
+            and info['stamp'] == inputs[path]}
+    to_read = [path for path in inputs if path not in kept]
+    kept_parts = set(manifest['parts']) - stale_parts
+    merged = kept_parts if len(kept_parts) >= max_parts else set()
+
+    if to_read or merged:
+        with tempfile.TemporaryDirectory(dir=out_dir, prefix='.compact-') as tmp_dir:
+            con = duckdb.connect(config={'memory_limit': memory_limit,
+                                         'threads': jobs or os.cpu_count() or 1,
+                                         'temp_directory': tmp_dir})
+            try:
+                kept_paths = [str(out_dir / p) for p in sorted(kept_parts - merged)]
+                sources = [str(out_dir / p) for p in sorted(merged)] + to_read
+                sql = select_sql(con, sources, columns, schema_file, sort_by, like=kept_paths)
+                if kept_paths:
+                    # New rows take the types of the parts that are kept, unless
+                    # they need wider ones: then the parts are merged with them
+                    new_types = {row[0]: row[1] for row in
+                                 con.execute(f'DESCRIBE {sql}', [sources]).fetchall()}
+                    if any(column_types(con, [p]) != new_types for p in kept_paths):
+                        merged = kept_parts
+                        sources = [str(out_dir / p) for p in sorted(merged)] + to_read
+                        sql = select_sql(con, sources, columns, schema_file, sort_by)
+
+                part = _next_part(set(manifest['parts']) | stale_parts)
+                n_rows = []
+                _atomic_write(out_dir, part, lambda p: n_rows.extend(con.execute(
+                    f'COPY ({sql}) TO {_literal(p)} (FORMAT PARQUET, COMPRESSION ZSTD,'
+                    f' ROW_GROUP_SIZE {int(row_group_size)})', [sources]).fetchone()))
+            finally:
+                con.close()
+        manifest['parts'][part] = n_rows[0]
+        stale_parts |= merged
+
+    files = {path: info for path, info in manifest['files'].items() if path in kept}
+    for info in files.values():
+        if info['part'] in merged:
+            info['part'] = part
+    if to_read:
+        files.update((path, {'stamp': inputs[path], 'part': part}) for path in to_read)
+    manifest['files'] = files
+    for part in stale_parts:
+        manifest['parts'].pop(part, None)
+    save_manifest(out_dir, manifest)
+    for part in stale_parts:
+        (out_dir / part).unlink(missing_ok=True)
+    return len(to_read), len(manifest['files'])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Compact the per-study Parquet files into sorted parts')
+    parser.add_argument('in_glob', nargs='?', default='work/NCT*.parquet')
+    parser.add_argument('out_dir', nargs='?', default='work/all_study_records')
+    parser.add_argument('--schema', help='Parquet file with the column types (e.g. work/empty.parquet)')
+    parser.add_argument('--columns', type=lambda s: s.split(','), default=DEFAULT_COLUMNS,
+                        help='comma-separated columns to keep')
+    parser.add_argument('--sort-by', type=lambda s: s.split(','), default=['nctid', 'version_number'])
+    parser.add_argument('--row-group-size', type=int, default=500_000)
+    parser.add_argument('--max-parts', type=int, default=16,
+                        help='merge the parts once there are this many')
+    parser.add_argument('--full', action='store_true', help='compact all the input files again')
+    parser.add_argument('--jobs', type=int, default=0, help='DuckDB threads (0 = all CPUs)')
+    parser.add_argument('--memory-limit', default='1GB',
+                        help='DuckDB memory limit for sorting the rows')
+    return parser.parse_args(argv)
 
 
-duckdb.sql(f"""COPY 
-    (SELECT {cols_} 
-    FROM read_parquet({table_list}, union_by_name=true))
-    TO 'work/all_study_records.parquet' (COMPRESSION ZSTD)""")
-print(cols_)
+if __name__ == '__main__':
+    args = parse_args()
+    n_read, n_files = compact(args.in_glob, args.out_dir, args.columns, args.schema,
+                              args.sort_by, args.row_group_size, args.max_parts,
+                              args.full, args.jobs, args.memory_limit)
+    print(f'{args.out_dir}: read {n_read} of {n_files} files')
@@ -0,0 +1,229 @@
+import argparse
+import csv
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import duckdb
+
+import instrument
+from tt_render import param_stash, read_params, render
+
+'''
+Render a SQL template for many parameter keys of `params.yaml` and run them
+in one DuckDB database.
+
+Instead of piping `script/tt-render-by-param` into a new `duckdb` process for
+each key, the setup statements of the rendered SQL (`INSTALL`, `LOAD`,
+`ATTACH` and `CREATE MACRO`) are run once on a shared connection and the
+remaining statements of each key run on their own cursor, so that independent
+keys run concurrently. The memory limit and temporary directory apply to the
+whole database, so all keys together stay within `MY_DUCKDB_MEMORY_LIMIT`.
+
+With `--variant PART:CSV`, each key is also rendered with the variables of the
+YAML file `PART` and the result of its last query is written to the CSV file
+`CSV` (where `{key}` is replaced by the parameter key), as with `duckdb -csv`.
+For example, the HLACT filter and its flowchart counts:
+
+    python3 stages/run_templated_sql.py sql/create_cthist_hlact.sql \\
+        --variant sql/params/hlact-filter/hlact-flowchart.part.yaml:brick/flowchart-counts/{key}.csv
+
+With `PIPELINE_PROFILE_LOG` set, each run and each of its statements are
+logged (see `stages/instrument.py`); with `--profile-dir`, the DuckDB profile
+of every statement is written there too.
+'''
+
+_SETUP_TYPES = {duckdb.StatementType.LOAD, duckdb.StatementType.ATTACH}
+_MACRO_RE = re.compile(r'CREATE\s+(?:OR\s+REPLACE\s+)?MACRO\b', re.I)
+_COPY_RE = re.compile(r'COPY\b', re.I)
+
+
+def _strip_comments(query):
+    return re.sub(r'--[^\n]*|/\*.*?\*/', '', query, flags=re.S).strip().rstrip(';').strip()
+
+
+def is_setup(statement):
+    '''
+    Whether the statement sets up the database for every key: extensions,
+    attached databases and (non-temporary) macros.
+    '''
+    if statement.type in _SETUP_TYPES:
+        return True
+    return (statement.type == duckdb.StatementType.CREATE
+            and _MACRO_RE.match(_strip_comments(statement.query)) is not None)
+
+
+def split_statements(sql):
+    '''
+    Split SQL into the setup statements and the other statements.
+    '''
+    setup, body = [], []
+    for statement in duckdb.extract_statements(sql):
+        (setup if is_setup(statement) else body).append(statement.query)
+    return setup, body
+
+
+class Runner:
+    def __init__(self, con, profile_dir=None):
+        self.con = con
+        self.profile_dir = profile_dir
+        self._setup_done = set()
+        self._lock = threading.Lock()
+
+    def setup(self, queries):
+        '''
+        Run the setup statements that were not run yet.
+        '''
+        with self._lock:
+            for query in queries:
+                normalized = _strip_comments(query)
+                if normalized not in self._setup_done:
+                    self.con.execute(query)
+                    self._setup_done.add(normalized)
+
+    def run(self, sql, out_csv=None, label=None, parent=None):
+        '''
+        Run the SQL on a new cursor. The result of the last query is written
+        to `out_csv`.
+
+        label: names the run in the profiling records and profiles.
+        parent: id of the span the run belongs to.
+        '''
+        setup, body = split_statements(sql)
+        self.setup(setup)
+        cur = self.con.cursor()
+        try:
+            with instrument.span('run', parent=parent, label=label) as run_span:
+                written = False
+                for i, query in enumerate(body, start=1):
+                    profile = (instrument.profile_path(self.profile_dir, label, i)
+                               if self.profile_dir else None)
+                    with instrument.duckdb_span(cur, 'statement', profile, label=label,
+                                                statement=i) as s:
+                        result = cur.sql(query)
+                        # A query result is only computed as it is fetched
+                        if i == len(body) and out_csv is not None and result is not None:
+                            s.set(rows_out=write_csv(result, out_csv),
+                                  bytes_written=instrument.file_bytes(out_csv))
+                            written = True
+                    # Rows are only counted from the DuckDB profiles and the CSV
+                    run_span.add(rows_in=s.fields.get('rows_in'))
+                    if written or _COPY_RE.match(_strip_comments(query)):
+                        run_span.add(rows_out=s.fields.get('rows_out'),
+                                     bytes_written=s.fields.get('bytes_written'))
+                if out_csv is not None and not written:
+                    raise ValueError(f'No query result to write to {out_csv}')
+        finally:
+            cur.close()
+
+
+def write_csv(relation, path):
+    '''
+    Returns the number of rows written.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(relation.columns)
+        rows = relation.fetchall()
+        for row in rows:
+            writer.writerow('' if v is None else v for v in row)
+    os.replace(tmp_path, path)
+    return len(rows)
+
+
+def connect(memory_limit=None, temp_dir=None, threads=None):
+    con = duckdb.connect()
+    if temp_dir:
+        print(f'Setting the DuckDB temp_directory to {temp_dir}', file=sys.stderr)
+        con.execute('SET temp_directory = ?', [temp_dir])
+    if memory_limit:
+        print(f'Setting the DuckDB memory_limit to {memory_limit}', file=sys.stderr)
+        con.execute('SET memory_limit = ?', [memory_limit])
+    if threads:
+        con.execute('SET threads = ?', [threads])
+    return con
+
+
+def _variant(value):
+    part, sep, out_csv = value.partition(':')
+    if not sep or not part or not out_csv:
+        raise argparse.ArgumentTypeError(f'expected PART:CSV, got {value!r}')
+    return part, out_csv
+
+
+def env_settings():
+    '''
+    The memory limit and temporary directory from `MY_DUCKDB_MEMORY_LIMIT` and
+    `MY_DUCKDB_TEMP_DIR` (if the directory exists).
+    '''
+    temp_dir = os.environ.get('MY_DUCKDB_TEMP_DIR')
+    return (os.environ.get('MY_DUCKDB_MEMORY_LIMIT'),
+            temp_dir if temp_dir and os.path.isdir(temp_dir) else None)
+
+
+def parse_args(argv=None):
+    memory_limit, temp_dir = env_settings()
+    parser = argparse.ArgumentParser(description='Run a SQL template for many parameter keys in one DuckDB database')
+    parser.add_argument('template')
+    parser.add_argument('keys', nargs='*', help='parameter keys (default: all)')
+    parser.add_argument('--params', default='params.yaml')
+    parser.add_argument('--part', action='append', default=[],
+                        help='YAML file with more variables for every run')
+    parser.add_argument('--csv', help='CSV file for the result of the last query ({key} is replaced)')
+    parser.add_argument('--variant', action='append', default=[], type=_variant,
+                        metavar='PART:CSV', help='also run with the variables of PART, writing the result to CSV')
+    parser.add_argument('--jobs', type=int, default=0, help='keys to run concurrently (0 = all CPUs)')
+    parser.add_argument('--threads', type=int, help='DuckDB threads (default: all CPUs)')
+    parser.add_argument('--memory-limit', default=memory_limit)
+    parser.add_argument('--temp-dir', default=temp_dir)
+    parser.add_argument('--profile-dir', default=instrument.duckdb_profile_dir(),
+                        help=f'write the DuckDB profile of every statement here (default: ${instrument.DUCKDB_PROFILE_ENV})')
+    return parser.parse_args(argv)
+
+
+def main(args):
+    params = read_params(args.params)
+    keys = args.keys or list(params)
+    with open(args.template) as f:
+        template = f.read()
+
+    runs = []
+    for key in keys:
+        runs.append((key, args.part, args.csv))
+        runs.extend((key, args.part + [part], out_csv) for part, out_csv in args.variant)
+    # Render everything first so that a template error fails before any run
+    jobs = []
+    for key, parts, out_csv in runs:
+        sql = render(template, param_stash(params, key, parts, args.params))
+        # e.g. `stanford_2019-2023` or `stanford_2019-2023+hlact-flowchart`
+        label = '+'.join([key] + [Path(part).name.split('.')[0] for part in parts])
+        jobs.append((key, label, sql, out_csv and out_csv.replace('{key}', key)))
+
+    con = connect(args.memory_limit, args.temp_dir, args.threads)
+    runner = Runner(con, args.profile_dir)
+
+    with instrument.span('main', template=args.template, keys=keys) as stage:
+        def run(job):
+            key, label, sql, out_csv = job
+            try:
+                runner.run(sql, out_csv, label=label, parent=stage.id)
+            except Exception as e:
+                raise RuntimeError(f'{args.template} failed for {key}: {e}') from e
+            sys.stderr.write(f'Done {key}' + (f' ({out_csv})' if out_csv else '') + '\n')
+
+        with ThreadPoolExecutor(max_workers=args.jobs or os.cpu_count()) as executor:
+            for _ in executor.map(run, jobs):
+                pass
+    con.close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        main(args)
+    except KeyError as e:
+        raise SystemExit(f'{sys.argv[0]}: {e.args[0]}')
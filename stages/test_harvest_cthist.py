@@ -0,0 +1,176 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from aiohttp import web
+
+from cthist_pack import PackedStore, pack_prefix
+from harvest_cthist import encode_line, harvest
+
+'''
+Tests of `stages/harvest_cthist.py` against a local stand-in for the
+ClinicalTrials.gov API:
+
+    python3 -m unittest discover -s stages -p 'test_*.py'
+'''
+
+HISTORY = {
+    'NCT00000125': [
+        {'version': 0, 'date': '2001-01-01', 'status': 'RECRUITING'},
+        {'version': 1, 'date': '2005-06-01', 'status': 'RECRUITING'},
+        {'version': 2, 'date': '2014-03-01', 'status': 'COMPLETED'},
+    ],
+}
+LATEST = {
+    'NCT00000141': {'study': {'protocolSection': {'identificationModule': {
+        'nctId': 'NCT01203436', 'nctIdAliases': ['NCT00000141']}}}},
+}
+
+
+def study_record(nctid, version):
+    return {
+        'studyVersion': version,
+        'study': {'protocolSection': {
+            'identificationModule': {'nctId': nctid},
+            'contactsLocationsModule': {'locations': [{'city': 'Białystok'}]},
+        }},
+    }
+
+
+class StandIn:
+    def __init__(self):
+        self.requests = []
+        # Paths that fail once with a 503
+        self.flaky = set()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/api/int/studies/{nctid}/history', self.history)
+        app.router.add_get('/api/int/studies/{nctid}/history/{version}', self.version)
+        app.router.add_get('/api/int/studies/{nctid}', self.latest)
+        return app
+
+    def _flake(self, request):
+        self.requests.append(request.path)
+        if request.path in self.flaky:
+            self.flaky.discard(request.path)
+            raise web.HTTPServiceUnavailable()
+
+    async def history(self, request):
+        self._flake(request)
+        nctid = request.match_info['nctid']
+        if nctid not in HISTORY:
+            raise web.HTTPNotFound(text=f'No study {nctid} history summary')
+        return web.json_response({'changes': HISTORY[nctid]})
+
+    async def version(self, request):
+        self._flake(request)
+        nctid, version = request.match_info['nctid'], int(request.match_info['version'])
+        return web.json_response(study_record(nctid, version))
+
+    async def latest(self, request):
+        self._flake(request)
+        nctid = request.match_info['nctid']
+        if nctid not in LATEST:
+            raise web.HTTPNotFound()
+        return web.json_response(LATEST[nctid])
+
+
+class HarvestTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.stand_in = StandIn()
+        self.runner = web.AppRunner(self.stand_in.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://127.0.0.1:{port}/api/int/studies'
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.out_dir = Path(self.tmp_dir.name)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp_dir.cleanup()
+
+    async def _harvest(self, nctids, **kwargs):
+        self.stand_in.requests.clear()
+        return await harvest(nctids, self.out_dir, self.base_url, rate=0, backoff=0.01, **kwargs)
+
+    def _lines(self, nctid):
+        with open(self.out_dir / nctid[:6] / f'{nctid}.jsonl', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    async def test_history(self):
+        self.stand_in.flaky.add('/api/int/studies/NCT00000125/history/1')
+        self.assertEqual(await self._harvest(['NCT00000125']), [])
+        lines = self._lines('NCT00000125')
+        self.assertEqual([line['change']['version'] for line in lines], [0, 1, 2])
+        self.assertEqual([line['studyRecord']['studyVersion'] for line in lines], [0, 1, 2])
+
+        path = self.out_dir / 'NCT000' / 'NCT00000125.jsonl'
+        text = path.read_text(encoding='utf-8')
+        self.assertIn('Białystok', text)
+        self.assertEqual(text, ''.join(encode_line(line) for line in lines))
+
+        # Nothing is fetched again
+        self.assertEqual(await self._harvest(['NCT00000125']), [])
+        self.assertEqual(self.stand_in.requests, [])
+
+    async def test_cutoff_then_rest(self):
+        await self._harvest(['NCT00000125'], cutoff_date='2013-09-27')
+        lines = self._lines('NCT00000125')
+        self.assertEqual([line['studyRecord'] is not None for line in lines], [False, True, False])
+
+        await self._harvest(['NCT00000125'])
+        self.assertEqual(sorted(self.stand_in.requests), [
+            '/api/int/studies/NCT00000125/history/0',
+            '/api/int/studies/NCT00000125/history/2',
+        ])
+        self.assertTrue(all(line['studyRecord'] is not None for line in self._lines('NCT00000125')))
+
+    async def test_refresh_history(self):
+        await self._harvest(['NCT00000125'])
+        HISTORY['NCT00000125'].append({'version': 3, 'date': '2015-01-01', 'status': 'COMPLETED'})
+        try:
+            await self._harvest(['NCT00000125'], refresh_history=True)
+        finally:
+            HISTORY['NCT00000125'].pop()
+        self.assertEqual(self.stand_in.requests, [
+            '/api/int/studies/NCT00000125/history',
+            '/api/int/studies/NCT00000125/history/3',
+        ])
+        self.assertEqual(len(self._lines('NCT00000125')), 4)
+
+    async def test_no_history(self):
+        self.assertEqual(await self._harvest(['NCT00000141']), [])
+        lines = self._lines('NCT00000141')
+        self.assertEqual(len(lines), 1)
+        self.assertIsNone(lines[0]['change'])
+        self.assertEqual(lines[0]['studyRecord'], LATEST['NCT00000141'])
+
+        self.assertEqual(await self._harvest(['NCT00000141']), [])
+        self.assertEqual(self.stand_in.requests, [])
+
+    async def test_packed(self):
+        await self._harvest(['NCT00000125'])
+        packed_dir = self.out_dir / 'packed'
+        packed_dir.mkdir()
+        pack_prefix(self.out_dir / 'NCT000', packed_dir, remove_source=True)
+        self.assertFalse((self.out_dir / 'NCT000' / 'NCT00000125.jsonl').exists())
+        store = PackedStore(packed_dir)
+        self.assertIn('NCT00000125', store)
+        self.assertNotIn('NCT00000126', store)
+        self.assertNotIn('NCT99999999', store)
+
+        self.assertEqual(await self._harvest(['NCT00000125'], packed_dir=packed_dir), [])
+        self.assertEqual(self.stand_in.requests, [])
+
+    async def test_failure(self):
+        failed = await self._harvest(['NCT00000125', 'NCT99999999'], retries=1)
+        self.assertEqual(failed, ['NCT99999999'])
+        self.assertEqual(len(self._lines('NCT00000125')), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
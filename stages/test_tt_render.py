@@ -0,0 +1,86 @@
+import unittest
+from pathlib import Path
+
+import duckdb
+
+from tt_render import TemplateError, param_stash, read_params, render, render_by_param
+
+'''
+Tests of `stages/tt_render.py`:
+
+    python3 -m unittest discover -s stages -p 'test_*.py'
+
+`stages/testdata/<template>.<key>[.<part>].sql` is the expected output of
+`script/tt-render-by-param <key> sql/<template>.sql [<part>.part.yaml]`.
+'''
+
+ROOT = Path(__file__).resolve().parents[1]
+TEMPLATES = ['sql/create_cthist_all.sql', 'sql/create_cthist_hlact.sql']
+TESTDATA = Path(__file__).with_name('testdata')
+EXPECTED = {
+    'create_cthist_all.anderson2015_2008-2012.sql':
+        ('sql/create_cthist_all.sql', 'anderson2015_2008-2012', []),
+    'create_cthist_hlact.stanford_2019-2023.hlact-filter-03.sql':
+        ('sql/create_cthist_hlact.sql', 'stanford_2019-2023',
+         ['sql/params/hlact-filter/hlact-filter-03.part.yaml']),
+}
+
+
+class TemplatesTest(unittest.TestCase):
+    def test_render_params(self):
+        params = read_params(ROOT / 'params.yaml')
+        parts = [[]] + [[str(p)] for p in sorted((ROOT / 'sql/params/hlact-filter').glob('*.part.yaml'))]
+        for template in TEMPLATES:
+            src = (ROOT / template).read_text()
+            for key in params:
+                for part in parts:
+                    with self.subTest(template=template, key=key, part=part):
+                        sql = render(src, param_stash(params, key, part))
+                        self.assertNotIn('--%%', sql)
+                        self.assertNotIn('\\[\\%', sql)
+                        self.assertTrue(duckdb.extract_statements(sql))
+
+    def test_expected(self):
+        for name, (template, key, parts) in EXPECTED.items():
+            with self.subTest(name):
+                sql = render_by_param(ROOT / template, key, [ROOT / p for p in parts],
+                                      params_file=ROOT / 'params.yaml')
+                self.assertEqual(sql, (TESTDATA / name).read_text())
+
+
+class RenderTest(unittest.TestCase):
+    def render(self, src, **stash):
+        return render('[% TAGS \\[\\% \\%\\] --%% %]\n' + src, stash)
+
+    def test_strings(self):
+        self.assertEqual(self.render('\\[\\% "a\\.b\\tc\\"" \\%\\]'), '\na.b\tc"')
+        self.assertEqual(self.render("\\[\\% 'a\\.b\\'\\\\' \\%\\]"), "\na\\.b'\\")
+        with self.assertRaises(TemplateError):
+            self.render('\\[\\% "$x" \\%\\]')
+
+    def test_replace(self):
+        src = '--%% FILTER replace("x[^\']+?\\.y", to)\n\'x-1.y\' \'x-2zy\' x.z\n--%% END\n'
+        # The search is a regex, the replacement is literal
+        self.assertEqual(self.render(src, to='\\1$&'), "\n'\\1$&' '\\1$&' x.z\n")
+
+    def test_outline(self):
+        src = 'a\n--%% IF x # comment\nb\n--%% ELSE\nc\n--%% END\nd --%% e\n'
+        self.assertEqual(self.render(src, x=1), '\na\nb\nd --%% e\n')
+        self.assertEqual(self.render(src, x=0), '\na\nc\nd --%% e\n')
+
+    def test_falsy(self):
+        src = '--%% IF x\nyes\n--%% ELSE\nno\n--%% END\n'
+        for value in [None, False, 0, '0', '']:
+            self.assertEqual(self.render(src, x=value), '\nno\n')
+        for value in [True, 1, '0.0', ' ', [], {}]:
+            self.assertEqual(self.render(src, x=value), '\nyes\n')
+        self.assertEqual(self.render(src), '\nno\n')
+
+    def test_operators(self):
+        src = '\\[\\% a.b || "d" \\%\\] \\[\\% a.exists("b") \\%\\] \\[\\% a.item("c-d") \\%\\]'
+        self.assertEqual(self.render(src, a={'b': '', 'c-d': 'e'}), '\nd 1 e')
+        self.assertEqual(self.render('\\[\\% x == "1" && !y \\%\\]', x=1, y=0), '\n1')
+
+
+if __name__ == '__main__':
+    unittest.main()
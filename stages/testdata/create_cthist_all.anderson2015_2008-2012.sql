@@ -0,0 +1,119 @@
+-- syntax: DuckDB SQL (+ templating)
+--
+-- NAME
+--
+--   create_cthist_all.sql - Create records before a cut-off date
+--
+-- DESCRIPTION
+--
+--   Selects the latest version of each versioned historical
+--   ClinicalTrials.gov study record before a given cut-off date (to represent
+--   the date that a given dataset was downloaded).
+--
+--   Reads the typed columns of all record versions written by
+--   `stages/ingest_cthist.py` and writes them with a few derived columns as a
+--   Parquet file.
+--
+-- 
+--## {{ begin:normalize_funding_source_top }}
+-- normalize_funding_source
+--
+-- @param lead_sponsor_funding_source VARCHAR
+-- @param collaborators_classes VARCHAR[]
+--
+-- Creates a single funding source based on the definition from the
+-- data dictionary:
+--
+-- > Derived from Sponsor and Collaborator information. If Sponsor is from NIH,
+-- > or at least one collaborator is from NIH with no Industry sponsor then
+-- > funding=NIH. Otherwise if Sponsor is from Industry or at least one
+-- > collaborator is from Industry then funding=Industry. Studies with no
+-- > Industry or NIH Sponsor or collaborators are assigned funding=Other.
+--
+-- @returns VARCHAR
+--## {{ begin:normalize_funding_source_macro }}
+CREATE MACRO normalize_funding_source(
+    lead_sponsor_funding_source,
+    collaborators_classes) AS (
+    CASE
+        WHEN
+        --  If lead sponsor is from 'NIH'
+            lead_sponsor_funding_source = 'NIH'
+        --  Or if if the collaborators contains 'NIH'
+        --  and the lead sponsor is not 'INDUSTRY'.
+             OR (
+                         list_contains(collaborators_classes, 'NIH')
+                 AND     lead_sponsor_funding_source != 'INDUSTRY'
+             )
+        THEN 'NIH'
+
+        WHEN
+        --      If the lead sponsor is from 'INDUSTRY'
+                lead_sponsor_funding_source = 'INDUSTRY'
+        --      Or any of the collaborators are from 'INDUSTRY'
+             OR list_contains(collaborators_classes, 'INDUSTRY')
+        THEN 'Industry'
+
+        -- Default to Other if neither 'NIH' nor 'INDUSTRY' are found
+        ELSE 'Other'
+    END
+);
+--## {{ end:normalize_funding_source_all }}
+
+COPY (
+    SELECT
+        *
+    FROM
+        (
+            WITH
+            _extract AS (
+                -- Latest version of each study as of the cut-off date. The
+                -- columns are extracted from the JSON once, by
+                -- `stages/ingest_cthist.py`.
+                SELECT
+                    * EXCLUDE (change, studyRecord, source_file, nct_prefix)
+                FROM read_parquet(
+                    'brick/ctgov/historical/versions/*/*.parquet',
+                    hive_partitioning = true
+                )
+                WHERE
+                        nct_id IS NOT NULL
+                    AND version_date <= '2013-09-27'::DATE -- cut-off date
+                QUALIFY
+                    version_number = MAX(version_number) OVER (PARTITION BY nct_id)
+            )
+            SELECT
+                *,
+--## {{ begin:derived_columns }}
+                -- `list_distinct()` ensures that the list `location_country`
+                -- does not contain `NULL` elements (but can still be `NULL` or
+                -- `[]` itself).
+--## {{ begin:process_has_us_facility }}
+                list_has_any(
+                    NULLIF(list_distinct(location_country), []),
+                    [
+                        'United States',
+                        'Puerto Rico',
+                        'American Samoa',
+                    ]
+                ) AS has_us_facility,
+--## {{ end:process_has_us_facility }}
+                list_reduce(
+                    phases,
+                    (acc, val) -> concat(acc, '; ', val)
+                ) AS phase,
+                normalize_funding_source(
+                    lead_sponsor_funding_source,
+                    collaborators_classes
+                ) AS norm_funding_source_class,
+--## {{ end:derived_columns }}
+            FROM
+                _extract
+        )
+    -- Clustered by completion date so that the row group statistics of the
+    -- output cover narrow date ranges (as `stages/build_cthist_snapshots.py`).
+    ORDER BY
+        primary_completion_date NULLS LAST,
+        completion_date NULLS LAST,
+        nct_id NULLS LAST
+) TO 'brick/analysis-20130927/ctgov-studies-all.parquet' (FORMAT PARQUET, ROW_GROUP_SIZE 20000)
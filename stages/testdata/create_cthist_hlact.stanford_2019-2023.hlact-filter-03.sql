@@ -0,0 +1,128 @@
+-- syntax: DuckDB SQL (+ templating)
+--
+-- NAME
+--
+--   create_cthist_hlact.sql - Create filtered HLACT records
+--
+-- DESCRIPTION
+--
+--   Processes the Parquet file of all records generated by
+--   `sql/create_cthist_all.sql` and AACT database in order to implement the
+--   inclusion criteria for HLACTs filtered within a given time period.
+--
+--   In particular, retrieves information about facilities and result reporting
+--   from the AACT database, as exported to Parquet by
+--   `sql/create_aact_parquet.sql`.
+--
+--   With `query.do_flowchart_count`, outputs the number of records left after
+--   each inclusion criterion instead (see
+--   `script/cthist_hlact_flowchart_partial_sql.sh`).
+--
+-- 
+
+CREATE MACRO try_parse_date(date_str) AS (
+    try_strptime(date_str, [ '%Y-%m-%d', '%Y-%m' ]) :: DATE
+);
+
+    SELECT
+        'N3' AS key,
+        COUNT(*) AS count
+    FROM
+        (
+            WITH
+            _all AS (
+                -- Each inclusion criterion is a flag, true only when the
+                -- criterion holds (so NULLs exclude the record as they would
+                -- in a WHERE clause).
+                SELECT
+                    *,
+                    coalesce(
+                        overall_status != 'WITHDRAWN'
+                    , false) AS hlact_filter_first_recruitment_status,
+                    coalesce(
+                        (
+                            try_parse_date(primary_completion_date) :: DATE >= '2019-01-01'
+                            OR primary_completion_date IS NULL
+                            AND (
+                                try_parse_date(completion_date) :: DATE >= '2019-01-01'
+                                OR completion_date IS NULL
+                            )
+                        )
+                    , false) AS hlact_filter_start_date,
+                    coalesce(
+                        study_type = 'INTERVENTIONAL'
+                    , false) AS hlact_filter_study_design,
+                    coalesce(
+                        phase NOT IN ('EARLY_PHASE1', 'PHASE1')
+                    , false) AS hlact_filter_phase,
+                    coalesce(
+                        overall_status IN ('TERMINATED', 'COMPLETED')
+                    , false) AS hlact_filter_second_recruitment_status,
+                    coalesce(
+                        try_parse_date(primary_completion_date) :: DATE < '2023-04-01'
+                        OR primary_completion_date IS NULL
+                        AND (
+                            try_parse_date(completion_date) :: DATE < '2023-04-01'
+                            OR completion_date IS NULL
+                        )
+                    , false) AS hlact_filter_end_date,
+                    coalesce(
+                        primary_completion_date IS NOT NULL
+                        OR completion_date IS NOT NULL
+                        OR (
+                            try_parse_date(verification_date) :: DATE >= '2019-01-01'
+                            AND try_parse_date(verification_date) :: DATE < '2023-04-01'
+                        )
+                    , false) AS hlact_filter_verification_date,
+                FROM
+                    read_parquet(
+                        'brick/analysis-20240430/ctgov-studies-all.parquet'
+                    )
+            ),
+            aact AS (
+                SELECT
+                    f.nct_id,
+                    any_value(v.has_us_facility) as has_us_facility,
+                    any_value(disposition_first_submitted_date) as extension_date2,
+                    any_value(f.country) as country,
+                -- Columns of the AACT tables exported by
+                -- `sql/create_aact_parquet.sql`.
+                FROM
+                    read_parquet('brick/aact_20240430/ctgov/calculated_values.parquet') v
+                    JOIN read_parquet('brick/aact_20240430/ctgov/facilities.parquet') f ON v.nct_id = f.nct_id
+                    JOIN read_parquet('brick/aact_20240430/ctgov/studies.parquet') s ON v.nct_id = s.nct_id
+                WHERE
+                    v.has_us_facility IS NOT NULL
+                GROUP BY
+                    f.nct_id
+            ),
+            _flags AS (
+                SELECT
+                    *,
+                    -- Records without AACT data are excluded by the
+                    -- oversight criterion.
+                    coalesce(
+                        ct.nct_id IS NOT NULL
+                        AND (
+                            (
+                                (is_fda_regulated_drug   = true AND primary_purpose = 'INTERVENTIONAL')
+                            OR  (is_fda_regulated_device = true)
+                            )
+                            AND a.has_us_facility = true
+                            OR ct.has_us_facility = true
+                        )
+                    , false) AS hlact_filter_oversight,
+                FROM
+                    _all a
+                    LEFT JOIN aact ct ON ct.nct_id = a.nct_id
+            )
+            SELECT
+                *
+            FROM
+                _flags
+            WHERE
+                1 = 1 -- Needed for dynamic AND clauses
+                AND hlact_filter_first_recruitment_status
+                AND hlact_filter_start_date
+                AND hlact_filter_study_design
+        )
@@ -0,0 +1,386 @@
+import argparse
+import re
+import sys
+
+import yaml
+
+'''
+Render the SQL templates in Python, as `script/tt-render-by-param` does with
+Template Toolkit.
+
+Only the part of the Template Toolkit language used by the SQL templates is
+supported (see § Templating… in `sql/README.md`):
+
+  - the `TAGS` directive and outline tags,
+  - `IF` / `ELSIF` / `ELSE` / `UNLESS` / `END` blocks,
+  - `FILTER replace(search, replacement)` blocks,
+  - variables such as `date.cutoff`, the `||`, `&&` and `!` operators (and
+    `OR`, `AND`, `NOT`), comparisons and the `.exists()`, `.item()` and
+    `.defined()` methods of hashes,
+  - `#` comments.
+
+Anything else raises a `TemplateError`.
+'''
+
+
+class TemplateError(Exception):
+    pass
+
+
+def _strip_comment(directive):
+    out, quote = [], None
+    for ch in directive:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in '"\'':
+            quote = ch
+        elif ch == '#':
+            break
+        out.append(ch)
+    return ''.join(out).strip()
+
+
+def tokenize(src):
+    '''
+    Split a template into `('text', str)` and `('dir', str)` tokens.
+    '''
+    start, end, outline = re.escape('[%'), re.escape('%]'), None
+    pos, tokens = 0, []
+    while pos < len(src):
+        patterns = [f'{start}(?P<inline>.*?){end}']
+        if outline:
+            patterns.append(f'^{re.escape(outline)}(?P<outline>[^\n]*)(?:\n|\\Z)')
+        m = re.compile('|'.join(patterns), re.M | re.S).search(src, pos)
+        if m is None:
+            tokens.append(('text', src[pos:]))
+            break
+        tokens.append(('text', src[pos:m.start()]))
+        pos = m.end()
+        inline = m.group('inline')
+        directive = _strip_comment(inline if inline is not None else m.group('outline'))
+        if directive.split(None, 1)[:1] == ['TAGS']:
+            parts = directive.split()
+            start, end = re.escape(parts[1]), re.escape(parts[2])
+            outline = parts[3] if len(parts) > 3 else None
+        elif directive:
+            tokens.append(('dir', directive))
+    return tokens
+
+
+_LEX_RE = re.compile(r'''\s*(?:
+    (?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<num>\d+(?:\.\d+)?)
+  | (?P<op>\|\||&&|==|!=|<=|>=|[<>!().,])
+  | (?P<word>[A-Za-z_]\w*)
+)''', re.X)
+
+_WORD_OPS = {'AND': '&&', 'OR': '||', 'NOT': '!'}
+
+
+def _lex(s):
+    pos, out = 0, []
+    s = s.rstrip()
+    while pos < len(s):
+        m = _LEX_RE.match(s, pos)
+        if m is None:
+            raise TemplateError(f'Cannot parse {s!r} at {pos}')
+        pos = m.end()
+        kind, val = m.lastgroup, m.group(m.lastgroup)
+        if kind == 'word' and val in _WORD_OPS:
+            kind, val = 'op', _WORD_OPS[val]
+        out.append((kind, val))
+    return out
+
+
+_QUOTED_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t'}
+
+
+def _unquote(token):
+    '''
+    The value of a string literal, unescaped as Template Toolkit does: in
+    double quotes, `\\n`, `\\r` and `\\t` are control characters and a
+    backslash before any other character is dropped (so `"\\."` is `.`); in
+    single quotes, only `\\\\` and `\\'` are unescaped.
+    '''
+    quote, body = token[0], token[1:-1]
+    if quote == "'":
+        return re.sub(r"\\([\\'])", r'\1', body)
+    if re.search(r'(?<!\\)\$', body):
+        raise TemplateError(f'Unsupported variable interpolation in {token}')
+    return re.sub(r'\\(.)', lambda m: _QUOTED_ESCAPES.get(m.group(1), m.group(1)), body, flags=re.S)
+
+
+class _Parser:
+    '''
+    Recursive descent parser of expressions into tuples.
+    '''
+    def __init__(self, s):
+        self.toks = _lex(s)
+        self.i = 0
+
+    def peek(self, op=None):
+        if self.i < len(self.toks):
+            tok = self.toks[self.i]
+            if op is None or tok == ('op', op):
+                return tok
+        return None
+
+    def take(self, op=None):
+        tok = self.peek(op)
+        if tok is None:
+            raise TemplateError(f'Expected {op or "expression"!r} in {self.toks}')
+        self.i += 1
+        return tok
+
+    def done(self):
+        return self.i == len(self.toks)
+
+    def parse(self):
+        e = self.or_()
+        if not self.done():
+            raise TemplateError(f'Unexpected {self.toks[self.i:]}')
+        return e
+
+    def or_(self):
+        e = self.and_()
+        while self.peek('||'):
+            self.take()
+            e = ('or', e, self.and_())
+        return e
+
+    def and_(self):
+        e = self.not_()
+        while self.peek('&&'):
+            self.take()
+            e = ('and', e, self.not_())
+        return e
+
+    def not_(self):
+        if self.peek('!'):
+            self.take()
+            return ('not', self.not_())
+        return self.cmp()
+
+    def cmp(self):
+        e = self.term()
+        for op in ('==', '!=', '<=', '>=', '<', '>'):
+            if self.peek(op):
+                self.take()
+                return ('cmp', op, e, self.term())
+        return e
+
+    def term(self):
+        kind, val = self.take()
+        if kind == 'str':
+            return ('lit', _unquote(val))
+        if kind == 'num':
+            return ('lit', float(val) if '.' in val else int(val))
+        if (kind, val) == ('op', '('):
+            e = self.or_()
+            self.take(')')
+            return e
+        if kind != 'word':
+            raise TemplateError(f'Unexpected {val!r}')
+        e = ('var', val)
+        while self.peek('.'):
+            self.take()
+            _, name = self.take()
+            args = None
+            if self.peek('('):
+                self.take()
+                args = []
+                while not self.peek(')'):
+                    args.append(self.or_())
+                    if self.peek(','):
+                        self.take()
+                self.take(')')
+            e = ('get', e, name, args)
+        return e
+
+
+def _truthy(v):
+    return v not in (None, '', 0, '0', False)
+
+
+def _get(obj, name, args):
+    if isinstance(obj, dict):
+        if args is None:
+            return obj.get(name)
+        if name == 'exists':
+            return int(args[0] in obj)
+        if name == 'item':
+            return obj.get(args[0])
+        if name == 'defined':
+            return int(obj.get(args[0]) is not None) if args else 1
+        raise TemplateError(f'Unknown method {name}')
+    if name == 'defined':
+        return int(obj is not None)
+    return None
+
+
+def _evaluate(e, stash):
+    kind = e[0]
+    if kind == 'lit':
+        return e[1]
+    if kind == 'var':
+        return stash.get(e[1])
+    if kind == 'get':
+        args = e[3] if e[3] is None else [_evaluate(a, stash) for a in e[3]]
+        return _get(_evaluate(e[1], stash), e[2], args)
+    if kind == 'or':
+        a = _evaluate(e[1], stash)
+        return a if _truthy(a) else _evaluate(e[2], stash)
+    if kind == 'and':
+        a = _evaluate(e[1], stash)
+        return _evaluate(e[2], stash) if _truthy(a) else a
+    if kind == 'not':
+        return int(not _truthy(_evaluate(e[1], stash)))
+    if kind == 'cmp':
+        op = e[1]
+        a, b = (_evaluate(x, stash) for x in e[2:])
+        a, b = ('' if a is None else a), ('' if b is None else b)
+        if op in ('==', '!='):
+            return int((str(a) == str(b)) == (op == '=='))
+        return int({'<': a < b, '>': a > b, '<=': a <= b, '>=': a >= b}[op])
+    raise TemplateError(f'Bad expression {e}')
+
+
+def _stringify(v):
+    if v is None or v is False:
+        return ''
+    if v is True:
+        return '1'
+    return str(v)
+
+
+def _split_directive(directive):
+    word = directive.split(None, 1)[0]
+    return word, directive[len(word):].strip()
+
+
+def _parse_block(tokens, i, stop):
+    body = []
+    while i < len(tokens):
+        kind, val = tokens[i]
+        if kind == 'text':
+            body.append(('text', val))
+            i += 1
+            continue
+        word, rest = _split_directive(val)
+        if word in stop:
+            return body, i
+        if word in ('IF', 'UNLESS'):
+            cond = _Parser(rest).parse()
+            if word == 'UNLESS':
+                cond = ('not', cond)
+            branches = []
+            i += 1
+            while True:
+                block, i = _parse_block(tokens, i, ('ELSIF', 'ELSE', 'END'))
+                branches.append((cond, block))
+                word, rest = _split_directive(tokens[i][1])
+                i += 1
+                if word == 'END':
+                    break
+                cond = ('lit', 1) if word == 'ELSE' else _Parser(rest).parse()
+            body.append(('if', branches))
+        elif word == 'FILTER':
+            m = re.match(r'(\w+)\s*\((.*)\)$', rest, re.S)
+            if m is None or m.group(1) != 'replace':
+                raise TemplateError(f'Unsupported FILTER {rest!r}')
+            p = _Parser(m.group(2))
+            args = []
+            while not p.done():
+                args.append(p.or_())
+                if p.peek(','):
+                    p.take()
+            if len(args) != 2:
+                raise TemplateError(f'FILTER replace takes 2 arguments: {rest!r}')
+            block, i = _parse_block(tokens, i + 1, ('END',))
+            i += 1
+            body.append(('replace', args, block))
+        elif word in ('ELSIF', 'ELSE', 'END'):
+            raise TemplateError(f'Unexpected {word}')
+        else:
+            body.append(('expr', _Parser(val).parse()))
+            i += 1
+    if stop:
+        raise TemplateError(f'Missing {"/".join(stop)}')
+    return body, i
+
+
+def parse(src):
+    body, _ = _parse_block(tokenize(src), 0, ())
+    return body
+
+
+def _render(body, stash, out):
+    for node in body:
+        kind = node[0]
+        if kind == 'text':
+            out.append(node[1])
+        elif kind == 'expr':
+            out.append(_stringify(_evaluate(node[1], stash)))
+        elif kind == 'if':
+            for cond, block in node[1]:
+                if _truthy(_evaluate(cond, stash)):
+                    _render(block, stash, out)
+                    break
+        elif kind == 'replace':
+            inner = []
+            _render(node[2], stash, inner)
+            search, replacement = (_stringify(_evaluate(a, stash)) for a in node[1])
+            out.append(re.sub(search, lambda m: replacement, ''.join(inner)))
+
+
+def render(src, stash):
+    '''
+    Render the template `src` with the variables in the dict `stash`.
+    '''
+    out = []
+    _render(parse(src), stash, out)
+    return ''.join(out)
+
+
+def read_params(path='params.yaml'):
+    with open(path) as f:
+        return yaml.safe_load(f)['param']
+
+
+def param_stash(params, key, parts=(), params_file='params.yaml'):
+    '''
+    Variables of the parameter key `key` updated with those of the YAML files
+    `parts`.
+    '''
+    if key not in params:
+        raise KeyError(f'Missing parameter key {key} in {params_file}\n\n'
+                       f'Existing parameter keys are: {" ".join(params)}')
+    stash = dict(params[key])
+    for part in parts:
+        with open(part) as f:
+            stash.update(yaml.safe_load(f) or {})
+    return stash
+
+
+def render_by_param(template, key, parts=(), params_file='params.yaml'):
+    stash = param_stash(read_params(params_file), key, parts, params_file)
+    with open(template) as f:
+        return render(f.read(), stash)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Render a SQL template with a parameter key')
+    parser.add_argument('key')
+    parser.add_argument('template')
+    parser.add_argument('parts', nargs='*', help='YAML files with more variables')
+    parser.add_argument('--params', default='params.yaml')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        sys.stdout.write(render_by_param(args.template, args.key, args.parts, args.params))
+    except KeyError as e:
+        raise SystemExit(f'{sys.argv[0]}: {e.args[0]}')